@@ -0,0 +1,145 @@
+"""Compiles button settings into immutable action plans that are ready to execute"""
+import shlex
+from typing import Any, NamedTuple, Tuple
+from warnings import warn
+
+from config import COMMAND_DEBOUNCE, COMMAND_MAX_INSTANCES, MIDI_BACKEND, MQTT_HOST, OSC_NATIVE
+from launcher import LaunchSpec
+import midi
+import mqtt
+import osc
+
+# Command types that are sent to something outside of this application
+EXTERNAL_COMMAND_TYPES = ("OSC", "MIDI", "MQTT")
+
+# Command types that do nothing, "Command Type" is what an unset type reads as
+NO_COMMAND_TYPES = ("", "Command Type")
+
+
+class ActionPlan(NamedTuple):
+    """What pressing a button does. argument holds the command string already parsed for
+    the command type: the LaunchSpec of a Command, the key sections of a Keystroke, the page index
+    of a Page, the OSC command, MQTT topic and payload or MIDI messages, and so on."""
+
+    command_type: str
+    command_string: str
+    argument: Any
+
+
+NO_ACTION = ActionPlan("", "", None)
+
+# The names of pynput's Key members on any platform, which a keystroke may use in any case
+# besides single characters. Listed here so compiling can check names without loading pynput.
+KEY_NAMES = frozenset((
+    "alt", "alt_l", "alt_r", "alt_gr", "backspace", "caps_lock", "cmd", "cmd_l", "cmd_r",
+    "ctrl", "ctrl_l", "ctrl_r", "delete", "down", "end", "enter", "esc", "home", "left",
+    "page_down", "page_up", "right", "shift", "shift_l", "shift_r", "space", "tab", "up",
+    "media_play_pause", "media_volume_mute", "media_volume_down", "media_volume_up",
+    "media_previous", "media_next", "insert", "menu", "num_lock", "pause", "print_screen",
+    "scroll_lock", *(f"f{number}" for number in range(1, 25)),
+))
+
+
+def _replace_special_keys(key: str) -> str:
+    """Replaces special keywords the user can use with their character equivalent."""
+    if key.lower() == "plus":
+        return "+"
+    if key.lower() == "comma":
+        return ","
+    if key.lower().startswith("delay"):
+        return key.lower()
+    return key
+
+
+def _compile_keystroke(command_string: str) -> Tuple[Tuple[Any, ...], ...]:
+    """Returns the sections of a keystroke string. Each section holds the keys to press
+    together, as lower case key names or characters, and delays as float seconds. Raises
+    ValueError for a key that is neither. Key names are looked up in pynput when pressed,
+    so compiling never loads pynput."""
+    sections = []
+    for section in command_string.strip().replace(" ", "").split(","):
+        section_keys = []
+        # Since + and , are used to delimit our section and keys to press,
+        # they need to be substituted with keywords.
+        for key_name in (_replace_special_keys(key_name) for key_name in section.split("+")):
+            if key_name.startswith("delay"):
+                sleep_time_arg = key_name.split("delay", 1)[1]
+                try:
+                    # default if not specified
+                    section_keys.append(float(sleep_time_arg) if sleep_time_arg else 0.5)
+                except ValueError:
+                    raise ValueError(f"Could not convert sleep time to float '{sleep_time_arg}'")
+            elif key_name.lower() in KEY_NAMES:
+                section_keys.append(key_name.lower())
+            elif len(key_name) == 1:
+                section_keys.append(key_name)
+            elif key_name:
+                raise ValueError(f"Unknown key '{key_name}'")
+        sections.append(tuple(section_keys))
+    return tuple(sections)
+
+
+def _midi_command_string(button_settings) -> str:
+    """Returns the MIDI message of a button: its command string, or its "midi" setting, which
+    some configurations use instead, if the command string is empty"""
+    command_string = button_settings.get("command_string", "")
+    midi_setting = button_settings.get("midi", "")
+    if not command_string:
+        return midi_setting
+    if midi_setting and midi_setting != command_string:
+        warn(f"MIDI button has both \"midi\" '{midi_setting}' and command string '{command_string}', "
+             "sending the command string")
+    return command_string
+
+
+def sends_natively(command_type: str, mqtt_host: str = MQTT_HOST) -> bool:
+    """Returns whether this process sends an external command type itself, rather than
+    relaying its command string to another process. mqtt_host is the broker of the deck."""
+    if command_type == "OSC":
+        return OSC_NATIVE
+    if command_type == "MQTT":
+        return bool(mqtt_host)
+    if command_type == "MIDI":
+        return midi.available(MIDI_BACKEND)
+    return False
+
+
+def compile_button(button_settings: dict, mqtt_host: str = MQTT_HOST) -> ActionPlan:
+    """Compiles a button's settings into its action plan, with mqtt_host the MQTT broker of
+    the button's deck. Raises ValueError if the command string is not valid for the command
+    type. External commands that are relayed keep their command string as it is, since only
+    the process they are relayed to has to understand it."""
+    command_type = button_settings.get("command_type", "")
+    command_string = button_settings.get("command_string", "")
+    if command_type in NO_COMMAND_TYPES:
+        return NO_ACTION
+    if command_type == "MIDI":
+        command_string = _midi_command_string(button_settings)
+    if command_type in EXTERNAL_COMMAND_TYPES and not sends_natively(command_type, mqtt_host):
+        return ActionPlan(command_type, command_string, command_string)
+
+    if command_type == "Command":
+        argument: Any = LaunchSpec(
+            tuple(shlex.split(command_string)),
+            int(button_settings.get("max_instances", COMMAND_MAX_INSTANCES)),
+            float(button_settings.get("debounce", COMMAND_DEBOUNCE)),
+        )
+    elif command_type == "Keystroke":
+        argument = _compile_keystroke(command_string)
+    elif command_type == "Text":
+        argument = command_string
+    elif command_type in ("Set Brightness", "Brightness"):
+        argument = int(command_string)
+    elif command_type == "Page":
+        argument = int(command_string) - 1
+    elif command_type == "OSC":
+        argument = osc.parse_command(command_string)
+    elif command_type == "MQTT":
+        argument = mqtt.parse_command(command_string)
+    elif command_type == "MIDI":
+        argument = midi.parse_message(command_string)
+    elif command_type == "CloseStreamDeck":
+        argument = None
+    else:
+        raise ValueError(f"Unknown command type '{command_type}'")
+    return ActionPlan(command_type, command_string, argument)
@@ -0,0 +1,201 @@
+"""Plays animated icons on every deck from one shared animation clock"""
+import bisect
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+# Seconds a frame is shown when its file gives no duration, or one too short to honour,
+# as web browsers do
+DEFAULT_FRAME_DURATION = 0.1
+MIN_FRAME_DURATION = 0.02
+
+
+def frame_duration(milliseconds: Optional[float]) -> float:
+    """Returns the seconds to show a frame for, from the duration its file gives"""
+    if not milliseconds or milliseconds / 1000 < MIN_FRAME_DURATION:
+        return DEFAULT_FRAME_DURATION
+    return milliseconds / 1000
+
+
+class Animation:
+    """ The frames of an animated key in the deck's native format, with the
+        seconds each is shown for. len() is the bytes held, so animations can
+        be kept in the ImageCache next to still images. """
+
+    __slots__ = ("frames", "ends", "duration", "_size")
+
+    def __init__(self, frames: Sequence[bytes], durations: Sequence[float]):
+        """ Constructs a new Animation instance
+
+        :param Sequence frames: The native images of the frames, in order.
+        :param Sequence durations: The seconds each frame is shown for.
+        """
+        self.frames = tuple(frames)
+        self.ends = tuple(itertools.accumulate(durations))
+        self.duration = self.ends[-1]
+        self._size = sum(len(frame) for frame in self.frames)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def frame_at(self, elapsed: float) -> Tuple[int, float]:
+        """ Returns the frame shown after elapsed seconds and the seconds until the next one."""
+        position = elapsed % self.duration
+        frame = min(bisect.bisect_right(self.ends, position), len(self.frames) - 1)
+        return frame, self.ends[frame] - position
+
+
+class _Playing:
+    __slots__ = ("deck_id", "page", "key", "cache_key", "load", "animation", "started_at", "frame")
+
+    def __init__(self, deck_id: str, page: int, key: int, cache_key: Hashable,
+                 load: Callable[[], Animation]):
+        self.deck_id = deck_id
+        self.page = page
+        self.key = key
+        self.cache_key = cache_key
+        self.load = load
+        self.animation: Optional[Animation] = None
+        self.started_at = 0.0
+        self.frame = -1
+
+
+class AnimationClock:
+    """ Plays the animated keys of the pages being shown, on one thread for all
+        decks. Frames are chosen by the time since an animation started, so a
+        frame that can't be sent in time is skipped instead of slowing the
+        animation down. All decks together get at most budget frames per
+        second, with bursts of up to budget; frames over it are dropped.
+        Animations are loaded on the clock's thread the first time they are
+        shown, through load, and are kept by their cache key in cache. write
+        is called with each frame while the clock's lock is held, so that a
+        key stopped by show never gets another frame once show returns; it
+        should only queue the frame, like DeckWriter.submit does, and must not
+        call show. """
+
+    def __init__(self, write: Callable[[str, int, bytes], None], cache, budget: float):
+        """ Constructs a new AnimationClock instance
+
+        :param Callable write: Receives (deck_id, key, image) for each frame to show.
+        :param ImageCache cache: Where loaded animations are kept, shared by every deck.
+        :param float budget: The most frames per second sent to all decks together.
+        """
+        self.write = write
+        self.cache = cache
+        self.budget = max(1.0, budget)
+        self.frames = 0
+        self.dropped = 0
+        self.loaded = 0
+        self.errors = 0
+        self._playing: Dict[Tuple[str, int], _Playing] = {}
+        self._due: List[Tuple[float, int, _Playing]] = []
+        self._sequence = itertools.count()
+        self._tokens = self.budget
+        self._counted_at = time.monotonic()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def show(self, deck_id: str, page: int,
+             animations: Dict[int, Tuple[Hashable, Callable[[], Animation]]]) -> None:
+        """ Sets the animated keys of the page a deck shows, by key: the animation's
+            cache key and how to load it. Keys that keep the same animation carry on
+            playing; all others of the deck stop."""
+        with self._condition:
+            for playing_id, playing in list(self._playing.items()):
+                if playing.deck_id != deck_id:
+                    continue
+                cache_key, _load = animations.get(playing.key, (None, None))
+                if playing.page != page or cache_key != playing.cache_key:
+                    del self._playing[playing_id]
+
+            now = time.monotonic()
+            for key, (cache_key, load) in animations.items():
+                if (deck_id, key) in self._playing:
+                    continue
+                playing = self._playing[(deck_id, key)] = _Playing(deck_id, page, key, cache_key, load)
+                heapq.heappush(self._due, (now, next(self._sequence), playing))
+
+            if self._playing and self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="animation", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the number of animations playing and the frame counters."""
+        return {
+            "playing": len(self._playing),
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "loaded": self.loaded,
+            "errors": self.errors,
+        }
+
+    def _take_token(self, now: float) -> bool:
+        self._tokens = min(self.budget, self._tokens + (now - self._counted_at) * self.budget)
+        self._counted_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _next(self) -> _Playing:
+        with self._condition:
+            while True:
+                while self._due and self._playing.get(
+                    (self._due[0][2].deck_id, self._due[0][2].key)
+                ) is not self._due[0][2]:
+                    # Stopped since it was scheduled
+                    heapq.heappop(self._due)
+                now = time.monotonic()
+                if self._due and self._due[0][0] <= now:
+                    return heapq.heappop(self._due)[2]
+                self._condition.wait(self._due[0][0] - now if self._due else None)
+
+    def _run(self) -> None:
+        while True:
+            playing = self._next()
+            if playing.animation is None and not self._load(playing):
+                continue
+
+            now = time.monotonic()
+            frame, remaining = playing.animation.frame_at(now - playing.started_at)  # type: ignore
+            with self._condition:
+                # The key may have been stopped or given another animation while this one was
+                # loaded, and its frame would then cover what the key shows now
+                if self._playing.get((playing.deck_id, playing.key)) is not playing:
+                    continue
+                if frame != playing.frame:
+                    if self._take_token(now):
+                        self._write(playing, frame)
+                    else:
+                        self.dropped += 1
+                heapq.heappush(self._due, (now + remaining, next(self._sequence), playing))
+
+    def _write(self, playing: _Playing, frame: int) -> None:
+        try:
+            self.write(playing.deck_id, playing.key, playing.animation.frames[frame])  # type: ignore
+            playing.frame = frame
+            self.frames += 1
+        except Exception as error:
+            self.errors += 1
+            print(f"Unable to show key {playing.key} of {playing.deck_id} with error {error}")
+
+    def _load(self, playing: _Playing) -> bool:
+        animation = self.cache.get(playing.cache_key)
+        if animation is None:
+            try:
+                animation = playing.load()
+            except Exception as error:
+                self.errors += 1
+                print(f"Unable to load the animation of key {playing.key} of {playing.deck_id} with error {error}")
+                with self._condition:
+                    if self._playing.get((playing.deck_id, playing.key)) is playing:
+                        del self._playing[(playing.deck_id, playing.key)]
+                return False
+            self.cache.put(playing.cache_key, animation)
+            self.loaded += 1
+        playing.animation = animation
+        playing.started_at = time.monotonic()
+        return True
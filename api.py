@@ -1,111 +1,390 @@
 """Defines the Python API for interacting with the StreamDeck Configuration UI"""
+import atexit
 import json
 import os
 import threading
-from functools import partial
-from typing import Dict, Tuple, Union, cast
+import time
+from contextlib import contextmanager
+from functools import partial, wraps
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple, Union
 from warnings import warn
 
-from PIL import Image, ImageDraw, ImageFont
-from PySide2.QtCore import QObject, Signal
 from StreamDeck import DeviceManager
 from StreamDeck.Devices import StreamDeck
-from StreamDeck.ImageHelpers import PILHelper
 
-from config import CONFIG_FILE_VERSION, DEFAULT_FONT, FONTS_PATH, STATE_FILE
-
-image_cache: Dict[str, memoryview] = {}
+from actions import NO_ACTION, ActionPlan, compile_button
+from animation import Animation, AnimationClock, frame_duration
+from cache import AssetCache, ImageCache
+import compositor
+from config import (
+    ANIMATION_FRAME_BUDGET,
+    ASSET_CACHE_SIZE,
+    CONFIG_FILE_VERSION,
+    FONTS_PATH,
+    IMAGE_CACHE_SIZE,
+    MQTT_HOST,
+    PAGE_COMPOSITOR,
+    STATE_FILE,
+    STATE_FILE_COMPACT,
+    STATE_SAVE_DELAY,
+    TILE_BUDGET,
+)
+from deckwriter import DeckWriter
+from events import Signal
+import metrics
+from model import BUTTON_DEFAULTS, ButtonState, DeckState
+from persist import StatePersister
+from prerender import Prerenderer
+from tiles import TileScheduler, tile_spec, tile_text
+
+image_cache = ImageCache(IMAGE_CACHE_SIZE)
+asset_cache = AssetCache(ASSET_CACHE_SIZE)
+prerenderer = Prerenderer()
 decks: Dict[str, StreamDeck.StreamDeck] = {}
-state: Dict[str, Dict[str, Union[int, Dict[int, Dict[int, Dict[str, str]]]]]] = {}
-streamdecks_lock = threading.Lock()
+state: Dict[str, DeckState] = {}
+# The image cache key of what each physical key currently shows, None for a cleared key
+displayed: Dict[str, Dict[int, Optional[Hashable]]] = {}
+# Held while a deck's keys are worked out, queued and recorded in displayed, so displayed
+# always holds what was queued last for each key
+render_locks: Dict[str, threading.RLock] = {}
+writers: Dict[str, DeckWriter] = {}
+writers_lock = threading.Lock()
 key_event_lock = threading.Lock()
+action_plans: Dict[Tuple[str, int, int], ActionPlan] = {}
+render_seconds = metrics.REGISTRY.histogram(
+    "streamdeck_render_seconds", "Time spent rendering a key image that was not cached"
+)
+compose_seconds = metrics.REGISTRY.histogram(
+    "streamdeck_compose_seconds", "Time spent rendering the uncached keys of a page on one canvas"
+)
+save_seconds = metrics.REGISTRY.histogram(
+    "streamdeck_save_seconds", "Time spent writing the configuration file"
+)
+change_listeners: List[Callable[[Optional[str], Optional[int], Optional[int]], None]] = []
+reconnect_listeners: List[Callable[[str, StreamDeck.StreamDeck], None]] = []
+device_manager: Optional[DeviceManager.DeviceManager] = None
+# Serial numbers by device id, so a device seen before is recognised without opening it
+device_serials: Dict[str, str] = {}
+# Device ids seen by the last ensure_decks_connected
+present_devices: Set[str] = set()
+# Seconds pre-rendering waits at most for the decks' writers to catch up before it starts
+PRERENDER_WRITE_WAIT = 1.0
+# The text this application last wrote to STATE_FILE, so reload_config ignores its own writes
+written_config: Optional[str] = None
+
+
+class KeySignalEmitter:
+    """ Relays key presses as key_pressed(deck_id, key, state). Its slots run on the
+        deck's read thread; GUI code should connect to qt_key_signals() instead. """
+
+    def __init__(self):
+        self.key_pressed = Signal()
 
 
-class KeySignalEmitter(QObject):
-    key_pressed = Signal(str, int, bool)
+streamdesk_keys = KeySignalEmitter()
+_qt_key_signals = None
 
 
-streamdesk_keys = KeySignalEmitter()
+def qt_key_signals():
+    """Returns a Qt object whose key_pressed signal relays key presses, so Qt delivers them on
+    the GUI thread. Qt is only imported when this is first called."""
+    global _qt_key_signals
+    if _qt_key_signals is None:
+        from PySide2.QtCore import QObject, Signal as QtSignal
+
+        class QtKeySignalEmitter(QObject):
+            key_pressed = QtSignal(str, int, bool)
+
+        _qt_key_signals = QtKeySignalEmitter()
+        streamdesk_keys.key_pressed.connect(_qt_key_signals.key_pressed.emit)
+    return _qt_key_signals
 
 
 def _key_change_callback(deck_id: str, _deck: StreamDeck.StreamDeck, key: int, state: bool) -> None:
     """ Callback whenever a key is pressed. This is method runs the various actions defined
         for the key being pressed, sequentially. """
-    # Stream Desk key events fire on a background thread. Emit a signal
-    # to bring it back to UI thread, so we can use Qt objects for timers etc.
+    # Stream Desk key events fire on a background thread. A UI gets them
+    # back on its own thread through qt_key_signals().
     # Since multiple keys could fire simultaniously, we need to protect
     # shared state with a lock
     with key_event_lock:
         streamdesk_keys.key_pressed.emit(deck_id, key, state)
 
 
+# Read in place of a deck, button or settings that are not configured, never modified
+_NO_SETTINGS: Dict[str, Union[str, int]] = {}
+_NO_DECK = DeckState()
+_NO_BUTTON = ButtonState()
+
+
+def _deck(deck_id: str) -> DeckState:
+    """Returns a deck's settings for reading, which are all defaults if it has none"""
+    return state.get(deck_id, _NO_DECK)
+
+
+def _deck_for_update(deck_id: str) -> DeckState:
+    deck = state.get(deck_id)
+    if deck is None:
+        deck = state[deck_id] = DeckState()
+    return deck
+
+
+def _updates_state(setter: Callable) -> Callable:
+    """Makes a function that changes the state hold batch_lock while it does, so a reload of
+    the configuration file can't replace the state part way through and lose the change"""
+
+    @wraps(setter)
+    def locked(*args, **kwargs):
+        with batch_lock:
+            return setter(*args, **kwargs)
+
+    return locked
+
+
 def get_display_timeout(deck_id: str) -> int:
     """ Returns the amount of time in seconds before the display gets dimmed."""
-    return cast(int, state.get(deck_id, {}).get("display_timeout", 0))
+    return _deck(deck_id).display_timeout
 
 
+@_updates_state
 def set_display_timeout(deck_id: str, timeout: int) -> None:
     """ Sets the amount of time in seconds before the display gets dimmed."""
-    state.setdefault(deck_id, {})["display_timeout"] = timeout
+    _deck_for_update(deck_id).set("display_timeout", timeout)
     _save_state()
 
 
 def _save_state():
-    export_config(STATE_FILE)
+    pending = _pending_work()
+    if pending is not None:
+        pending.save = True
+        return
+    state_persister.schedule()
+
+
+def _write_state():
+    global written_config
+    written_config = export_config(STATE_FILE, compact=STATE_FILE_COMPACT)
+
+
+state_persister = StatePersister(_write_state, STATE_SAVE_DELAY)
+atexit.register(state_persister.flush)
 
 
 def _open_config(config_file: str):
-    global state
+    global state, action_plans
 
+    prerenderer.cancel()
     with open(config_file) as state_file:
-        config = json.loads(state_file.read())
-        file_version = config.get("streamdeck_ui_version", 0)
-        if file_version != CONFIG_FILE_VERSION:
-            raise ValueError(
-                "Incompatible version of config file found: "
-                f"{file_version} does not match required version "
-                f"{CONFIG_FILE_VERSION}."
-            )
-
-        state = {}
-        for deck_id, deck in config["state"].items():
+        new_state = _parse_config(state_file.read())
+
+    new_action_plans = _compile_action_plans(new_state)
+    state = new_state
+    action_plans = new_action_plans
+    _button_changed(None, None, None)
+
+
+def _parse_config(text: str) -> Dict[str, DeckState]:
+    """Returns the state held by the text of a configuration file. Raises ValueError if the
+    file is not a compatible configuration."""
+    config = json.loads(text)
+    file_version = config.get("streamdeck_ui_version", 0)
+    if file_version != CONFIG_FILE_VERSION:
+        raise ValueError(
+            "Incompatible version of config file found: "
+            f"{file_version} does not match required version "
+            f"{CONFIG_FILE_VERSION}."
+        )
+
+    new_state = {}
+    for deck_id, deck in config["state"].items():
+        if "buttons" in deck:
             deck["buttons"] = {
                 int(page_id): {int(button_id): button for button_id, button in buttons.items()}
-                for page_id, buttons in deck.get("buttons", {}).items()
+                for page_id, buttons in deck["buttons"].items()
             }
-            state[deck_id] = deck
+        new_state[deck_id] = DeckState.from_dict(deck)
+    return new_state
 
 
+def reload_config(config_file: str = STATE_FILE) -> List[Tuple[str, int, int]]:
+    """Applies changes made to the configuration file by something else than this application,
+    returning the (deck_id, page, button) of every button that changed. Only those buttons'
+    actions are compiled and only those shown on a deck are rendered again. Raises ValueError,
+    leaving the state as it was, if the file has an invalid button."""
+    global state
+
+    with open(config_file) as state_file:
+        text = state_file.read()
+    if text == written_config:
+        return []
+    new_state = _parse_config(text)
+
+    # The state is only compared and replaced while no setter or batch is changing it, and
+    # changes that are not saved yet are newer than the file, which they are about to replace
+    with batch():
+        if text == written_config or state_persister.pending():
+            return []
+
+        changed = []
+        for deck_id in new_state.keys() | state.keys():
+            old_deck, new_deck = state.get(deck_id, _NO_DECK), new_state.get(deck_id, _NO_DECK)
+            for page in old_deck.buttons.keys() | new_deck.buttons.keys():
+                old_page, new_page = old_deck.page_buttons(page), new_deck.page_buttons(page)
+                page_changed = False
+                for button in old_page.keys() | new_page.keys():
+                    if old_page.get(button) != new_page.get(button):
+                        changed.append((deck_id, page, button))
+                        page_changed = True
+                    elif button in new_page:
+                        # Unchanged buttons keep their record, and so their version
+                        new_page[button] = old_page[button]
+                if not page_changed and page in old_deck.page_versions:
+                    new_deck.page_versions[page] = old_deck.page_versions[page]
+
+        # MQTT buttons are compiled for their deck's broker, so they compile again when it changes
+        recompiled = [
+            (deck_id, page, button)
+            for deck_id, new_deck in new_state.items()
+            if _mqtt_host(new_deck) != _mqtt_host(state.get(deck_id, _NO_DECK))
+            for page, buttons in new_deck.buttons.items()
+            for button, button_state in buttons.items()
+            if button_state.command_type == "MQTT" and (deck_id, page, button) not in changed
+        ]
+        plans = {}
+        for deck_id, page, button in changed + recompiled:
+            button_state = new_state.get(deck_id, _NO_DECK).button(page, button)
+            try:
+                plans[(deck_id, page, button)] = compile_button(
+                    button_state or _NO_BUTTON, _mqtt_host(new_state.get(deck_id, _NO_DECK))
+                )
+            except ValueError as error:
+                raise ValueError(f"Invalid button {button} on page {page} of {deck_id}: {error}") from error
+
+        old_state, state = state, new_state
+        for deck_id, page, button in changed:
+            old_deck = old_state.get(deck_id, _NO_DECK)
+            old_button = old_deck.button(page, button)
+            if old_button and deck_id in decks:
+                image_cache.pop(_image_key(
+                    decks[deck_id], old_button.icon, old_button.text, old_button.font,
+                    old_deck.get("background", ""), button,
+                ))
+            _button_changed(deck_id, page, button)
+            action_plans[(deck_id, page, button)] = plans[(deck_id, page, button)]
+        for deck_id, page, button in recompiled:
+            action_plans[(deck_id, page, button)] = plans[(deck_id, page, button)]
+
+        pages_changed = False
+        for deck_id in new_state:
+            if deck_id not in decks:
+                continue
+            old_deck = old_state.get(deck_id, _NO_DECK)
+            if get_brightness(deck_id) != old_deck.brightness:
+                write_brightness(deck_id, get_brightness(deck_id))
+            background_changed = get_background(deck_id) != old_deck.get("background", "")
+            if background_changed:
+                _button_changed(None, None, None)
+            if get_page(deck_id) != old_deck.page or background_changed:
+                pages_changed = True
+                render(deck_id=deck_id)
+            else:
+                page = get_page(deck_id)
+                keys = [button for button_deck, button_page, button in changed
+                        if button_deck == deck_id and button_page == page]
+                if keys:
+                    _page_shown(deck_id)
+                    render(deck_id=deck_id, keys=keys)
+
+        if changed or pages_changed:
+            prerender()
+        return changed
+
+
+def _compile_action_plans(config_state: Dict[str, DeckState]) -> Dict[Tuple[str, int, int], ActionPlan]:
+    """Compiles the action plan of every button, raising ValueError for the first invalid one"""
+    plans = {}
+    for deck_id, deck in config_state.items():
+        mqtt_host = _mqtt_host(deck)
+        for page, buttons in deck.buttons.items():
+            for button, button_settings in buttons.items():
+                try:
+                    plans[(deck_id, page, button)] = compile_button(button_settings, mqtt_host)
+                except ValueError as error:
+                    raise ValueError(
+                        f"Invalid button {button} on page {page} of {deck_id}: {error}"
+                    ) from error
+    return plans
+
+
+def _mqtt_host(deck: DeckState) -> str:
+    """Returns the MQTT broker a deck's MQTT buttons publish to, empty if they are relayed"""
+    return deck.get("mqtt", _NO_SETTINGS).get("host", MQTT_HOST)
+
+
+def get_action_plan(deck_id: str, page: int, button: int) -> ActionPlan:
+    """Returns what pressing the specified button does, compiled from its settings. A button
+    whose settings are not valid does nothing."""
+    plan = action_plans.get((deck_id, page, button))
+    if plan is None:
+        try:
+            plan = compile_button(_button(deck_id, page, button), _mqtt_host(_deck(deck_id)))
+        except ValueError as error:
+            warn(f"Button {button} on page {page} of {deck_id} does nothing: {error}")
+            plan = NO_ACTION
+        action_plans[(deck_id, page, button)] = plan
+    return plan
+
+
+@_updates_state
 def import_config(config_file: str) -> None:
     _open_config(config_file)
     render()
+    prerender()
     _save_state()
 
 
-def export_config(output_file: str) -> None:
+def export_config(output_file: str, compact: bool = False) -> str:
+    """Writes the configuration to output_file, returning the text written"""
+    with save_seconds.labels().time():
+        return _export_config(output_file, compact)
+
+
+def _export_config(output_file: str, compact: bool) -> str:
     try:
+        text = json.dumps(
+            {
+                "streamdeck_ui_version": CONFIG_FILE_VERSION,
+                "state": {deck_id: deck.to_dict() for deck_id, deck in state.items()},
+            },
+            indent=None if compact else 4,
+            separators=(",", ":") if compact else (",", ": "),
+        )
         with open(output_file + ".tmp", "w") as state_file:
-            state_file.write(
-                json.dumps(
-                    {"streamdeck_ui_version": CONFIG_FILE_VERSION, "state": state},
-                    indent=4,
-                    separators=(",", ": "),
-                )
-            )
+            state_file.write(text)
     except Exception as error:
         print(f"The configuration file '{output_file}' was not updated. Error: {error}")
         raise
     else:
         os.replace(output_file + ".tmp", os.path.realpath(output_file))
+    return text
+
+
+def _device_manager() -> DeviceManager.DeviceManager:
+    global device_manager
+    if device_manager is None:
+        device_manager = DeviceManager.DeviceManager()
+    return device_manager
 
 
 def open_decks() -> Dict[str, Dict[str, Union[str, Tuple[int, int]]]]:
     """Opens and then returns all known stream deck devices"""
-    for deck in DeviceManager.DeviceManager().enumerate():
+    for deck in _device_manager().enumerate():
         deck.open()
         deck.reset()
         deck_id = deck.get_serial_number()
+        device_serials[deck.id()] = deck_id
         decks[deck_id] = deck
+        invalidate_displayed(deck_id)
         deck.set_key_callback(partial(_key_change_callback, deck_id))
 
     return {
@@ -116,272 +395,930 @@ def open_decks() -> Dict[str, Dict[str, Union[str, Tuple[int, int]]]]:
 
 def close_decks() -> None:
     """Closes open decks for input/ouput."""
-    for _deck_serial, deck in decks.items():
+    state_persister.flush()
+    for deck_serial, deck in decks.items():
+        writer = writers.pop(deck_serial, None)
+        if writer is not None:
+            writer.stop()
         if deck.connected():
             deck.set_brightness(50)
             deck.reset()
             deck.close()
 
 
-def ensure_decks_connected() -> None:
-    """Reconnects to any decks that lost connection. If they did, re-renders them."""
-    for deck_serial, deck in decks.copy().items():
-        if not deck.connected():
-            for new_deck in DeviceManager.DeviceManager().enumerate():
-                try:
-                    new_deck.open()
-                    new_deck_serial = new_deck.get_serial_number()
-                except Exception as error:
-                    warn(f"A {error} error occurred when trying to reconnect to {deck_serial}")
-                    new_deck_serial = None
+def add_reconnect_listener(listener: Callable[[str, StreamDeck.StreamDeck], None]) -> None:
+    """Registers a callback that receives (deck_id, deck) when a lost deck was reconnected,
+    before its page is rendered again"""
+    reconnect_listeners.append(listener)
+
 
-                if new_deck_serial == deck_serial:
-                    deck.close()
-                    new_deck.reset()
-                    new_deck.set_key_callback(partial(_key_change_callback, new_deck_serial))
-                    decks[new_deck_serial] = new_deck
-                    render()
+def ensure_decks_connected() -> List[str]:
+    """Reconnects to any decks that lost connection and re-renders each of them, returning
+    their ids. Devices are enumerated once. A device not in use is only opened if its serial
+    number is unknown, belongs to a lost deck, or it was plugged in since the last call."""
+    global present_devices
+    devices = _device_manager().enumerate()
+    present = {device.id() for device in devices}
+    plugged_in = present - present_devices
+    present_devices = present
+    lost = {
+        deck_id for deck_id, deck in decks.items() if deck.id() not in present or not deck.is_open()
+    }
+    if not lost:
+        return []
+
+    in_use = {deck.id() for deck_id, deck in decks.items() if deck_id not in lost}
+    reconnected = []
+    for new_deck in devices:
+        known_serial = device_serials.get(new_deck.id())
+        if new_deck.id() in in_use or (
+            known_serial is not None and known_serial not in lost and new_deck.id() not in plugged_in
+        ):
+            continue
+        try:
+            new_deck.open()
+            new_deck_serial = new_deck.get_serial_number()
+        except Exception as error:
+            warn(f"A {error} error occurred when trying to reconnect to {new_deck.id()}")
+            continue
+
+        device_serials[new_deck.id()] = new_deck_serial
+        if new_deck_serial in lost:
+            _reconnect_deck(new_deck_serial, new_deck)
+            lost.discard(new_deck_serial)
+            reconnected.append(new_deck_serial)
+        else:
+            new_deck.close()
+    return reconnected
+
+
+def _reconnect_deck(deck_id: str, new_deck: StreamDeck.StreamDeck) -> None:
+    try:
+        decks[deck_id].close()
+    except Exception:
+        pass
+    new_deck.reset()
+    new_deck.set_key_callback(partial(_key_change_callback, deck_id))
+    decks[deck_id] = new_deck
+    invalidate_displayed(deck_id)
+    write_brightness(deck_id, get_brightness(deck_id))
+    for listener in reconnect_listeners:
+        listener(deck_id, new_deck)
+    render(deck_id=deck_id)
 
 
 def get_deck(deck_id: str) -> Dict[str, Dict[str, Union[str, Tuple[int, int]]]]:
     return {"type": decks[deck_id].deck_type(), "layout": decks[deck_id].key_layout()}
 
 
-def _button_state(deck_id: str, page: int, button: int) -> dict:
-    buttons = state.setdefault(deck_id, {}).setdefault("buttons", {})
-    buttons_state = buttons.setdefault(page, {})  # type: ignore
-    return buttons_state.setdefault(button, {})  # type: ignore
+def _button(deck_id: str, page: int, button: int) -> ButtonState:
+    """Returns a button's settings for reading, which are all defaults if it has none"""
+    deck = state.get(deck_id)
+    button_state = deck.button(page, button) if deck is not None else None
+    return button_state if button_state is not None else _NO_BUTTON
+
+
+def _set_button(deck_id: str, page: int, button: int, name: str, value) -> bool:
+    """Changes a setting of a button, returning whether it was different. Raises ValueError,
+    changing nothing, if the button would not be valid."""
+    return _set_button_fields(deck_id, page, button, {name: value})
+
+
+def _set_button_fields(deck_id: str, page: int, button: int, fields: Dict[str, Any]) -> bool:
+    """Changes settings of a button and compiles its action plan, returning whether any was
+    different. Raises ValueError, changing nothing, if the button would not be valid."""
+    settings = {**get_button_settings(deck_id, page, button), **fields}
+    plan = validate_button(deck_id, page, button, settings)
+    deck = _deck_for_update(deck_id)
+    changed = False
+    for name, value in fields.items():
+        changed = deck.set_button(page, button, name, value) or changed
+    if changed:
+        _button_changed(deck_id, page, button)
+        action_plans[(deck_id, page, button)] = plan
+    return changed
+
+
+def validate_button(deck_id: str, page: int, button: int, settings: Dict[str, Any]) -> ActionPlan:
+    """Returns the action plan of a button with the given settings on a deck. Raises ValueError
+    if the settings are not valid for it."""
+    try:
+        return compile_button(settings, _mqtt_host(_deck(deck_id)))
+    except ValueError as error:
+        raise ValueError(f"Invalid button {button} on page {page} of {deck_id}: {error}") from error
+
+
+def _unset_button(deck_id: str, page: int, button: int, name: str) -> bool:
+    """Removes a setting of a button, so it reads as its default, returning whether it was set"""
+    deck = state.get(deck_id)
+    if deck is None or not deck.unset_button(page, button, name):
+        return False
+    _button_changed(deck_id, page, button)
+    _forget_if_empty(deck_id)
+    return True
+
+
+def _forget_if_empty(deck_id: str) -> None:
+    # A deck left without any settings is dropped, so it isn't saved as an empty entry
+    deck = state.get(deck_id)
+    if deck is not None and next(deck.items(), None) is None:
+        del state[deck_id]
+
+
+def get_button_version(deck_id: str, page: int, button: int) -> int:
+    """Returns a number that changes whenever the button's settings do, and is never reused"""
+    return _button(deck_id, page, button).version
+
+
+def get_page_version(deck_id: str, page: int) -> int:
+    """Returns a number that changes whenever a button on the page does"""
+    return _deck(deck_id).page_version(page)
+
+
+def add_change_listener(
+    listener: Callable[[Optional[str], Optional[int], Optional[int]], None]
+) -> None:
+    """Registers a callback that receives (deck_id, page, button) whenever a button's settings
+    change. None is passed for all three when the whole configuration was replaced."""
+    change_listeners.append(listener)
+
+
+def _button_changed(deck_id: Optional[str], page: Optional[int], button: Optional[int]) -> None:
+    if deck_id is not None:
+        action_plans.pop((deck_id, page, button), None)  # type: ignore
+    pending = _pending_work()
+    if pending is not None:
+        pending.changes[(deck_id, page, button)] = None
+        return
+    for listener in change_listeners:
+        listener(deck_id, page, button)
+
+
+class _PendingWork:
+    """ What the changes made within a batch leave to be done once it ends: the buttons
+        to tell change listeners about, the keys to render by deck, None for the whole
+        page, the decks whose dynamic keys and animations to start again, and whether to
+        pre-render and save. """
+
+    __slots__ = ("changes", "renders", "shown", "prerender", "save")
+
+    def __init__(self):
+        self.changes: Dict[Tuple[Optional[str], Optional[int], Optional[int]], None] = {}
+        self.renders: Dict[str, Optional[Set[int]]] = {}
+        self.shown: Set[str] = set()
+        self.prerender = False
+        self.save = False
+
+
+_batch = threading.local()
+batch_lock = threading.RLock()
+
+
+def _pending_work() -> Optional[_PendingWork]:
+    return getattr(_batch, "pending", None)
+
+
+@contextmanager
+def batch():
+    """Applies the changes made on this thread within it together. Change listeners hear of
+    each changed button once, every deck is rendered once and the configuration is saved once,
+    when the outermost batch ends, even if it ends with an exception. Batches on other threads
+    wait for it to end."""
+    with batch_lock:
+        if _pending_work() is not None:
+            yield
+            return
+        pending = _batch.pending = _PendingWork()
+        try:
+            yield
+        finally:
+            _batch.pending = None
+            _finish_batch(pending)
+
+
+def _finish_batch(pending: _PendingWork) -> None:
+    for change in pending.changes:
+        for listener in change_listeners:
+            listener(*change)
+    # Rendering a whole page already starts its dynamic keys and animations
+    for deck_id in pending.shown:
+        if deck_id not in pending.renders or pending.renders[deck_id] is not None:
+            _page_shown(deck_id)
+    for deck_id, keys in pending.renders.items():
+        render(deck_id=deck_id, keys=keys)
+    if pending.prerender:
+        prerender()
+    if pending.save:
+        _save_state()
 
 
+@_updates_state
 def swap_buttons(deck_id: str, page: int, source_button: int, target_button: int) -> None:
     """Swaps the properties of the source and target buttons"""
-    temp = cast(dict, state[deck_id]["buttons"])[page][source_button]
-    cast(dict, state[deck_id]["buttons"])[page][source_button] = cast(
-        dict, state[deck_id]["buttons"]
-    )[page][target_button]
-    cast(dict, state[deck_id]["buttons"])[page][target_button] = temp
-
-    # Clear the cache so images will be recreated on render
-    image_cache.pop(f"{deck_id}.{page}.{source_button}", None)
-    image_cache.pop(f"{deck_id}.{page}.{target_button}", None)
+    buttons = state[deck_id].buttons[page]
+    source, target = buttons.pop(source_button, None), buttons.pop(target_button, None)
+    if target is not None:
+        buttons[source_button] = target
+    if source is not None:
+        buttons[target_button] = source
+    state[deck_id].page_changed(page)
+    _button_changed(deck_id, page, source_button)
+    _button_changed(deck_id, page, target_button)
 
     _save_state()
-    render()
+    _render_button(deck_id, page, source_button)
+    _render_button(deck_id, page, target_button)
 
 
+@_updates_state
 def set_button_text(deck_id: str, page: int, button: int, text: str) -> None:
     """Set the text associated with a button"""
-    if get_button_text(deck_id, page, button) != text:
-        _button_state(deck_id, page, button)["text"] = text
-        image_cache.pop(f"{deck_id}.{page}.{button}", None)
-        render()
+    if _set_button(deck_id, page, button, "text", text):
+        _render_button(deck_id, page, button)
+        _save_state()
+
+
+def get_button_fields(deck_id: str, page: int, button: int) -> Dict[str, Any]:
+    """Returns every setting of a button, with the default of each it leaves out"""
+    return {**BUTTON_DEFAULTS, **_button(deck_id, page, button).to_dict()}
+
+
+@_updates_state
+def set_button_fields(deck_id: str, page: int, button: int, fields: Dict[str, Any]) -> None:
+    """Sets several settings of a button, rendering and saving it once. Raises ValueError,
+    changing nothing, if the button would not be valid."""
+    if _set_button_fields(deck_id, page, button, fields):
+        _render_button(deck_id, page, button)
+        _save_state()
+
+
+def get_button_settings(deck_id: str, page: int, button: int) -> Dict[str, Any]:
+    """Returns the settings a button has in the configuration, without defaults for the others"""
+    return _button(deck_id, page, button).to_dict()
+
+
+@_updates_state
+def clear_button_fields(deck_id: str, page: int, button: int, names: Iterable[str]) -> None:
+    """Removes several settings of a button, so they read as their defaults again, rendering and
+    saving it once. A button left without settings is removed."""
+    changed = False
+    for name in names:
+        changed = _unset_button(deck_id, page, button, name) or changed
+    if changed:
+        _render_button(deck_id, page, button)
         _save_state()
 
 
 def get_button_text(deck_id: str, page: int, button: int) -> str:
     """Returns the text set for the specified button"""
-    return _button_state(deck_id, page, button).get("text", "")
+    return _button(deck_id, page, button).text
 
 
+@_updates_state
 def set_button_icon(deck_id: str, page: int, button: int, icon: str) -> None:
     """Sets the icon associated with a button"""
-    if get_button_icon(deck_id, page, button) != icon:
-        _button_state(deck_id, page, button)["icon"] = icon
-        image_cache.pop(f"{deck_id}.{page}.{button}", None)
-        render()
+    if _set_button(deck_id, page, button, "icon", icon):
+        _render_button(deck_id, page, button)
         _save_state()
 
 
 def get_button_icon(deck_id: str, page: int, button: int) -> str:
     """Returns the icon set for a particular button"""
-    return _button_state(deck_id, page, button).get("icon", "")
+    return _button(deck_id, page, button).icon
 
 
+@_updates_state
 def set_button_change_brightness(deck_id: str, page: int, button: int, amount: int) -> None:
     """Sets the brightness changing associated with a button"""
-    if get_button_change_brightness(deck_id, page, button) != amount:
-        _button_state(deck_id, page, button)["brightness_change"] = amount
-        render()
+    if _set_button(deck_id, page, button, "brightness_change", amount):
+        _render_button(deck_id, page, button)
         _save_state()
 
 
 def get_button_change_brightness(deck_id: str, page: int, button: int) -> int:
     """Returns the brightness change set for a particular button"""
-    return _button_state(deck_id, page, button).get("brightness_change", 0)
+    return _button(deck_id, page, button).brightness_change
 
 
+@_updates_state
 def set_button_command(deck_id: str, page: int, button: int, command: str) -> None:
     """Sets the command associated with the button"""
-    if get_button_command(deck_id, page, button) != command:
-        _button_state(deck_id, page, button)["command"] = command
+    if _set_button(deck_id, page, button, "command", command):
         _save_state()
 
 #ND Add
+@_updates_state
 def set_button_command_type(deck_id: str, page: int, button: int, command_type: str) -> None:
     """Sets the command associated with the button"""
-    if get_button_command_type(deck_id, page, button) != command_type:
-        _button_state(deck_id, page, button)["command_type"] = command_type
+    if _set_button(deck_id, page, button, "command_type", command_type):
         _save_state()
 
 def get_button_command(deck_id: str, page: int, button: int) -> str:
     """Returns the command set for the specified button"""
-    return _button_state(deck_id, page, button).get("command", "")
+    return _button(deck_id, page, button).command
 
 #ND Add
 def get_button_command_type(deck_id: str, page: int, button: int) -> str:
     """Returns the command set for the specified button"""
-    type = _button_state(deck_id, page, button).get("command_type", "")
+    type = _button(deck_id, page, button).command_type
     if type == '':
         type = 'Command Type'
     return type
 
 
+@_updates_state
 def set_button_switch_page(deck_id: str, page: int, button: int, switch_page: int) -> None:
     """Sets the page switch associated with the button"""
-    if get_button_switch_page(deck_id, page, button) != switch_page:
-        _button_state(deck_id, page, button)["switch_page"] = switch_page
+    if _set_button(deck_id, page, button, "switch_page", switch_page):
         _save_state()
 
 
 def get_button_switch_page(deck_id: str, page: int, button: int) -> int:
     """Returns the page switch set for the specified button. 0 implies no page switch."""
-    return _button_state(deck_id, page, button).get("switch_page", 0)
+    return _button(deck_id, page, button).switch_page
 
 
+@_updates_state
 def set_button_keys(deck_id: str, page: int, button: int, keys: str) -> None:
     """Sets the keys associated with the button"""
-    if get_button_keys(deck_id, page, button) != keys:
-        _button_state(deck_id, page, button)["keys"] = keys
+    if _set_button(deck_id, page, button, "keys", keys):
         _save_state()
 
 #ND Add
+@_updates_state
 def set_button_command_string(deck_id: str, page: int, button: int, command_string: str) -> None:
     """Sets the keys associated with the button"""
-    if get_button_command_string(deck_id, page, button) != command_string:
-        _button_state(deck_id, page, button)["command_string"] = command_string
+    if _set_button(deck_id, page, button, "command_string", command_string):
         _save_state()
 
 def get_button_keys(deck_id: str, page: int, button: int) -> str:
     """Returns the keys set for the specified button"""
-    return _button_state(deck_id, page, button).get("keys", "")
+    return _button(deck_id, page, button).keys
 
 #ND Add
 def get_button_command_string(deck_id: str, page: int, button: int) -> str:
     """Returns the command_string set for the specified button"""
-    return _button_state(deck_id, page, button).get("command_string", "")
+    return _button(deck_id, page, button).command_string
 
 
+@_updates_state
 def set_button_write(deck_id: str, page: int, button: int, write: str) -> None:
     """Sets the text meant to be written when button is pressed"""
-    if get_button_write(deck_id, page, button) != write:
-        _button_state(deck_id, page, button)["write"] = write
+    if _set_button(deck_id, page, button, "write", write):
         _save_state()
 
 
 def get_button_write(deck_id: str, page: int, button: int) -> str:
     """Returns the text to be produced when the specified button is pressed"""
-    return _button_state(deck_id, page, button).get("write", "")
+    return _button(deck_id, page, button).write
+
+
+@_updates_state
+def set_button_dynamic(
+    deck_id: str, page: int, button: int, provider: str, argument: str = "", interval: float = 0
+) -> None:
+    """Makes the button show a value from a provider of the tiles module ("clock", "cpu",
+    "memory", "file" or "command"), updated every interval seconds or the provider's default
+    interval if 0. An empty provider makes the button static again."""
+    fields = {"dynamic": provider, "dynamic_string": argument, "dynamic_interval": interval}
+    if _set_button_fields(deck_id, page, button, fields):
+        _render_button(deck_id, page, button)
+        _save_state()
+
 
+def get_button_dynamic(deck_id: str, page: int, button: int) -> str:
+    """Returns the provider of the button's dynamic value, empty if the button is static"""
+    return _button(deck_id, page, button).get("dynamic", "")
 
+
+def refresh_tile(deck_id: str, key: int) -> None:
+    """Shows the latest value of a dynamic key again, after something else was shown on it"""
+    invalidate_displayed(deck_id, key)
+    if tile_scheduler.value(deck_id, get_page(deck_id), key) is None:
+        render(deck_id=deck_id, keys=[key])
+    else:
+        tile_scheduler.refresh(deck_id, key)
+
+
+@_updates_state
 def set_brightness(deck_id: str, brightness: int) -> None:
     """Sets the brightness for every button on the deck"""
     if get_brightness(deck_id) != brightness:
-        decks[deck_id].set_brightness(brightness)
-        state.setdefault(deck_id, {})["brightness"] = brightness
+        write_brightness(deck_id, brightness)
+        _deck_for_update(deck_id).set("brightness", brightness)
+        _save_state()
+
+
+def write_brightness(deck_id: str, brightness: int) -> None:
+    """Queues a brightness level for the deck without saving it, such as a step of a fade. A
+    newer level replaces one that is still waiting to be written."""
+    _writer(deck_id, decks[deck_id]).submit_brightness(brightness)
+
+
+@_updates_state
+def clear_deck_setting(deck_id: str, name: str) -> None:
+    """Removes a setting of a deck from the configuration, without changing what the deck shows.
+    The setting reads as its default again."""
+    deck = state.get(deck_id)
+    if deck is not None and deck.unset(name):
+        _forget_if_empty(deck_id)
         _save_state()
 
 
 def get_brightness(deck_id: str) -> int:
     """Gets the brightness that is set for the specified stream deck"""
-    return state.get(deck_id, {}).get("brightness", 100)  # type: ignore
+    return _deck(deck_id).brightness
 
 
 def get_brightness_dimmed(deck_id: str) -> int:
     """Gets the percentage value of the full brightness that is used when dimming the specified
     stream deck"""
-    return state.get(deck_id, {}).get("brightness_dimmed", 0)  # type: ignore
+    return _deck(deck_id).brightness_dimmed
 
 
+@_updates_state
 def set_brightness_dimmed(deck_id: str, brightness_dimmed: int) -> None:
     """Sets the percentage value that will be used for dimming the full brightness"""
-    state.setdefault(deck_id, {})["brightness_dimmed"] = brightness_dimmed
+    _deck_for_update(deck_id).set("brightness_dimmed", brightness_dimmed)
     _save_state()
 
 
+def get_background(deck_id: str) -> str:
+    """Returns the image shown behind the keys of every page, spanning all of them"""
+    return _deck(deck_id).get("background", "")
+
+
+@_updates_state
+def set_background(deck_id: str, background: str) -> None:
+    """Sets the image shown behind the keys of every page, or removes it if empty"""
+    if _deck_for_update(deck_id).set("background", background):
+        _button_changed(None, None, None)
+        render(deck_id=deck_id)
+        prerender()
+        _save_state()
+
+
+def key_background(deck_id: str, key: int):
+    """Returns the part of the deck's background behind a key as an RGB PIL image, or None
+    if the deck has no background"""
+    return compositor.background_tile(_page_background(deck_id, decks[deck_id]), decks[deck_id], key)
+
+
+def _page_background(deck_id: str, deck: StreamDeck.StreamDeck):
+    background = get_background(deck_id)
+    if not background:
+        return None
+    try:
+        return asset_cache.background(background, compositor.page_size(deck))
+    except (OSError, IOError) as background_error:
+        print(f"Unable to load background {background} with error {background_error}")
+        return None
+
+
 def change_brightness(deck_id: str, amount: int = 1) -> None:
     """Change the brightness of the deck by the specified amount"""
     set_brightness(deck_id, max(min(get_brightness(deck_id) + amount, 100), 0))
 
 
+def get_mqtt_broker(deck_id: str) -> Dict[str, Union[str, int]]:
+    """Returns the MQTT broker settings (host, port, username, password, keepalive, qos)
+    configured for the specified stream deck. Empty if the deck uses the global broker."""
+    return _deck(deck_id).get("mqtt", _NO_SETTINGS)
+
+
 def get_page(deck_id: str) -> int:
     """Gets the current page shown on the stream deck"""
-    return state.get(deck_id, {}).get("page", 0)  # type: ignore
+    return _deck(deck_id).page
 
 
+@_updates_state
 def set_page(deck_id: str, page: int) -> None:
     """Sets the current page shown on the stream deck"""
     if get_page(deck_id) != page:
-        state.setdefault(deck_id, {})["page"] = page
-        render()
+        _deck_for_update(deck_id).set("page", page)
+        render(deck_id=deck_id)
+        prerender()
         _save_state()
 
 
-def render(decks) -> None:
-    """renders all decks"""
-    for deck_id, deck_state in state.items():
-        deck = decks.get(deck_id, None)
+def render(
+    streamdecks: Optional[Dict[str, StreamDeck.StreamDeck]] = None,
+    deck_id: Optional[str] = None,
+    keys: Optional[Iterable[int]] = None,
+) -> None:
+    """Renders the current page of every deck, or only of deck_id and only the given keys.
+    Keys already showing the right image are skipped and keys without a button on the
+    current page are cleared. Within a batch, the keys are rendered when it ends."""
+    if streamdecks is None:
+        pending = _pending_work()
+        if pending is not None:
+            for render_deck_id in state if deck_id is None else [deck_id]:
+                rendered = pending.renders.setdefault(render_deck_id, set())
+                if keys is None or rendered is None:
+                    pending.renders[render_deck_id] = None
+                else:
+                    rendered.update(keys)
+            return
+        streamdecks = decks
+
+    for render_deck_id in state if deck_id is None else [deck_id]:
+        deck = streamdecks.get(render_deck_id, None)
         if not deck:
-            warn(f"{deck_id} has settings specified but is not seen. Likely unplugged!")
+            warn(f"{render_deck_id} has settings specified but is not seen. Likely unplugged!")
             continue
 
+        _render_deck(render_deck_id, deck, keys)
+
+
+def _render_deck(deck_id: str, deck: StreamDeck.StreamDeck, keys: Optional[Iterable[int]]) -> None:
+    if keys is None:
+        _page_shown(deck_id)
+    with _render_lock(deck_id):
         page = get_page(deck_id)
-        for button_id, button_settings in (
-            deck_state.get("buttons", {}).get(page, {}).items()  # type: ignore
-        ):
-            key = f"{deck_id}.{page}.{button_id}"
-            if key in image_cache:
-                image = image_cache[key]
-            else:
-                image = _render_key_image(deck, **button_settings)
-                image_cache[key] = image
+        background = get_background(deck_id)
+        contents = _key_contents(
+            deck_id, deck, page, background, range(deck.key_count()) if keys is None else keys
+        )
+        shown = displayed.setdefault(deck_id, {})
+        writer = _writer(deck_id, deck)
+        missing = {}
+        for key, content in contents.items():
+            image_key = content[0] if content is not None else None
+            if key in shown and shown[key] == image_key:
+                continue
+
+            image = image_cache.get(image_key) if image_key is not None and content[4] else None
+            if image is None and image_key is not None:
+                missing[key] = content
+                continue
+
+            writer.submit(key, image)
+            shown[key] = image_key
+
+        if missing:
+            # NumPy is left for the prerenderer to import, keeping it off the way to the first page
+            images = _render_keys(deck_id, deck, page, background, missing, loaded_only=True)
+            for key, image in images.items():
+                writer.submit(key, image)
+                shown[key] = missing[key][0]
+
+
+def _render_lock(deck_id: str) -> threading.RLock:
+    lock = render_locks.get(deck_id)
+    if lock is None:
+        lock = render_locks.setdefault(deck_id, threading.RLock())
+    return lock
+
+
+# What a key shows: its image cache key, icon, text and font, and whether its image is kept
+# in the image cache. Images of dynamic keys are not, they would only push others out.
+KeyContent = Tuple[tuple, str, str, str, bool]
+
+
+def _key_contents(
+    deck_id: str, deck: StreamDeck.StreamDeck, page: int, background: str, keys: Iterable[int]
+) -> Dict[int, Optional[KeyContent]]:
+    """Returns what each of the given keys of a page shows, None for keys left blank. The
+    contents are copied, so they can be rendered while the buttons are being changed."""
+    buttons = _deck(deck_id).page_buttons(page)
+    contents: Dict[int, Optional[KeyContent]] = {}
+    for key in keys:
+        button = buttons.get(key) or (_NO_BUTTON if background else None)
+        if button is None:
+            contents[key] = None
+            continue
+        text = button.text
+        dynamic = bool(button.get("dynamic"))
+        if dynamic:
+            value = tile_scheduler.value(deck_id, page, key)
+            if value is not None:
+                text = tile_text(text, value)
+        image_key = _image_key(deck, button.icon, text, button.font, background, key)
+        contents[key] = (image_key, button.icon, text, button.font, not dynamic)
+    return contents
+
+
+def _render_keys(
+    deck_id: str,
+    deck: StreamDeck.StreamDeck,
+    page: int,
+    background: str,
+    missing: Dict[int, KeyContent],
+    loaded_only: bool = False,
+) -> Dict[int, bytes]:
+    """Renders and caches the images of keys that are not cached. On decks the compositor
+    supports, several keys are drawn on one page canvas and converted together."""
+    page_background = _page_background(deck_id, deck) if background else None
+    if len(missing) > 1 and PAGE_COMPOSITOR and compositor.supports(deck, loaded_only):
+        with compose_seconds.labels(deck=deck_id, page=page).time():
+            images = _compose_keys(deck, page_background, missing)
+    else:
+        images = {}
+        for key, (_image_key, icon, text, font, _cached) in missing.items():
+            with render_seconds.labels(deck=deck_id, page=page).time():
+                images[key] = _render_key_image(
+                    deck, icon, text, font, compositor.background_tile(page_background, deck, key)
+                )
+
+    for key, image in images.items():
+        if missing[key][4]:
+            image_cache.put(missing[key][0], image)
+    return images
+
+
+def _compose_keys(deck, page_background, missing: Dict[int, KeyContent]) -> Dict[int, bytes]:
+    from PIL import Image
+
+    if page_background is not None:
+        canvas = page_background.copy()
+    else:
+        canvas = Image.new("RGB", compositor.page_size(deck))
+    for key, (_image_key, icon, text, font, _cached) in missing.items():
+        # Each key is drawn within its own area, so a long label is cut off at the key's edge
+        # like it is on its own
+        box = compositor.key_box(deck, key)
+        tile = canvas.crop(box)
+        _draw_key(tile, icon, text, font)
+        canvas.paste(tile, box)
+    return compositor.to_native_keys(deck, canvas, missing)
+
+
+def _show_tiles(deck_id: str) -> None:
+    """Starts the providers of the dynamic keys on the page a deck shows, stopping others"""
+    page = get_page(deck_id)
+    specs = {}
+    for key, button in _deck(deck_id).page_buttons(page).items():
+        try:
+            spec = tile_spec(button)
+        except ValueError as error:
+            print(f"Unable to show button {key} on page {page} of {deck_id} as dynamic: {error}")
+            continue
+        if spec is not None:
+            specs[key] = spec
+    tile_scheduler.show(deck_id, page, specs)
+
+
+def _tile_changed(deck_id: str, page: int, key: int, _value: str) -> None:
+    if deck_id in decks and get_page(deck_id) == page:
+        render(deck_id=deck_id, keys=[key])
+
+
+tile_scheduler = TileScheduler(_tile_changed, TILE_BUDGET)
+
+
+def _show_animations(deck_id: str) -> None:
+    """Plays the animated icons on the page a deck shows, stopping any others of the deck"""
+    deck = decks.get(deck_id)
+    if deck is None:
+        return
+    page = get_page(deck_id)
+    background = get_background(deck_id)
+    animations = {}
+    for key, button in _deck(deck_id).page_buttons(page).items():
+        if not button.icon or button.get("dynamic"):
+            continue
+        try:
+            if not asset_cache.animated(button.icon):
+                continue
+        except (OSError, IOError):
+            continue
+        image_key = _image_key(deck, button.icon, button.text, button.font, background, key)
+        animations[key] = (
+            ("animation", *image_key),
+            partial(_load_animation, deck_id, deck, key, button.icon, button.text, button.font),
+        )
+    animation_clock.show(deck_id, page, animations)
+
+
+def _load_animation(deck_id: str, deck, key: int, icon: str, text: str, font: str) -> Animation:
+    """Renders every frame of a key with an animated icon in the deck's native format"""
+    from StreamDeck.ImageHelpers import PILHelper
+
+    background = compositor.background_tile(_page_background(deck_id, deck), deck, key)
+    icon_frames = asset_cache.frames(icon, _icon_size(deck.key_image_format()["size"], text))
+    frames = []
+    for frame in range(len(icon_frames)):
+        image = background.copy() if background is not None else PILHelper.create_image(deck)
+        _draw_key(image, icon, text, font, frame)
+        frames.append(PILHelper.to_native_format(deck, image))
+    return Animation(frames, [frame_duration(duration) for _image, duration in icon_frames])
+
+
+def _write_frame(deck_id: str, key: int, frame: bytes) -> None:
+    deck = decks.get(deck_id)
+    if deck is not None:
+        _writer(deck_id, deck).submit(key, frame)
+        invalidate_displayed(deck_id, key)
+
+
+animation_clock = AnimationClock(_write_frame, image_cache, ANIMATION_FRAME_BUDGET)
+
+
+def _page_shown(deck_id: str) -> None:
+    """Starts the dynamic keys and animations of the page a deck shows, stopping others. Call
+    this before rendering the page's keys: once it returns, no frame of an animation it
+    stopped is written, so none can cover a key rendered afterwards."""
+    pending = _pending_work()
+    if pending is not None:
+        pending.shown.add(deck_id)
+        return
+    _show_tiles(deck_id)
+    _show_animations(deck_id)
+
+
+def _collect_metrics() -> List[Tuple[str, Dict[str, str], float]]:
+    samples = [
+        (f"streamdeck_image_cache_{name}", {}, value) for name, value in image_cache.stats().items()
+    ]
+    samples += [
+        (f"streamdeck_asset_cache_{name}", {}, value) for name, value in asset_cache.stats().items()
+    ]
+    samples += [
+        (f"streamdeck_state_{name}", {}, value) for name, value in state_persister.stats().items()
+    ]
+    samples += [(f"streamdeck_tiles_{name}", {}, value) for name, value in tile_scheduler.stats().items()]
+    samples += [
+        (f"streamdeck_animation_{name}", {}, value) for name, value in animation_clock.stats().items()
+    ]
+    for deck_id, writer in writers.items():
+        samples += [
+            (f"streamdeck_writer_{name}", {"deck": deck_id}, value)
+            for name, value in writer.stats().items()
+        ]
+    return samples
+
+
+metrics.REGISTRY.register_collector(_collect_metrics)
+
+
+def _writer(deck_id: str, deck: StreamDeck.StreamDeck) -> DeckWriter:
+    writer = writers.get(deck_id)
+    if writer is None or writer.deck is not deck:
+        with writers_lock:
+            writer = writers.get(deck_id)
+            if writer is None or writer.deck is not deck:
+                if writer is not None:
+                    writer.stop()
+                writer = writers[deck_id] = DeckWriter(deck, deck_id)
+    return writer
+
+
+def set_key_image(deck_id: str, key: int, image: Optional[bytes]) -> None:
+    """Queues an image to be shown on one of a deck's keys, outside of render. Returns without
+    waiting for the write; a newer image for the same key replaces one still waiting."""
+    with _render_lock(deck_id):
+        _writer(deck_id, decks[deck_id]).submit(key, image)
+        invalidate_displayed(deck_id, key)
+
+
+def writer_stats() -> Dict[str, Dict[str, int]]:
+    """Returns the backlog and write, drop and error counts of every deck's writer"""
+    return {deck_id: writer.stats() for deck_id, writer in writers.items()}
+
+
+def _render_button(deck_id: str, page: int, button: int) -> None:
+    if get_page(deck_id) == page:
+        _page_shown(deck_id)
+        render(deck_id=deck_id, keys=[button])
+
+
+def invalidate_displayed(deck_id: str, key: Optional[int] = None) -> None:
+    """Forgets what is shown on a deck's key, or on all its keys, so the next render writes
+    it. Call this after writing to the deck without going through render."""
+    with _render_lock(deck_id):
+        if key is None:
+            displayed.pop(deck_id, None)
+        else:
+            displayed.get(deck_id, {}).pop(key, None)
+
+
+def _reachable_pages(deck_id: str, page: int) -> Set[int]:
+    """Returns the pages that buttons on the given page can switch to"""
+    pages = set()
+    for button in _deck(deck_id).page_buttons(page).values():
+        if button.command_type == "Page":
+            try:
+                pages.add(int(button.command_string) - 1)
+            except ValueError:
+                pass
+        if button.switch_page:
+            pages.add(int(button.switch_page) - 1)
+    pages.discard(page)
+    return pages
+
+
+def prerender(streamdecks: Optional[Dict[str, StreamDeck.StreamDeck]] = None) -> None:
+    """Warms the image cache in the background for the current page of every deck and every
+    page reachable from it, replacing any pre-rendering still pending"""
+    if streamdecks is None:
+        pending = _pending_work()
+        if pending is not None:
+            pending.prerender = True
+            return
+        streamdecks = decks
+
+    jobs = []
+    for deck_id in state:
+        deck = streamdecks.get(deck_id, None)
+        if not deck:
+            continue
+
+        page = get_page(deck_id)
+        background = get_background(deck_id)
+        for render_page in [page, *sorted(_reachable_pages(deck_id, page))]:
+            contents = _key_contents(deck_id, deck, render_page, background, range(deck.key_count()))
+            missing = {key: content for key, content in contents.items() if content is not None and content[4]}
+            if missing:
+                jobs.append(partial(_prerender_page, deck_id, deck, render_page, background, missing))
+
+    if jobs:
+        # The images already queued for the decks come first, so pre-rendering never holds
+        # up a page being shown and does not import NumPy before a deck's first page is up
+        deck_writers = [writers[deck_id] for deck_id in streamdecks if deck_id in writers]
+        jobs.insert(0, partial(_wait_for_writers, deck_writers))
+    prerenderer.schedule(jobs)
+
+
+def _wait_for_writers(deck_writers: List[DeckWriter]) -> None:
+    """Waits until the writers have written everything queued, for at most
+    PRERENDER_WRITE_WAIT seconds in all"""
+    deadline = time.monotonic() + PRERENDER_WRITE_WAIT
+    for writer in deck_writers:
+        writer.flush(max(0.0, deadline - time.monotonic()))
+
+
+def _prerender_page(
+    deck_id: str, deck, page: int, background: str, contents: Dict[int, KeyContent]
+) -> None:
+    missing = {key: content for key, content in contents.items() if content[0] not in image_cache}
+    if missing:
+        _render_keys(deck_id, deck, page, background, missing)
+
+
+def _image_key(deck, icon: str, text: str, font: str, background: str = "", key: int = 0) -> tuple:
+    """Returns the image cache key for a button: everything that affects how its image looks.
+    Including the icon's modification time means an edited icon file is rendered again. With
+    a background the image also depends on where the key is."""
+    try:
+        icon_mtime = os.stat(icon).st_mtime_ns if icon else 0
+    except OSError:
+        icon_mtime = 0
+    image_key = (deck.deck_type(), deck.key_image_format()["size"], icon, icon_mtime, text, font)
+    if background:
+        try:
+            background_mtime = os.stat(background).st_mtime_ns
+        except OSError:
+            background_mtime = 0
+        image_key += (background, background_mtime, key)
+    return image_key
+
+
+def _render_key_image(deck, icon: str, text: str, font: str, background=None):
+    """Renders an individual key image, on top of background if given"""
+    # PIL is imported on first render, so starting up and serving cached images does not
+    # pay for it
+    from StreamDeck.ImageHelpers import PILHelper
+
+    image = background.copy() if background is not None else PILHelper.create_image(deck)
+    _draw_key(image, icon, text, font)
+    return PILHelper.to_native_format(deck, image)
 
-            with streamdecks_lock:
-                deck.set_key_image(button_id, image)
 
+def _icon_size(key_size: Tuple[int, int], text: str) -> Tuple[int, int]:
+    """Returns the space for a button's icon on a key, which leaves room for its text"""
+    width, height = key_size
+    return (width, height - 20) if text else (width, height)
+
+
+def _draw_key(image, icon: str, text: str, font: str, frame: Optional[int] = None) -> None:
+    """Draws a button's icon, or the given frame of an animated one, and text onto a key sized
+    RGB PIL image"""
+    from PIL import ImageDraw
 
-def _render_key_image(deck, icon: str = "", text: str = "", font: str = DEFAULT_FONT, **kwargs):
-    """Renders an individual key image"""
-    image = PILHelper.create_image(deck)
     draw = ImageDraw.Draw(image)
 
     if icon:
         try:
-            rgba_icon = Image.open(icon).convert("RGBA")
+            if frame is None:
+                rgba_icon = asset_cache.icon(icon, _icon_size(image.size, text))
+            else:
+                rgba_icon = asset_cache.frames(icon, _icon_size(image.size, text))[frame][0]
         except (OSError, IOError) as icon_error:
             print(f"Unable to load icon {icon} with error {icon_error}")
-            rgba_icon = Image.new("RGBA", (300, 300))
-    else:
-        rgba_icon = Image.new("RGBA", (300, 300))
-
-    icon_width, icon_height = image.width, image.height
-    if text:
-        icon_height -= 20
-
-    rgba_icon.thumbnail((icon_width, icon_height), Image.LANCZOS)
-    icon_pos = ((image.width - rgba_icon.width) // 2, 0)
-    image.paste(rgba_icon, icon_pos, rgba_icon)
+        else:
+            icon_pos = ((image.width - rgba_icon.width) // 2, 0)
+            image.paste(rgba_icon, icon_pos, rgba_icon)
 
     if text:
-        true_font = ImageFont.truetype(os.path.join(FONTS_PATH, font), 14)
-        label_w, label_h = draw.textsize(text, font=true_font)
+        true_font = asset_cache.font(os.path.join(FONTS_PATH, font), 14)
+        left, _top, right, _bottom = draw.textbbox((0, 0), text, font=true_font)
+        label_w = right - left
         if icon:
             label_pos = ((image.width - label_w) // 2, image.height - 20)
         else:
             label_pos = ((image.width - label_w) // 2, (image.height // 2) - 7)
         draw.text(label_pos, text=text, font=true_font, fill="white")
 
-    return PILHelper.to_native_format(deck, image)
-
 
 if os.path.isfile(STATE_FILE):
     _open_config(STATE_FILE)
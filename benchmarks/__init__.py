@@ -0,0 +1 @@
+"""Hardware free benchmarks for the rendering and key handling paths"""
@@ -0,0 +1,287 @@
+"""Measures rendering, page switching, config import, state access and key press latency on simulated decks
+
+Run from the project folder, optionally comparing against an earlier run:
+
+    python -m benchmarks.bench --output results.json
+    python -m benchmarks.bench --baseline results.json
+
+The configuration file in use is never read or written: the benchmarks set
+STREAMDECK_UI_CONFIG to a temporary file before the api module is imported.
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_PATH = tempfile.mkdtemp(prefix="streamdeck-bench-")
+os.environ["STREAMDECK_UI_CONFIG"] = os.path.join(WORK_PATH, "streamdeck_ui.json")
+if PROJECT_PATH not in sys.path:
+    sys.path.insert(0, PROJECT_PATH)
+
+import api  # noqa: E402
+from benchmarks.fakedeck import MODELS, FakeStreamDeck, make_config  # noqa: E402
+
+DECK_ID = "FAKE0001"
+
+
+def summarise(samples: List[float]) -> Dict[str, float]:
+    """Returns the distribution of a benchmark's samples, in seconds"""
+    ordered = sorted(samples)
+    return {
+        "iterations": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "median": statistics.median(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "min": ordered[0],
+        "max": ordered[-1],
+    }
+
+
+def measure(iterations: int, run: Callable[[], None], setup: Optional[Callable[[], None]] = None) -> List[float]:
+    samples = []
+    for _iteration in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def load_config(config: dict) -> str:
+    path = os.path.join(WORK_PATH, "bench_config.json")
+    with open(path, "w") as config_file:
+        json.dump(config, config_file)
+    api.import_config(path)
+    api.prerenderer.wait()
+    return path
+
+
+def flush() -> None:
+    for writer in list(api.writers.values()):
+        writer.flush()
+
+
+def clear_caches() -> None:
+    api.prerenderer.cancel()
+    api.prerenderer.wait()
+    api.image_cache.clear()
+    api.asset_cache.reload()
+
+
+def bench_render(deck: FakeStreamDeck, iterations: int) -> Dict[str, List[float]]:
+    """A full page written to the deck, rendered from scratch or taken from the image cache"""
+    def render() -> None:
+        api.render(deck_id=DECK_ID)
+        flush()
+
+    def forget_displayed() -> None:
+        api.invalidate_displayed(DECK_ID)
+
+    def cold() -> None:
+        clear_caches()
+        forget_displayed()
+
+    return {
+        "render_page_cold": measure(iterations, render, cold),
+        "render_page_warm": measure(iterations, render, forget_displayed),
+        "render_page_unchanged": measure(iterations, render),
+    }
+
+
+def bench_page_switch(deck: FakeStreamDeck, iterations: int) -> Dict[str, List[float]]:
+    """Switching to the next page, with the page pre-rendered or not"""
+    def switch() -> None:
+        api.set_page(DECK_ID, (api.get_page(DECK_ID) + 1) % 2)
+        flush()
+
+    def cold() -> None:
+        clear_caches()
+
+    def warm() -> None:
+        api.prerenderer.wait()
+
+    return {
+        "page_switch_cold": measure(iterations, switch, cold),
+        "page_switch_warm": measure(iterations, switch, warm),
+    }
+
+
+def bench_import(deck: FakeStreamDeck, iterations: int, pages: int) -> Dict[str, List[float]]:
+    """Importing a large multi-page configuration, up to the first page being on the deck"""
+    path = os.path.join(WORK_PATH, "large_config.json")
+    with open(path, "w") as config_file:
+        json.dump(make_config(DECK_ID, deck.key_count(), pages), config_file)
+
+    def run() -> None:
+        api.import_config(path)
+        flush()
+
+    def cold() -> None:
+        clear_caches()
+        api.invalidate_displayed(DECK_ID)
+
+    return {f"import_config_{pages}_pages": measure(iterations, run, cold)}
+
+
+def bench_state(deck: FakeStreamDeck, iterations: int, pages: int) -> Dict[str, List[float]]:
+    """Reading every button's settings of a page, configured and unconfigured, 1000 times"""
+    load_config(make_config(DECK_ID, deck.key_count(), 2))
+    keys = range(deck.key_count())
+
+    def read(page: int) -> Callable[[], None]:
+        def run() -> None:
+            for _repeat in range(1000):
+                for key in keys:
+                    api.get_button_text(DECK_ID, page, key)
+                    api.get_button_icon(DECK_ID, page, key)
+                    api.get_button_command_type(DECK_ID, page, key)
+        return run
+
+    return {
+        "state_read_configured": measure(iterations, read(0)),
+        "state_read_unconfigured": measure(iterations, read(pages + 1)),
+    }
+
+
+def state_memory(deck: FakeStreamDeck, pages: int) -> Dict[str, int]:
+    """Bytes held by the parsed state of a large configuration"""
+    text = json.dumps(make_config(DECK_ID, deck.key_count(), pages))
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        parsed = api._parse_config(text)
+        held = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del parsed
+    return {"bytes": held, "pages": pages}
+
+
+def load_cli():
+    spec = importlib.util.spec_from_file_location(
+        "streamdeck_cli", os.path.join(PROJECT_PATH, "streamdeck-cli.py")
+    )
+    cli = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cli)  # type: ignore
+    return cli
+
+
+def bench_key_press(deck: FakeStreamDeck, iterations: int) -> Dict[str, List[float]]:
+    """Time from a key press until its action takes effect, measured with an OSC button whose
+    message is received on a local UDP socket, and the time the callback holds the deck's read
+    thread"""
+    cli = load_cli()
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(5)
+    port = receiver.getsockname()[1]
+
+    config = make_config(DECK_ID, deck.key_count(), 2)
+    config["state"][DECK_ID]["buttons"]["0"]["0"].update(
+        command_type="OSC", command_string=f"127.0.0.1:{port}/bench/press"
+    )
+    load_config(config)
+    deck.set_key_callback(cli.key_change_callback)
+    cli.prerender_key_sprites(deck, DECK_ID)
+
+    press_to_action = []
+    callback = []
+    # The CLI prints every key event, which must not end up in the JSON results on stdout
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            for _iteration in range(iterations):
+                start = time.perf_counter()
+                deck.press(0, True)
+                callback.append(time.perf_counter() - start)
+                receiver.recv(1024)
+                press_to_action.append(time.perf_counter() - start)
+                deck.press(0, False)
+                flush()
+    finally:
+        receiver.close()
+        cli.osc_sender.close()
+    return {"key_press_to_action": press_to_action, "key_callback": callback}
+
+
+def compare(results: Dict[str, dict], baseline_file: str, threshold: float) -> bool:
+    """Prints how each median changed since the baseline run. Returns False if any benchmark
+    got slower by more than threshold, as a fraction."""
+    with open(baseline_file) as baseline_json:
+        baseline = json.load(baseline_json)["results"]
+
+    passed = True
+    for name, result in results.items():
+        if name not in baseline or "median" not in result or "median" not in baseline[name]:
+            continue
+        change = result["median"] / baseline[name]["median"] - 1 if baseline[name]["median"] else 0.0
+        regressed = change > threshold
+        passed = passed and not regressed
+        print(f"{name:32} {change:+8.1%}{'  REGRESSION' if regressed else ''}", file=sys.stderr)
+    return passed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=50, help="pages in the imported configuration")
+    parser.add_argument("--model", choices=sorted(MODELS), default="Stream Deck Original")
+    parser.add_argument("--latency", type=float, default=0.0005,
+                        help="seconds each simulated USB transfer takes")
+    parser.add_argument("--output", help="file to write the JSON results to, stdout if not given")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown of a median, as a fraction, reported as a regression")
+    args = parser.parse_args()
+
+    deck = FakeStreamDeck(DECK_ID, args.model, args.latency)
+    deck.open()
+    api.decks[DECK_ID] = deck
+    load_config(make_config(DECK_ID, deck.key_count(), 2))
+
+    samples: Dict[str, List[float]] = {}
+    results: Dict[str, dict] = {}
+    samples.update(bench_render(deck, args.iterations))
+    samples.update(bench_page_switch(deck, args.iterations))
+    samples.update(bench_import(deck, max(1, args.iterations // 4), args.pages))
+    samples.update(bench_state(deck, args.iterations, args.pages))
+    results[f"state_memory_{args.pages}_pages"] = state_memory(deck, args.pages)
+    try:
+        samples.update(bench_key_press(deck, args.iterations))
+    except ImportError as error:
+        results["key_press_to_action"] = {"skipped": f"streamdeck-cli.py could not be loaded: {error}"}
+    results.update((name, summarise(values)) for name, values in samples.items())
+
+    report = {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "model": args.model,
+        "transfer_latency": args.latency,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    api.prerenderer.cancel()
+    api.state_persister.flush()
+    if args.baseline and not compare(results, args.baseline, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""Defines a simulated StreamDeck for running the application without hardware"""
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from config import CONFIG_FILE_VERSION, PROJECT_PATH
+
+# Key geometry and image format of the simulated models, as reported by the real devices
+MODELS = {
+    "Stream Deck Original": ((3, 5), {"size": (72, 72), "format": "BMP", "flip": (True, True), "rotation": 0}),
+    "Stream Deck MK.2": ((3, 5), {"size": (72, 72), "format": "JPEG", "flip": (True, True), "rotation": 0}),
+    "Stream Deck Mini": ((2, 3), {"size": (80, 80), "format": "BMP", "flip": (False, True), "rotation": 90}),
+    "Stream Deck XL": ((4, 8), {"size": (96, 96), "format": "JPEG", "flip": (True, True), "rotation": 0}),
+}
+
+ICONS = [os.path.join(PROJECT_PATH, "icons", name) for name in ("cross.png", "gear.png")]
+
+
+class FakeStreamDeck:
+    """ Implements the part of the StreamDeck device interface used by api.py and
+        streamdeck-cli.py. Key images are recorded instead of sent, each transfer
+        takes a configurable time like a USB write would, and key presses can be
+        injected to exercise the key callback. """
+
+    def __init__(self, serial_number: str = "FAKE0001", deck_type: str = "Stream Deck Original",
+                 transfer_latency: float = 0.0):
+        """ Constructs a new FakeStreamDeck instance
+
+        :param str serial_number: The serial number the deck reports.
+        :param str deck_type: One of the model names in MODELS.
+        :param float transfer_latency: Seconds each set_key_image and set_brightness call takes.
+        """
+        self.serial_number = serial_number
+        self._deck_type = deck_type
+        self._layout, self._image_format = MODELS[deck_type]
+        self.transfer_latency = transfer_latency
+        self.key_images: List[Optional[bytes]] = [None] * self.key_count()
+        self.transfers = 0
+        # The CLOCK_MONOTONIC time the last transfer finished
+        self.transferred_at = 0.0
+        self.brightness = 100
+        self.is_connected = True
+        self._open = False
+        self._callback: Optional[Callable] = None
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self._lock.release()
+
+    def open(self) -> None:
+        self._open = True
+
+    def close(self) -> None:
+        self._open = False
+
+    def is_open(self) -> bool:
+        return self._open
+
+    def connected(self) -> bool:
+        return self.is_connected
+
+    def id(self) -> str:
+        return f"fake:{self.serial_number}"
+
+    def get_serial_number(self) -> str:
+        return self.serial_number
+
+    def deck_type(self) -> str:
+        return self._deck_type
+
+    def key_layout(self) -> Tuple[int, int]:
+        return self._layout
+
+    def key_count(self) -> int:
+        return self._layout[0] * self._layout[1]
+
+    def key_image_format(self) -> dict:
+        return dict(self._image_format)
+
+    def reset(self) -> None:
+        self.key_images = [None] * self.key_count()
+
+    def set_brightness(self, percent: int) -> None:
+        self._transfer()
+        self.brightness = percent
+
+    def set_key_image(self, key: int, image: Optional[bytes]) -> None:
+        if not 0 <= key < self.key_count():
+            raise IndexError("Invalid key index {}.".format(key))
+        self._transfer()
+        self.key_images[key] = image
+
+    def set_key_callback(self, callback: Callable) -> None:
+        self._callback = callback
+
+    def press(self, key: int, state: bool = True) -> None:
+        """ Injects a key state change, calling the key callback like the read thread does."""
+        if self._callback is not None:
+            self._callback(self, key, state)
+
+    def _transfer(self) -> None:
+        self.transfers += 1
+        if self.transfer_latency:
+            time.sleep(self.transfer_latency)
+        self.transferred_at = time.monotonic()
+
+
+def make_config(deck_id: str, key_count: int, pages: int) -> dict:
+    """Returns a configuration with every key of every page labelled, most with an icon, and
+    a key on each page switching to the next page"""
+    buttons = {}
+    for page in range(pages):
+        page_buttons = {}
+        for key in range(key_count):
+            button = {"text": f"P{page} K{key}", "command_type": "", "command_string": ""}
+            if key % 3:
+                button["icon"] = ICONS[(page + key) % len(ICONS)]
+            page_buttons[str(key)] = button
+        page_buttons[str(key_count - 1)].update(
+            command_type="Page", command_string=str((page + 1) % pages + 1)
+        )
+        buttons[str(page)] = page_buttons
+    return {
+        "streamdeck_ui_version": CONFIG_FILE_VERSION,
+        "state": {deck_id: {"buttons": buttons, "brightness": 100, "page": 0}},
+    }
@@ -0,0 +1,132 @@
+"""Measures how long streamdeck-cli.py takes from a cold start until a deck shows its first page
+
+Every run is a fresh interpreter that loads streamdeck-cli.py and starts a simulated deck
+the way its main block starts a real one. A run fails if the median time is over the target
+or if Qt, pynput or NumPy was loaded before the first page was shown. Run from the project
+folder:
+
+    python -m benchmarks.startup --target 0.5
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_PATH not in sys.path:
+    sys.path.insert(0, PROJECT_PATH)
+
+from benchmarks.fakedeck import MODELS, make_config  # noqa: E402
+
+# Modules a headless start should not load before the first page is shown. The run fails
+# if it does.
+HEAVY_MODULES = ("PySide2", "pynput", "numpy")
+
+# The child notes when each heavy module starts being imported, so one imported in the
+# background after the first page is shown is told apart from one the first page waited on
+CHILD = """
+import importlib.util, json, sys, time
+heavy_imported_at = {{}}
+
+
+class HeavyImportFinder:
+    def find_spec(self, name, path=None, target=None):
+        if name in {heavy!r}:
+            heavy_imported_at.setdefault(name, time.monotonic())
+        return None
+
+
+sys.meta_path.insert(0, HeavyImportFinder())
+sys.path.insert(0, {project!r})
+spec = importlib.util.spec_from_file_location("streamdeck_cli", {cli!r})
+cli = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cli)
+imported = time.monotonic()
+from benchmarks.fakedeck import FakeStreamDeck
+deck = FakeStreamDeck("FAKE0001", {model!r}, {latency!r})
+cli.start_deck(deck)
+for writer in cli.api.writers.values():
+    writer.flush()
+shown = time.monotonic()
+print(json.dumps({{"imported": imported, "shown": shown,
+                  "modules": [name for name, started in heavy_imported_at.items()
+                              if started <= deck.transferred_at]}}))
+"""
+
+
+def run_once(config_file: str, model: str, latency: float) -> dict:
+    child = CHILD.format(
+        project=PROJECT_PATH,
+        cli=os.path.join(PROJECT_PATH, "streamdeck-cli.py"),
+        model=model,
+        latency=latency,
+        heavy=HEAVY_MODULES,
+    )
+    environment = dict(os.environ, STREAMDECK_UI_CONFIG=config_file)
+    # CLOCK_MONOTONIC is shared by every process, so the child's times compare with ours
+    start = time.monotonic()
+    output = subprocess.run(
+        [sys.executable, "-c", child], env=environment, check=True, capture_output=True, text=True
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    return {
+        "import": result["imported"] - start,
+        "first_page": result["shown"] - start,
+        "modules": result["modules"],
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--model", choices=sorted(MODELS), default="Stream Deck Original")
+    parser.add_argument("--latency", type=float, default=0.0005,
+                        help="seconds each simulated USB transfer takes")
+    parser.add_argument("--target", type=float, default=0.5,
+                        help="seconds the median time to the first page must stay under")
+    parser.add_argument("--output", help="file to write the JSON results to, stdout if not given")
+    args = parser.parse_args()
+
+    work_path = tempfile.mkdtemp(prefix="streamdeck-startup-")
+    config_file = os.path.join(work_path, "streamdeck_ui.json")
+    key_count = MODELS[args.model][0][0] * MODELS[args.model][0][1]
+    config = make_config("FAKE0001", key_count, 10)
+    # Compiling a Keystroke button must not load pynput
+    config["state"]["FAKE0001"]["buttons"]["0"]["0"].update(command_type="Keystroke", command_string="ctrl+c")
+    with open(config_file, "w") as config_json:
+        json.dump(config, config_json)
+
+    runs = [run_once(config_file, args.model, args.latency) for _run in range(args.runs)]
+    first_page = statistics.median(run["first_page"] for run in runs)
+    heavy_modules = sorted({name for run in runs for name in run["modules"]})
+    report = {
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "model": args.model,
+        "transfer_latency": args.latency,
+        "results": {
+            "startup_import": {"median": statistics.median(run["import"] for run in runs),
+                               "max": max(run["import"] for run in runs)},
+            "startup_first_page": {"median": first_page,
+                                   "max": max(run["first_page"] for run in runs)},
+        },
+        "heavy_modules_loaded": heavy_modules,
+        "target": args.target,
+        "passed": first_page <= args.target and not heavy_modules,
+    }
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+    return 0 if report["passed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+"""Defines the caches used when rendering stream deck key images"""
+import os
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, Optional, Tuple
+
+if TYPE_CHECKING:
+    from PIL import Image, ImageFont
+
+
+class ImageCache:
+    """ Least recently used cache of rendered key images, and of animations,
+        whose len() is their size in bytes. Entries are keyed on the content
+        that produced them, so identical keys on different pages or decks share
+        one image, and the cache is bounded by the total number of bytes held
+        instead of by the number of entries. """
+
+    def __init__(self, max_bytes: int):
+        """ Constructs a new ImageCache instance
+
+        :param int max_bytes: The memory budget for all cached images together.
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """ Returns the cached image for key, or None if it is not cached."""
+        with self._lock:
+            image = self._entries.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key: Hashable, image: bytes) -> None:
+        """ Adds an image to the cache, evicting the least recently used
+            images until the cache fits within its budget again."""
+        image_size = len(image)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            if image_size > self.max_bytes:
+                return
+            self._entries[key] = image
+            self.size += image_size
+            while self.size > self.max_bytes:
+                _key, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def get_or_render(self, key: Hashable, render: Callable[[], bytes]) -> bytes:
+        """ Returns the cached image for key, rendering and caching it first if needed."""
+        image = self.get(key)
+        if image is None:
+            image = render()
+            self.put(key, image)
+        return image
+
+    def pop(self, key: Hashable) -> Optional[bytes]:
+        """ Removes and returns the image cached for key, if any."""
+        with self._lock:
+            image = self._entries.pop(key, None)
+            if image is not None:
+                self.size -= len(image)
+            return image
+
+    def clear(self) -> None:
+        """ Removes every image from the cache. Counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the cache counters and current memory use."""
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class AssetCache:
+    """ Least recently used cache of the files key images are built from: fonts
+        loaded per (path, size), icons decoded to RGBA and scaled per
+        (path, size), and backgrounds scaled to fill a whole page. Entries are
+        also keyed on the file's modification time, so a changed file is read
+        again on its next use. The cached images are shared and must not be
+        modified by callers. """
+
+    def __init__(self, max_entries: int):
+        """ Constructs a new AssetCache instance
+
+        :param int max_entries: The number of fonts and icons kept loaded together.
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Tuple[str, str, int, Any], Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def font(self, path: str, size: int) -> "ImageFont.FreeTypeFont":
+        """ Returns the TrueType font at path loaded in the given size."""
+        return self._get("font", path, size, partial(_load_font, path, size))
+
+    def icon(self, path: str, size: Optional[Tuple[int, int]] = None) -> "Image.Image":
+        """ Returns the image at path converted to RGBA and, if a size is given,
+            scaled down to fit within it. Raises OSError if it can't be loaded."""
+        return self._get("icon", path, size, partial(_load_icon, path, size))
+
+    def animated(self, path: str) -> bool:
+        """ Returns whether the image at path has more than one frame, like an animated
+            GIF or PNG. Raises OSError if it can't be loaded."""
+        return self._get("animated", path, None, partial(_load_animated, path))
+
+    def frames(self, path: str, size: Tuple[int, int]) -> Tuple[Tuple["Image.Image", Optional[float]], ...]:
+        """ Returns every frame of the image at path, converted to RGBA and scaled down
+            to fit within size, with its duration in milliseconds if the file gives
+            one. Raises OSError if it can't be loaded."""
+        return self._get("frames", path, size, partial(_load_frames, path, size))
+
+    def background(self, path: str, size: Tuple[int, int]) -> "Image.Image":
+        """ Returns the image at path converted to RGB and scaled and cropped to
+            fill size exactly. Raises OSError if it can't be loaded."""
+        return self._get("background", path, size, partial(_load_background, path, size))
+
+    def reload(self, path: Optional[str] = None) -> None:
+        """ Drops the cached assets loaded from path, or every asset if no path is given."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[1] == path]:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the cache counters and current number of entries."""
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _get(self, kind: str, path: str, size: Any, load: Callable[[], Any]) -> Any:
+        key = (kind, path, os.stat(path).st_mtime_ns, size)
+        with self._lock:
+            asset = self._entries.get(key)
+            if asset is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return asset
+            self.misses += 1
+
+        asset = load()
+        with self._lock:
+            self._entries[key] = asset
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return asset
+
+
+def _load_font(path: str, size: int) -> "ImageFont.FreeTypeFont":
+    from PIL import ImageFont
+
+    return ImageFont.truetype(path, size)
+
+
+def _load_icon(path: str, size: Optional[Tuple[int, int]]) -> "Image.Image":
+    from PIL import Image
+
+    with Image.open(path) as image:
+        icon = image.convert("RGBA")
+    if size:
+        icon.thumbnail(size, Image.LANCZOS)
+    return icon
+
+
+def _load_background(path: str, size: Tuple[int, int]) -> "Image.Image":
+    from PIL import Image, ImageOps
+
+    with Image.open(path) as image:
+        return ImageOps.fit(image.convert("RGB"), size, Image.LANCZOS)
+
+
+def _load_animated(path: str) -> bool:
+    from PIL import Image
+
+    with Image.open(path) as image:
+        return bool(getattr(image, "is_animated", False))
+
+
+def _load_frames(path: str, size: Tuple[int, int]) -> Tuple[Tuple["Image.Image", Optional[float]], ...]:
+    from PIL import Image, ImageSequence
+
+    frames = []
+    with Image.open(path) as image:
+        for frame in ImageSequence.Iterator(image):
+            icon = frame.convert("RGBA")
+            icon.thumbnail(size, Image.LANCZOS)
+            frames.append((icon, frame.info.get("duration")))
+    return tuple(frames)
@@ -0,0 +1,121 @@
+"""Converts a whole page of key images to the deck's native format at once with NumPy"""
+import importlib.util
+import io
+import sys
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Tuple
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+_numpy_available: Optional[bool] = None
+
+# BMP file headers by key size, taken from what PIL writes so the output matches it exactly
+_bmp_headers: Dict[Tuple[int, int], bytes] = {}
+
+
+def available() -> bool:
+    """Returns whether NumPy is installed, which the page compositor needs"""
+    global _numpy_available
+    if _numpy_available is None:
+        _numpy_available = importlib.util.find_spec("numpy") is not None
+    return _numpy_available
+
+
+def supports(deck, loaded_only: bool = False) -> bool:
+    """ Returns whether converting the deck's keys together is worth it. Only
+        BMP keys are written straight from the page array; keys in compressed
+        formats still need one encode each, which costs more than the
+        conversion saves. With loaded_only, NumPy must already be imported:
+        importing it takes longer than rendering a page the slow way."""
+    if loaded_only and "numpy" not in sys.modules:
+        return False
+    return available() and deck.key_image_format()["format"] == "BMP"
+
+
+def page_size(deck) -> Tuple[int, int]:
+    """Returns the size of a canvas holding every key of the deck side by side"""
+    rows, columns = deck.key_layout()
+    width, height = deck.key_image_format()["size"]
+    return columns * width, rows * height
+
+
+def key_box(deck, key: int) -> Tuple[int, int, int, int]:
+    """Returns the area of a key on the page canvas, as seen from the front of the deck"""
+    _rows, columns = deck.key_layout()
+    width, height = deck.key_image_format()["size"]
+    left, top = (key % columns) * width, (key // columns) * height
+    return left, top, left + width, top + height
+
+
+def _bmp_header(size: Tuple[int, int]) -> bytes:
+    header = _bmp_headers.get(size)
+    if header is None:
+        from PIL import Image
+
+        with io.BytesIO() as bmp:
+            Image.new("RGB", size).save(bmp, "BMP")
+            data = bmp.getvalue()
+        row_bytes = (size[0] * 3 + 3) & ~3
+        header = _bmp_headers[size] = data[:len(data) - row_bytes * size[1]]
+    return header
+
+
+def to_native_keys(deck, canvas: "Image.Image", keys: Iterable[int]) -> Dict[int, bytes]:
+    """ Returns the image of each of the given keys in the deck's native format,
+        cut from an RGB page canvas of page_size(deck). The result is byte for
+        byte what PILHelper.to_native_format gives for each key on its own.
+        Rotating and flipping is done on all keys at once; BMP keys are then
+        written straight from the array, while other formats, such as the JPEG
+        of newer decks, are still encoded one key at a time."""
+    import numpy
+
+    keys = list(keys)
+    if not keys:
+        return {}
+    rows, columns = deck.key_layout()
+    image_format = deck.key_image_format()
+    width, height = image_format["size"]
+
+    page = numpy.asarray(canvas.convert("RGB"))
+    tiles = page.reshape(rows, height, columns, width, 3).swapaxes(1, 2).reshape(-1, height, width, 3)
+    tiles = tiles[keys]
+    if image_format["rotation"]:
+        tiles = numpy.rot90(tiles, image_format["rotation"] // 90, axes=(1, 2))
+    if image_format["flip"][0]:
+        tiles = tiles[:, :, ::-1]
+    if image_format["flip"][1]:
+        tiles = tiles[:, ::-1]
+
+    if image_format["format"] == "BMP":
+        # BMP stores rows bottom up, in blue, green, red order, padded to four bytes
+        tiles = tiles[:, ::-1, :, ::-1]
+        tile_height, tile_width = tiles.shape[1:3]
+        padding = (-tile_width * 3) % 4
+        tiles = tiles.reshape(len(keys), tile_height, tile_width * 3)
+        if padding:
+            tiles = numpy.pad(tiles, ((0, 0), (0, 0), (0, padding)))
+        header = _bmp_header((tile_width, tile_height))
+        data = numpy.ascontiguousarray(tiles).tobytes()
+        tile_bytes = len(data) // len(keys)
+        return {
+            key: header + data[index * tile_bytes:(index + 1) * tile_bytes]
+            for index, key in enumerate(keys)
+        }
+
+    from PIL import Image
+
+    images = {}
+    for index, key in enumerate(keys):
+        with io.BytesIO() as compressed:
+            Image.fromarray(numpy.ascontiguousarray(tiles[index])).save(
+                compressed, image_format["format"], quality=100
+            )
+            images[key] = compressed.getvalue()
+    return images
+
+
+def background_tile(background: Optional["Image.Image"], deck, key: int) -> Optional["Image.Image"]:
+    """Returns the part of a page background behind a key, or None without a background"""
+    if background is None:
+        return None
+    return background.crop(key_box(deck, key))
@@ -8,3 +8,72 @@ DEFAULT_FONT = os.path.join("roboto", "Roboto-Regular.ttf")
 STATE_FILE = os.environ.get("STREAMDECK_UI_CONFIG", f"{PROJECT_PATH}/deckConfigs/streamdeck_ui.json")
 # STATE_FILE = os.environ.get("STREAMDECK_UI_CONFIG", os.path.expanduser("~/.streamdeck_ui.json"))
 CONFIG_FILE_VERSION = 1  # Update only if backward incompatible changes are made to the config file
+# Memory budget in bytes for rendered key images shared by all decks and pages
+IMAGE_CACHE_SIZE = int(os.environ.get("STREAMDECK_UI_IMAGE_CACHE_SIZE", 16 * 1024 * 1024))
+# Number of loaded fonts and decoded icons kept in memory for rendering
+ASSET_CACHE_SIZE = int(os.environ.get("STREAMDECK_UI_ASSET_CACHE_SIZE", 256))
+# Render a full page on one canvas and convert all its keys to the deck's format at once,
+# on decks with BMP keys when NumPy is installed. Backgrounds that span keys work either way.
+PAGE_COMPOSITOR = os.environ.get("STREAMDECK_UI_PAGE_COMPOSITOR", "1") not in ("", "0")
+# The most dynamic key updates, such as a clock ticking, sent to each deck per second
+TILE_BUDGET = float(os.environ.get("STREAMDECK_UI_TILE_BUDGET", 10))
+# The most frames of animated icons sent to all decks together per second
+ANIMATION_FRAME_BUDGET = float(os.environ.get("STREAMDECK_UI_ANIMATION_FRAME_BUDGET", 60))
+# Seconds to gather configuration changes before writing them to STATE_FILE
+STATE_SAVE_DELAY = float(os.environ.get("STREAMDECK_UI_SAVE_DELAY", 0.5))
+# Write STATE_FILE without indentation, which is smaller and faster to write
+STATE_FILE_COMPACT = os.environ.get("STREAMDECK_UI_COMPACT_CONFIG", "") not in ("", "0")
+# Number of button actions that can run at once, and that may wait to run
+ACTION_WORKERS = int(os.environ.get("STREAMDECK_UI_ACTION_WORKERS", 4))
+ACTION_QUEUE_SIZE = int(os.environ.get("STREAMDECK_UI_ACTION_QUEUE_SIZE", 64))
+# Limits for the programs of Command buttons, unless a button sets its own "max_instances"
+# or "debounce": copies of a button's program that may run at once (0 for no limit, 1 for a
+# single instance) and seconds after starting it during which presses are ignored
+COMMAND_MAX_INSTANCES = int(os.environ.get("STREAMDECK_UI_COMMAND_MAX_INSTANCES", 0))
+COMMAND_DEBOUNCE = float(os.environ.get("STREAMDECK_UI_COMMAND_DEBOUNCE", 0))
+# Start Command programs with posix_spawn instead of fork and exec where possible
+COMMAND_FAST_SPAWN = os.environ.get("STREAMDECK_UI_COMMAND_FAST_SPAWN", "1") not in ("", "0")
+# How the display dims after its timeout: seconds the fade takes, the most brightness writes
+# it may use, and its easing curve ("linear", "ease_in", "ease_out" or "ease_in_out")
+DIM_FADE_DURATION = float(os.environ.get("STREAMDECK_UI_DIM_FADE_DURATION", 1.0))
+DIM_FADE_STEPS = int(os.environ.get("STREAMDECK_UI_DIM_FADE_STEPS", 20))
+DIM_FADE_EASING = os.environ.get("STREAMDECK_UI_DIM_FADE_EASING", "ease_in_out")
+# Watch for decks being plugged back in through udev events when pyudev is installed, and
+# otherwise look for them every HOTPLUG_INTERVAL seconds
+HOTPLUG_UDEV = os.environ.get("STREAMDECK_UI_HOTPLUG_UDEV", "1") not in ("", "0")
+HOTPLUG_INTERVAL = float(os.environ.get("STREAMDECK_UI_HOTPLUG_INTERVAL", 2.0))
+# Apply changes made to STATE_FILE by other programs while running, checking every
+# CONFIG_WATCH_INTERVAL seconds where inotify is not available
+CONFIG_WATCH = os.environ.get("STREAMDECK_UI_CONFIG_WATCH", "1") not in ("", "0")
+CONFIG_WATCH_INTERVAL = float(os.environ.get("STREAMDECK_UI_CONFIG_WATCH_INTERVAL", 1.0))
+# Where OSC, MIDI and MQTT button presses that are not sent directly go for another process
+# to handle: "stdout", "unix:<path>" to serve them on a Unix socket or "fifo:<path>" for a
+# named pipe. Up to EVENT_BUFFER_SIZE events wait for a slow reader, after which the
+# EVENT_OVERFLOW policy applies: "block", "drop-oldest" or "drop-newest".
+EVENT_SINK = os.environ.get("STREAMDECK_UI_EVENT_SINK", "stdout")
+EVENT_BUFFER_SIZE = int(os.environ.get("STREAMDECK_UI_EVENT_BUFFER_SIZE", 1024))
+EVENT_OVERFLOW = os.environ.get("STREAMDECK_UI_EVENT_OVERFLOW", "drop-oldest")
+# Unix socket through which other processes can read and change buttons, pages and
+# brightness while running, one JSON request per line (see control.py), none if empty
+CONTROL_SOCKET = os.environ.get("STREAMDECK_UI_CONTROL_SOCKET", "")
+# Send OSC button messages directly instead of printing them for another process
+OSC_NATIVE = os.environ.get("STREAMDECK_UI_OSC_NATIVE", "1") not in ("", "0")
+# Seconds a resolved OSC host name is reused before it is looked up again
+OSC_RESOLVE_TTL = float(os.environ.get("STREAMDECK_UI_OSC_RESOLVE_TTL", 300))
+# MQTT broker used by MQTT buttons, unless a deck configures its own "mqtt" settings.
+# Without a broker, MQTT button presses are printed for another process to publish.
+MQTT_HOST = os.environ.get("STREAMDECK_UI_MQTT_HOST", "")
+MQTT_PORT = int(os.environ.get("STREAMDECK_UI_MQTT_PORT", 1883))
+MQTT_KEEPALIVE = int(os.environ.get("STREAMDECK_UI_MQTT_KEEPALIVE", 60))
+MQTT_QOS = int(os.environ.get("STREAMDECK_UI_MQTT_QOS", 0))
+# Number of MQTT messages kept while the broker is unreachable
+MQTT_QUEUE_SIZE = int(os.environ.get("STREAMDECK_UI_MQTT_QUEUE_SIZE", 100))
+# MIDI output used by MIDI buttons: the backend ("rtmidi", or "fake" for testing, empty to
+# relay MIDI button presses instead, as happens when rtmidi isn't installed) and the output
+# port name to open
+MIDI_BACKEND = os.environ.get("STREAMDECK_UI_MIDI_BACKEND", "rtmidi")
+MIDI_PORT = os.environ.get("STREAMDECK_UI_MIDI_PORT", "")
+# File that latency and throughput metrics are periodically written to, none if empty.
+# A name ending in .json gets a JSON dump, anything else the Prometheus text format.
+METRICS_FILE = os.environ.get("STREAMDECK_UI_METRICS_FILE", "")
+METRICS_INTERVAL = float(os.environ.get("STREAMDECK_UI_METRICS_INTERVAL", 15))
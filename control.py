@@ -0,0 +1,348 @@
+"""Lets other processes read and change the running decks through a local Unix socket
+
+Each request is one JSON object on a line of its own and gets one JSON reply line, in order.
+Pages and buttons are numbered from 0, as in the configuration file. A request may carry an
+"id", which its reply repeats.
+
+    {"op": "decks"}
+    {"op": "get", "deck": "AL12H1A00001"}
+    {"op": "get", "deck": "AL12H1A00001", "page": 0, "button": 3}
+    {"op": "set", "deck": "AL12H1A00001", "fields": {"page": 1, "brightness": 60}}
+    {"op": "set", "deck": "AL12H1A00001", "page": 0, "button": 3, "fields": {"text": "21°C"}}
+    {"op": "batch", "ops": [{"op": "set", ...}, {"op": "set", ...}]}
+
+Replies are {"ok": true, "value": ...} or {"ok": false, "error": "..."}. The sets of a batch
+are checked before any is applied and apply together or not at all, and the decks are
+rendered and the configuration saved once for the whole batch.
+"""
+import json
+import os
+import select
+import socket
+import threading
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import api
+from eventchannel import listen_private
+from model import BUTTON_DEFAULTS
+from tiles import PROVIDERS
+
+# Seconds a client may take to accept a reply before it is disconnected
+CLIENT_TIMEOUT = 1.0
+
+# Longest request line accepted; a client sending a longer one is disconnected
+MAX_REQUEST_SIZE = 1024 * 1024
+
+# The button fields that can be set, with the value of each when a button leaves it out
+BUTTON_FIELD_DEFAULTS: Dict[str, Any] = {
+    **BUTTON_DEFAULTS,
+    "dynamic": "",
+    "dynamic_string": "",
+    "dynamic_interval": 0,
+}
+
+# The types each button field accepts
+BUTTON_FIELDS: Dict[str, Tuple[type, ...]] = {
+    **{name: (type(default),) for name, default in BUTTON_FIELD_DEFAULTS.items()},
+    "dynamic_interval": (int, float),
+}
+
+# A set of one deck's page and brightness, or of one button's fields: deck_id, page, button
+# and the fields, with None for the page and button of deck fields
+Change = Tuple[str, Optional[int], Optional[int], Dict[str, Any]]
+
+
+def _number(request: Dict[str, Any], name: str, minimum: int = 0, maximum: Optional[int] = None) -> int:
+    value = request.get(name)
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError(f"'{name}' must be a whole number")
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ValueError(f"'{name}' is out of range")
+    return value
+
+
+class ControlServer:
+    """ Serves requests to read and change buttons, pages and brightness on a
+        Unix stream socket, from its own thread, one request at a time. The
+        socket is only accessible to the user running the application.
+        set_page and set_brightness are called for those deck fields, so the
+        caller can keep anything of its own in step, such as its dimmers. """
+
+    def __init__(
+        self,
+        path: str,
+        set_page: Callable[[str, int], None] = api.set_page,
+        set_brightness: Callable[[str, int], None] = api.set_brightness,
+    ):
+        """ Constructs a new ControlServer instance
+
+        :param str path: Where to create the socket. A socket left there is replaced.
+        :param Callable set_page: Receives (deck_id, page) to switch a deck's page.
+        :param Callable set_brightness: Receives (deck_id, brightness) to set a deck's brightness.
+        """
+        self.path = os.path.expanduser(path)
+        self.set_page = set_page
+        self.set_brightness = set_brightness
+        self.requests = 0
+        self.changes = 0
+        self.batches = 0
+        self.errors = 0
+        self._server: Optional[socket.socket] = None
+        self._clients: Dict[socket.socket, bytearray] = {}
+        self._stopped = threading.Event()
+        self._wake_receive, self._wake_send = os.pipe()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """ Creates the socket and starts serving it. A socket that can't be created is
+            reported and nothing is served."""
+        try:
+            server = listen_private(self.path)
+        except OSError as error:
+            print(f"Unable to open the control socket {self.path} with error {error}")
+            return
+        self._server = server
+        self._thread = threading.Thread(target=self._run, name="control", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        os.write(self._wake_send, b"\0")
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the number of clients connected and the request counters."""
+        return {
+            "clients": len(self._clients),
+            "requests": self.requests,
+            "changes": self.changes,
+            "batches": self.batches,
+            "errors": self.errors,
+        }
+
+    def _run(self) -> None:
+        server = self._server
+        assert server is not None
+        try:
+            while not self._stopped.is_set():
+                readable, _writable, _errors = select.select(
+                    [server, self._wake_receive, *self._clients], [], []
+                )
+                for ready in readable:
+                    if ready is server:
+                        client, _address = server.accept()
+                        client.settimeout(CLIENT_TIMEOUT)
+                        self._clients[client] = bytearray()
+                    elif ready is not self._wake_receive:
+                        self._read(ready)
+        finally:
+            for client in self._clients:
+                client.close()
+            self._clients.clear()
+            server.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _read(self, client: socket.socket) -> None:
+        try:
+            data = client.recv(64 * 1024)
+        except OSError:
+            data = b""
+        buffer = self._clients[client]
+        buffer += data
+        replies = []
+        while True:
+            end = buffer.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(buffer[:end])
+            del buffer[:end + 1]
+            if line.strip():
+                replies.append(json.dumps(self.handle_line(line)) + "\n")
+
+        try:
+            if replies:
+                client.sendall("".join(replies).encode())
+        except OSError:
+            data = b""
+        if not data or len(buffer) > MAX_REQUEST_SIZE:
+            del self._clients[client]
+            client.close()
+
+    def handle_line(self, line: bytes) -> Dict[str, Any]:
+        """ Returns the reply to one request line."""
+        self.requests += 1
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            self.errors += 1
+            return {"ok": False, "error": f"Invalid JSON: {error}"}
+        if not isinstance(request, dict):
+            self.errors += 1
+            return {"ok": False, "error": "A request must be a JSON object"}
+
+        reply: Dict[str, Any] = {"id": request["id"]} if "id" in request else {}
+        try:
+            value = self.handle(request)
+            reply.update(ok=True, value=value)
+        except ValueError as error:
+            self.errors += 1
+            reply.update(ok=False, error=str(error))
+        except Exception as error:
+            self.errors += 1
+            print(f"Unable to handle control request {request.get('op')} with error {error}")
+            reply.update(ok=False, error=f"Internal error: {error}")
+        return reply
+
+    def handle(self, request: Dict[str, Any]) -> Any:
+        """ Carries out a request, returning the value of its reply. Raises ValueError for a
+            request that is not valid, having changed nothing."""
+        op = request.get("op")
+        if op == "decks":
+            deck_ids = sorted(api.state.keys() | api.decks.keys())
+            return {deck_id: self._deck_info(deck_id) for deck_id in deck_ids}
+        if op == "get":
+            deck_id = self._deck_id(request)
+            if "button" not in request and "page" not in request:
+                return self._deck_info(deck_id)
+            return api.get_button_fields(deck_id, _number(request, "page"), self._button(request, deck_id))
+        if op == "set":
+            self._apply([self._change(request, {})])
+            return None
+        if op == "batch":
+            operations = request.get("ops")
+            if not isinstance(operations, list):
+                raise ValueError("'ops' must be a list of set requests")
+            changes = []
+            buttons: Dict[Tuple[str, int, int], Dict[str, Any]] = {}
+            for index, operation in enumerate(operations):
+                if not isinstance(operation, dict) or operation.get("op") != "set":
+                    raise ValueError(f"Operation {index} of the batch is not a set request")
+                try:
+                    changes.append(self._change(operation, buttons))
+                except ValueError as error:
+                    raise ValueError(f"Operation {index} of the batch: {error}") from None
+            self._apply(changes)
+            self.batches += 1
+            return None
+        raise ValueError(f"Unknown op '{op}', expected decks, get, set or batch")
+
+    def _deck_info(self, deck_id: str) -> Dict[str, Any]:
+        deck = api.decks.get(deck_id)
+        info: Dict[str, Any] = {
+            "connected": deck is not None,
+            "page": api.get_page(deck_id),
+            "brightness": api.get_brightness(deck_id),
+        }
+        if deck is not None:
+            info.update(api.get_deck(deck_id), keys=deck.key_count())
+        return info
+
+    def _deck_id(self, request: Dict[str, Any]) -> str:
+        deck_id = request.get("deck")
+        if deck_id not in api.state and deck_id not in api.decks:
+            raise ValueError(f"Unknown deck '{deck_id}'")
+        return deck_id  # type: ignore
+
+    def _button(self, request: Dict[str, Any], deck_id: str) -> int:
+        deck = api.decks.get(deck_id)
+        return _number(request, "button", 0, deck.key_count() - 1 if deck is not None else None)
+
+    def _change(self, request: Dict[str, Any], buttons: Dict[Tuple[str, int, int], Dict[str, Any]]) -> Change:
+        """Returns the change a set request asks for, checking it can be made. buttons holds the
+        settings the earlier sets of the same batch leave each button they change with, and is
+        updated with this one's, so each set is checked as it will be applied."""
+        deck_id = self._deck_id(request)
+        fields = request.get("fields")
+        if not isinstance(fields, dict) or not fields:
+            raise ValueError("'fields' must be an object of the fields to set")
+
+        if "button" not in request and "page" not in request:
+            for name in fields:
+                if name not in ("page", "brightness"):
+                    raise ValueError(f"Unknown deck field '{name}', expected page or brightness")
+            if "page" in fields:
+                _number(fields, "page")
+            if "brightness" in fields:
+                _number(fields, "brightness", 0, 100)
+                if deck_id not in api.decks:
+                    raise ValueError(f"Deck '{deck_id}' is not connected")
+            return deck_id, None, None, fields
+
+        page, button = _number(request, "page"), self._button(request, deck_id)
+        for name, value in fields.items():
+            types = BUTTON_FIELDS.get(name)
+            if types is None:
+                raise ValueError(f"Unknown button field '{name}'")
+            if not isinstance(value, types) or isinstance(value, bool):
+                type_names = " or ".join(t.__name__ for t in types)
+                raise ValueError(f"Button field '{name}' must be a {type_names}")
+        if fields.get("dynamic") and fields["dynamic"] not in PROVIDERS:
+            raise ValueError(f"Unknown dynamic provider '{fields['dynamic']}'")
+        settings = buttons.get((deck_id, page, button)) or api.get_button_settings(deck_id, page, button)
+        settings = {**settings, **fields}
+        api.validate_button(deck_id, page, button, settings)
+        buttons[(deck_id, page, button)] = settings
+        return deck_id, page, button, fields
+
+    def _apply(self, changes: List[Change]) -> None:
+        """Makes the changes within one batch, undoing those made if one of them fails"""
+        undo: List[Callable[[], None]] = []
+        with api.batch():
+            try:
+                for change in changes:
+                    self._set(change, undo)
+            except Exception:
+                for step in reversed(undo):
+                    try:
+                        step()
+                    except Exception as error:
+                        print(f"Unable to undo a control change with error {error}")
+                raise
+        self.changes += len(changes)
+
+    def _set(self, change: Change, undo: List[Callable[[], None]]) -> None:
+        """Makes a change, adding what undoes each part of it to undo before making that part.
+        Undoing removes the settings that were not in the configuration before, rather than
+        writing their defaults to it."""
+        deck_id, page, button, fields = change
+        if page is None or button is None:
+            deck = api.state.get(deck_id)
+            if "page" in fields:
+                undo.append(partial(
+                    self._restore_deck, self.set_page, deck_id, "page", api.get_page(deck_id),
+                    deck is not None and "page" in deck,
+                ))
+                self.set_page(deck_id, fields["page"])
+            if "brightness" in fields:
+                undo.append(partial(
+                    self._restore_deck, self.set_brightness, deck_id, "brightness",
+                    api.get_brightness(deck_id), deck is not None and "brightness" in deck,
+                ))
+                self.set_brightness(deck_id, fields["brightness"])
+            return
+
+        settings = api.get_button_settings(deck_id, page, button)
+        # Undone in reverse, so settings that were absent are removed before the others are
+        # restored, and the button is never checked with a mix of old and new settings
+        undo.append(partial(
+            api.set_button_fields, deck_id, page, button,
+            {name: settings[name] for name in fields if name in settings},
+        ))
+        undo.append(partial(
+            api.clear_button_fields, deck_id, page, button,
+            [name for name in fields if name not in settings],
+        ))
+        api.set_button_fields(deck_id, page, button, fields)
+
+    @staticmethod
+    def _restore_deck(
+        setter: Callable[[str, int], None], deck_id: str, name: str, value: int, was_set: bool
+    ) -> None:
+        setter(deck_id, value)
+        if not was_set:
+            api.clear_deck_setting(deck_id, name)
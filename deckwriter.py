@@ -0,0 +1,132 @@
+"""Defines the per deck output worker that owns all key image writes to a device"""
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from StreamDeck.Devices import StreamDeck
+
+import metrics
+
+write_seconds = metrics.REGISTRY.histogram(
+    "streamdeck_key_write_seconds", "Duration of set_key_image USB transfers"
+)
+write_wait_seconds = metrics.REGISTRY.histogram(
+    "streamdeck_key_write_wait_seconds", "Time a key image waited for its deck's writer"
+)
+
+
+class DeckWriter:
+    """ Writes key images to one deck from a dedicated thread. Each key has a
+        single pending slot: submitting an image for a key that still has one
+        waiting replaces it, so a burst of updates never queues stale frames
+        and only the newest image of each key is transferred. Brightness has a
+        slot of its own that works the same way and is written before any
+        waiting key image. """
+
+    def __init__(self, deck: StreamDeck.StreamDeck, name: str):
+        """ Constructs a new DeckWriter instance and starts its thread
+
+        :param StreamDeck deck: The deck this writer owns the output of.
+        :param str name: Used to name the writer thread.
+        """
+        self.deck = deck
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._pending: Dict[int, Tuple[Optional[bytes], float]] = {}
+        self._brightness: Optional[int] = None
+        self._write_seconds = write_seconds.labels(deck=name)
+        self._write_wait_seconds = write_wait_seconds.labels(deck=name)
+        self._writing = False
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=f"writer-{name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, key: int, image: Optional[bytes]) -> None:
+        """ Queues an image for a key without waiting for it to be written.
+            None clears the key."""
+        with self._condition:
+            if key in self._pending:
+                self.dropped += 1
+            self._pending[key] = (image, time.perf_counter())
+            self.submitted += 1
+            self._condition.notify()
+
+    def submit_brightness(self, percent: int) -> None:
+        """ Queues a brightness change without waiting for it to be written."""
+        with self._condition:
+            if self._brightness is not None:
+                self.dropped += 1
+            self._brightness = percent
+            self.submitted += 1
+            self._condition.notify()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """ Waits until every submitted image has been written. Returns False on timeout."""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._pending and self._brightness is None and not self._writing,
+                timeout,
+            )
+
+    def stop(self) -> None:
+        """ Stops the writer thread once the images already submitted are written."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def backlog(self) -> int:
+        """ Returns the number of keys waiting to be written."""
+        return len(self._pending) + (self._brightness is not None)
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the writer counters and current backlog."""
+        return {
+            "backlog": len(self._pending) + (self._brightness is not None),
+            "submitted": self.submitted,
+            "written": self.written,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+                while not self._pending and self._brightness is None and not self._stopped:
+                    self._condition.wait()
+                brightness, self._brightness = self._brightness, None
+                if brightness is None:
+                    if not self._pending:
+                        return
+                    key = next(iter(self._pending))
+                    image, submitted_at = self._pending.pop(key)
+                self._writing = True
+
+            if brightness is not None:
+                self._write_brightness(brightness)
+                continue
+
+            start = time.perf_counter()
+            self._write_wait_seconds.observe(start - submitted_at)
+            try:
+                with self.deck:
+                    self.deck.set_key_image(key, image)
+                self._write_seconds.observe(time.perf_counter() - start)
+                self.written += 1
+            except Exception as error:
+                self.errors += 1
+                print(f"Unable to update key {key} with error {error}")
+
+    def _write_brightness(self, percent: int) -> None:
+        try:
+            with self.deck:
+                self.deck.set_brightness(percent)
+            self.written += 1
+        except Exception as error:
+            self.errors += 1
+            print(f"Unable to set brightness to {percent} with error {error}")
@@ -0,0 +1,257 @@
+"""Delivers events for other processes, such as external button commands, without blocking"""
+import errno
+import json
+import os
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+# What emit does when the buffer is full: wait for room, discard the oldest buffered event,
+# or discard the new event
+OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+# Seconds a Unix socket client may take to accept an event before it is disconnected
+CLIENT_TIMEOUT = 1.0
+
+
+def listen_private(path: str) -> socket.socket:
+    """Returns a Unix stream socket listening at path that only the current user can connect
+    to, replacing a socket left there. It is bound in a new directory only the user can enter
+    and moved to path once restricted, so it is never reachable with looser permissions."""
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+    directory = tempfile.mkdtemp(prefix=".streamdeck-", dir=os.path.dirname(os.path.abspath(path)))
+    private_path = os.path.join(directory, "socket")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(private_path)
+        os.chmod(private_path, 0o600)
+        server.listen()
+        os.rename(private_path, path)
+    except OSError:
+        server.close()
+        raise
+    finally:
+        try:
+            os.unlink(private_path)
+        except OSError:
+            pass
+        os.rmdir(directory)
+    return server
+
+
+class StdoutSink:
+    """ Writes events to standard output, one JSON object per line."""
+
+    def write(self, data: bytes) -> None:
+        sys.stdout.buffer.write(data)
+        sys.stdout.flush()
+
+    def close(self) -> None:
+        sys.stdout.flush()
+
+
+class UnixSocketSink:
+    """ Listens on a Unix stream socket and sends every event to each client
+        connected at the time. Only the user running the application can
+        connect, as events include every key press. Events are discarded while
+        no client is connected, and a client that stops reading is
+        disconnected. """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._server = listen_private(path)
+        self._server.setblocking(False)
+        self._clients: List[socket.socket] = []
+
+    def write(self, data: bytes) -> None:
+        while True:
+            try:
+                client, _address = self._server.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            client.settimeout(CLIENT_TIMEOUT)
+            self._clients.append(client)
+
+        for client in list(self._clients):
+            try:
+                client.sendall(data)
+            except OSError:
+                self._clients.remove(client)
+                client.close()
+
+    def close(self) -> None:
+        for client in self._clients:
+            client.close()
+        self._server.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class FifoSink:
+    """ Writes events to a named pipe, creating it if needed. Events are
+        discarded while no process has the pipe open for reading, and the pipe
+        is opened again once its reader went away. """
+
+    def __init__(self, path: str):
+        self.path = path
+        if not os.path.exists(path):
+            os.mkfifo(path)
+        self._fd: Optional[int] = None
+
+    def write(self, data: bytes) -> None:
+        if self._fd is None:
+            try:
+                # Opening without O_NONBLOCK would wait for a reader
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+            except OSError as error:
+                if error.errno == errno.ENXIO:
+                    return
+                raise
+            os.set_blocking(self._fd, True)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._fd, view):]
+        except BrokenPipeError:
+            self.close()
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def open_sink(spec: str):
+    """Returns the sink described by spec: "stdout", "unix:<path>" or "fifo:<path>". Raises
+    ValueError for any other kind of sink."""
+    kind, _separator, path = spec.partition(":")
+    if kind == "stdout":
+        return StdoutSink()
+    if kind == "unix" and path:
+        return UnixSocketSink(os.path.expanduser(path))
+    if kind == "fifo" and path:
+        return FifoSink(os.path.expanduser(path))
+    raise ValueError(f"Unknown event sink '{spec}', expected stdout, unix:<path> or fifo:<path>")
+
+
+class EventChannel:
+    """ Buffers events in a ring of at most size entries and writes them to a
+        sink from its own thread, so emitting never waits on the process that
+        reads them unless the overflow policy is "block". Each event gets a
+        sequence number, "seq", and the CLOCK_MONOTONIC time it was emitted,
+        "time", which readers can compare with their own time.monotonic() to
+        tell how far behind they are; gaps in "seq" are events that were
+        dropped. The sink is opened on the writer thread, so an unusable sink
+        is reported there and its events are counted as errors. """
+
+    def __init__(self, sink: str, size: int, overflow: str):
+        """ Constructs a new EventChannel instance
+
+        :param str sink: Where events go, as accepted by open_sink.
+        :param int size: The most events buffered while the sink is behind.
+        :param str overflow: One of OVERFLOW_POLICIES, what to do with the buffer full.
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}', expected one of {OVERFLOW_POLICIES}")
+        self.sink_spec = sink
+        self.size = max(1, size)
+        self.overflow = overflow
+        self.emitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._sequence = 0
+        self._events: Deque[Dict[str, Any]] = deque()
+        self._closing = False
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """ Starts the writer thread, opening the sink. emit starts it when needed."""
+        with self._condition:
+            self._ensure_thread()
+
+    def emit(self, event: Dict[str, Any]) -> bool:
+        """ Queues an event, adding its sequence number and time. Returns False if it was
+            dropped because the buffer was full and the policy is "drop-newest"."""
+        with self._condition:
+            self._ensure_thread()
+            while len(self._events) >= self.size:
+                if self.overflow == "drop-newest":
+                    self.dropped += 1
+                    self._sequence += 1
+                    return False
+                if self.overflow == "drop-oldest":
+                    self._events.popleft()
+                    self.dropped += 1
+                    break
+                self._condition.wait()
+
+            self._sequence += 1
+            self._events.append({**event, "seq": self._sequence, "time": time.monotonic()})
+            self.emitted += 1
+            self._condition.notify_all()
+            return True
+
+    def close(self, timeout: float = 2.0) -> None:
+        """ Writes the events still buffered, waiting up to timeout seconds, and closes the sink."""
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the number of events buffered and the event counters."""
+        return {
+            "buffered": len(self._events),
+            "emitted": self.emitted,
+            "written": self.written,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="events", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        try:
+            sink = open_sink(self.sink_spec)
+        except (OSError, ValueError) as error:
+            print(f"Unable to open the event sink {self.sink_spec} with error {error}")
+            sink = None
+
+        while True:
+            with self._condition:
+                while not self._events and not self._closing:
+                    self._condition.wait()
+                if not self._events:
+                    break
+                # Everything waiting goes out in one write
+                events = list(self._events)
+                self._events.clear()
+                self._condition.notify_all()
+
+            if sink is None:
+                self.errors += len(events)
+                continue
+            data = "".join(json.dumps(event) + "\n" for event in events).encode()
+            try:
+                sink.write(data)
+                self.written += len(events)
+            except OSError as error:
+                self.errors += len(events)
+                print(f"Unable to write {len(events)} events to {self.sink_spec} with error {error}")
+
+        if sink is not None:
+            sink.close()
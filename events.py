@@ -0,0 +1,113 @@
+"""Signals and timers that work without a Qt event loop, for running headless"""
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+
+class Signal:
+    """ A list of callbacks called with the emitted arguments, in the order they were
+        connected. Unlike a Qt signal, slots run on the thread that emits. """
+
+    def __init__(self):
+        self._slots: List[Callable] = []
+
+    def connect(self, slot: Callable) -> None:
+        self._slots.append(slot)
+
+    def disconnect(self, slot: Callable) -> None:
+        self._slots.remove(slot)
+
+    def emit(self, *args) -> None:
+        for slot in list(self._slots):
+            try:
+                slot(*args)
+            except Exception as error:
+                print(f"Signal handler {slot} failed with error {error}")
+
+
+class _Scheduler:
+    """ Runs every timer's timeouts on one shared thread, started on first use."""
+
+    def __init__(self):
+        self._timers: List[Tuple[float, int, "Timer", int]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, due: float, timer: "Timer", generation: int) -> None:
+        with self._condition:
+            heapq.heappush(self._timers, (due, next(self._sequence), timer, generation))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="timers", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._timers or self._timers[0][0] > time.monotonic():
+                    self._condition.wait(
+                        self._timers[0][0] - time.monotonic() if self._timers else None
+                    )
+                _due, _sequence, timer, generation = heapq.heappop(self._timers)
+            timer._fire(generation)
+
+
+scheduler = _Scheduler()
+
+
+class Timer:
+    """ Calls the slots connected to timeout once the interval has passed, repeatedly unless
+        it is single shot. The methods mirror QTimer's so either can be used by the same
+        code. Timeouts are called on the shared timer thread, stopping or restarting a
+        timer drops the timeout still pending. """
+
+    def __init__(self):
+        self.timeout = Signal()
+        self._single_shot = False
+        self._interval = 0.0
+        self._generation = 0
+        self._active = False
+        self._lock = threading.Lock()
+
+    def setSingleShot(self, single_shot: bool) -> None:
+        self._single_shot = single_shot
+
+    def isActive(self) -> bool:
+        return self._active
+
+    def start(self, msec: Optional[float] = None) -> None:
+        """ (Re)starts the timer, with a new interval in milliseconds if given."""
+        with self._lock:
+            if msec is not None:
+                self._interval = msec / 1000
+            self._generation += 1
+            self._active = True
+            generation = self._generation
+        scheduler.add(time.monotonic() + self._interval, self, generation)
+
+    def stop(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._active = False
+
+    def _fire(self, generation: int) -> None:
+        with self._lock:
+            if generation != self._generation:
+                return
+            if self._single_shot:
+                self._active = False
+            else:
+                scheduler.add(time.monotonic() + self._interval, self, generation)
+        self.timeout.emit()
+
+    @staticmethod
+    def singleShot(msec: float, slot: Callable[[], None]) -> "Timer":
+        """ Calls slot once after msec milliseconds, returning the timer to stop it early."""
+        timer = Timer()
+        timer.setSingleShot(True)
+        timer.timeout.connect(slot)
+        timer.start(msec)
+        return timer
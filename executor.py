@@ -0,0 +1,146 @@
+"""Runs button actions on worker threads so key callbacks return immediately"""
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Generator, Hashable, List, Optional, Tuple
+
+# An action is a generator. Each value it yields is a delay in seconds to wait
+# before the rest of the action runs; the wait happens on a timer, not a thread.
+Action = Generator[Optional[float], None, None]
+
+
+class _Task:
+    __slots__ = ("button", "action", "submitted_at", "started_at")
+
+    def __init__(self, button: Hashable, action: Action):
+        self.button = button
+        self.action = action
+        self.submitted_at = time.perf_counter()
+        self.started_at: Optional[float] = None
+
+
+class ActionExecutor:
+    """ Runs actions on a small pool of worker threads. Actions submitted for the
+        same button run one after another in the order they were submitted, while
+        actions of different buttons run concurrently. The number of actions
+        waiting is bounded; once full, new submissions are dropped. """
+
+    def __init__(self, workers: int, max_pending: int):
+        """ Constructs a new ActionExecutor instance and starts its workers
+
+        :param int workers: The number of actions that can run at the same time.
+        :param int max_pending: The number of submitted actions that may wait to run.
+        """
+        self.max_pending = max_pending
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_start_latency = 0.0
+        self.total_start_latency = 0.0
+        self.max_run_time = 0.0
+        self.total_run_time = 0.0
+        self._pending = 0
+        self._queues: Dict[Hashable, Deque[_Task]] = {}
+        self._ready: Deque[_Task] = deque()
+        self._timers: List[Tuple[float, int, _Task]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._workers = [
+            threading.Thread(target=self._run, name=f"action-{index}", daemon=True)
+            for index in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, button: Hashable, action: Action) -> bool:
+        """ Queues an action behind any others of the same button. Returns False if
+            the action was dropped because too many actions are waiting."""
+        with self._condition:
+            if self._pending >= self.max_pending:
+                self.dropped += 1
+                action.close()
+                return False
+
+            self._pending += 1
+            self.submitted += 1
+            task = _Task(button, action)
+            queue = self._queues.get(button)
+            if queue is None:
+                # Nothing running for this button, the action can start right away
+                self._queues[button] = deque()
+                self._ready.append(task)
+                self._condition.notify()
+            else:
+                queue.append(task)
+            return True
+
+    def depth(self) -> int:
+        """ Returns the number of actions that are waiting or running."""
+        return self._pending
+
+    def stats(self) -> Dict[str, float]:
+        """ Returns the executor counters and action latencies in seconds. Start latency
+            is the time from submission until an action starts running."""
+        return {
+            "depth": self._pending,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "max_start_latency": self.max_start_latency,
+            "mean_start_latency": self.total_start_latency / self.completed if self.completed else 0.0,
+            "max_run_time": self.max_run_time,
+            "mean_run_time": self.total_run_time / self.completed if self.completed else 0.0,
+        }
+
+    def _next(self) -> _Task:
+        with self._condition:
+            while True:
+                now = time.perf_counter()
+                while self._timers and self._timers[0][0] <= now:
+                    self._ready.append(heapq.heappop(self._timers)[2])
+                if self._ready:
+                    return self._ready.popleft()
+                self._condition.wait(self._timers[0][0] - now if self._timers else None)
+
+    def _run(self) -> None:
+        while True:
+            task = self._next()
+            if task.started_at is None:
+                task.started_at = time.perf_counter()
+                start_latency = task.started_at - task.submitted_at
+                self.max_start_latency = max(self.max_start_latency, start_latency)
+                self.total_start_latency += start_latency
+
+            try:
+                delay = next(task.action)
+            except StopIteration:
+                pass
+            except Exception as error:
+                self.errors += 1
+                print(f"Action failed with error {error}")
+            else:
+                # Continue after the delay on whichever worker is free at that point
+                with self._condition:
+                    due = time.perf_counter() + (delay or 0)
+                    heapq.heappush(self._timers, (due, next(self._sequence), task))
+                    self._condition.notify()
+                continue
+
+            self._finish(task, time.perf_counter() - task.started_at)
+
+    def _finish(self, task: _Task, run_time: float) -> None:
+        with self._condition:
+            self._pending -= 1
+            self.completed += 1
+            self.max_run_time = max(self.max_run_time, run_time)
+            self.total_run_time += run_time
+            queue = self._queues[task.button]
+            if queue:
+                self._ready.append(queue.popleft())
+                self._condition.notify()
+            else:
+                del self._queues[task.button]
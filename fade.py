@@ -0,0 +1,149 @@
+"""Fades deck brightness smoothly from one shared scheduler thread"""
+import threading
+import time
+from typing import Callable, Dict, Hashable, Optional
+
+
+def linear(progress: float) -> float:
+    return progress
+
+
+def ease_in(progress: float) -> float:
+    return progress * progress
+
+
+def ease_out(progress: float) -> float:
+    return 1 - (1 - progress) * (1 - progress)
+
+
+def ease_in_out(progress: float) -> float:
+    return progress * progress * (3 - 2 * progress)
+
+
+EASINGS: Dict[str, Callable[[float], float]] = {
+    "linear": linear,
+    "ease_in": ease_in,
+    "ease_out": ease_out,
+    "ease_in_out": ease_in_out,
+}
+
+
+class _Fade:
+    __slots__ = ("start", "end", "duration", "steps", "step", "easing", "write", "done",
+                 "started_at", "due", "level")
+
+    def __init__(self, start: int, end: int, duration: float, steps: int,
+                 easing: Callable[[float], float], write: Callable[[int], None],
+                 done: Optional[Callable[[], None]]):
+        self.start = start
+        self.end = end
+        self.duration = duration
+        self.steps = steps
+        self.step = 0
+        self.easing = easing
+        self.write = write
+        self.done = done
+        self.started_at = time.monotonic()
+        self.due = self.started_at + duration / steps
+        self.level = start
+
+
+class FadeEngine:
+    """ Runs every fade on one thread. A fade takes at most max_steps brightness
+        writes whatever its length, spread over its duration along an easing
+        curve, and a step that would repeat the previous level is skipped. Each
+        target, usually a deck, has at most one fade: starting another one or
+        cancelling stops it at once. write is called with the engine's lock held,
+        so it must only queue the value, like DeckWriter.submit_brightness does,
+        and no write of a fade happens after it was cancelled. """
+
+    def __init__(self, max_steps: int):
+        """ Constructs a new FadeEngine instance
+
+        :param int max_steps: The most brightness writes a single fade may take.
+        """
+        self.max_steps = max(1, max_steps)
+        self.started = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.writes = 0
+        self._fades: Dict[Hashable, _Fade] = {}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def fade(self, target: Hashable, start: int, end: int, duration: float,
+             write: Callable[[int], None], easing: str = "linear",
+             done: Optional[Callable[[], None]] = None) -> None:
+        """ Fades target from the start to the end level over duration seconds, calling write
+            with each new level and done, if given, once the end level was written."""
+        steps = min(self.max_steps, abs(end - start)) if duration > 0 else 1
+        with self._condition:
+            if self._fades.pop(target, None) is not None:
+                self.cancelled += 1
+            self._fades[target] = _Fade(
+                start, end, duration, max(1, steps), EASINGS[easing], write, done
+            )
+            self.started += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="fade", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def cancel(self, target: Hashable) -> Optional[int]:
+        """ Stops the fade of target, returning the last level it wrote or None if it was
+            not fading. No further writes happen for it once this returns."""
+        with self._condition:
+            fade = self._fades.pop(target, None)
+            if fade is None:
+                return None
+            self.cancelled += 1
+            return fade.level
+
+    def active(self, target: Hashable) -> bool:
+        return target in self._fades
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the fade counters and the number of fades running."""
+        return {
+            "active": len(self._fades),
+            "started": self.started,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "writes": self.writes,
+        }
+
+    def _run(self) -> None:
+        while True:
+            finished = []
+            with self._condition:
+                now = time.monotonic()
+                for target, fade in list(self._fades.items()):
+                    if fade.due <= now:
+                        self._advance(fade)
+                        if fade.step >= fade.steps:
+                            del self._fades[target]
+                            self.completed += 1
+                            finished.append(fade)
+                if not finished:
+                    timeout = min((fade.due for fade in self._fades.values()), default=None)
+                    self._condition.wait(None if timeout is None else max(0.0, timeout - now))
+
+            for fade in finished:
+                if fade.done is not None:
+                    try:
+                        fade.done()
+                    except Exception as error:
+                        print(f"Fade completion failed with error {error}")
+
+    def _advance(self, fade: _Fade) -> None:
+        fade.step += 1
+        progress = fade.step / fade.steps
+        level = round(fade.start + (fade.end - fade.start) * fade.easing(progress))
+        if level != fade.level:
+            fade.level = level
+            try:
+                fade.write(level)
+                self.writes += 1
+            except Exception as error:
+                print(f"Unable to set brightness to {level} with error {error}")
+        fade.due = fade.started_at + fade.duration * (fade.step + 1) / fade.steps
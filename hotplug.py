@@ -0,0 +1,91 @@
+"""Notices stream decks being plugged in and removed, so lost decks are reconnected"""
+import threading
+from typing import Callable, Dict, Optional
+
+# USB vendor id of Elgato, as udev reports it
+ELGATO_VENDOR_ID = "0fd9"
+
+# Seconds to wait for further udev events of the same plug before scanning
+SETTLE_TIME = 0.25
+
+
+def _is_stream_deck(device) -> bool:
+    properties = device.properties
+    # Remove events carry PRODUCT ("vendor/product/version" in unpadded hex) but no ID_VENDOR_ID
+    return (
+        properties.get("ID_VENDOR_ID") == ELGATO_VENDOR_ID
+        or properties.get("PRODUCT", "").startswith(ELGATO_VENDOR_ID.lstrip("0") + "/")
+    )
+
+
+class HotplugMonitor:
+    """ Calls scan whenever a deck may have been plugged in or removed. With pyudev
+        installed, scan only runs after a udev event from an Elgato USB device;
+        otherwise, or when udev can't be used, it runs every interval seconds. The
+        scan itself, such as api.ensure_decks_connected, decides what changed. """
+
+    def __init__(self, scan: Callable[[], object], interval: float, udev: bool = True):
+        """ Constructs a new HotplugMonitor instance
+
+        :param Callable scan: Looks for lost decks and reconnects them.
+        :param float interval: Seconds between scans when polling.
+        :param bool udev: Whether to wait for udev events when pyudev is available.
+        """
+        self.scan = scan
+        self.interval = interval
+        self.udev = udev
+        self.mode = ""
+        self.events = 0
+        self.scans = 0
+        self.errors = 0
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="hotplug", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the number of udev events seen and scans run."""
+        return {"udev": int(self.mode == "udev"), "events": self.events, "scans": self.scans,
+                "errors": self.errors}
+
+    def _udev_monitor(self):
+        try:
+            import pyudev
+
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by(subsystem="usb")
+            monitor.start()
+            return monitor
+        except Exception as error:
+            print(f"Polling for stream decks every {self.interval}s, udev is not available: {error}")
+            return None
+
+    def _run(self) -> None:
+        monitor = self._udev_monitor() if self.udev else None
+        self.mode = "udev" if monitor is not None else "poll"
+        while not self._stopped.is_set():
+            if monitor is not None:
+                # The timeout only serves to notice stop() being called
+                device = monitor.poll(timeout=1)
+                if device is None or not _is_stream_deck(device):
+                    continue
+                self.events += 1
+                # One plug produces several events; gather them into a single scan
+                while monitor.poll(timeout=SETTLE_TIME) is not None:
+                    self.events += 1
+            elif self._stopped.wait(self.interval):
+                return
+
+            self.scans += 1
+            try:
+                self.scan()
+            except Exception as error:
+                self.errors += 1
+                print(f"Unable to reconnect stream decks with error {error}")
@@ -0,0 +1,183 @@
+"""Starts the programs of Command buttons, limiting how many run and reaping them when they exit"""
+import os
+import select
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from typing import Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+import metrics
+
+command_seconds = metrics.REGISTRY.histogram(
+    "streamdeck_command_seconds", "How long programs started by Command buttons ran",
+    buckets=(0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0),
+)
+command_exits = metrics.REGISTRY.counter(
+    "streamdeck_command_exits_total", "Programs started by Command buttons that exited, by status"
+)
+
+# Seconds between checks for exited programs when pidfds are not available
+POLL_INTERVAL = 0.5
+
+
+class LaunchSpec(NamedTuple):
+    """A Command button's program and how often it may run: max_instances copies at once,
+    0 for no limit, and no new copy within debounce seconds of the last one"""
+    argv: Tuple[str, ...]
+    max_instances: int = 0
+    debounce: float = 0.0
+
+
+class _Child:
+    __slots__ = ("process", "button", "command", "started_at", "pidfd")
+
+    def __init__(self, process: subprocess.Popen, button: Hashable, command: str):
+        self.process = process
+        self.button = button
+        self.command = command
+        self.started_at = time.monotonic()
+        self.pidfd: Optional[int] = None
+
+
+class Launcher:
+    """ Starts programs for buttons and waits for them on a single reaper thread,
+        so exited programs never linger as zombies. Each button's LaunchSpec
+        limits how many copies of its program run at once and how soon a
+        program may be started again; a press over the limit is ignored.
+        On Linux the reaper sleeps on pidfds, elsewhere it polls. """
+
+    def __init__(self, fast_spawn: bool = True):
+        """ Constructs a new Launcher instance
+
+        :param bool fast_spawn: Start programs with posix_spawn where the platform allows it,
+                                instead of fork and exec. Programs then inherit the file
+                                descriptors marked inheritable, which Python's are not.
+        """
+        self.fast_spawn = fast_spawn
+        self.launched = 0
+        self.refused = 0
+        self.failed = 0
+        self.exited = 0
+        self._children: Dict[int, _Child] = {}
+        self._last_launch: Dict[Hashable, float] = {}
+        self._executables: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._use_pidfd = hasattr(os, "pidfd_open")
+        self._wake_receive, self._wake_send = socket.socketpair()
+        self._thread: Optional[threading.Thread] = None
+
+    def launch(self, button: Hashable, spec: LaunchSpec, command: str = "") -> Optional[int]:
+        """ Starts the program of a button unless its spec refuses another copy right now.
+            Returns the process id, or None if the program was not started. Raises OSError
+            if the program could not be started."""
+        if not spec.argv:
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            last_launch = self._last_launch.get(button)
+            if (
+                (spec.debounce and last_launch is not None and now - last_launch < spec.debounce)
+                or (spec.max_instances and self._running(button) >= spec.max_instances)
+            ):
+                self.refused += 1
+                return None
+            self._last_launch[button] = now
+
+            try:
+                process = self._spawn(spec.argv)
+            except OSError:
+                self.failed += 1
+                raise
+            child = _Child(process, button, command or " ".join(spec.argv))
+            if self._use_pidfd:
+                try:
+                    child.pidfd = os.pidfd_open(process.pid)
+                except OSError:
+                    self._use_pidfd = False
+            self._children[process.pid] = child
+            self.launched += 1
+            self._ensure_thread()
+        self._wake()
+        return process.pid
+
+    def running(self, button: Optional[Hashable] = None) -> int:
+        """ Returns the number of programs still running, of one button or of all of them."""
+        with self._lock:
+            return self._running(button) if button is not None else len(self._children)
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the launcher counters and the number of programs running."""
+        return {
+            "running": len(self._children),
+            "launched": self.launched,
+            "refused": self.refused,
+            "failed": self.failed,
+            "exited": self.exited,
+        }
+
+    def reap(self) -> List[Tuple[int, int]]:
+        """ Collects the programs that exited, returning their process ids and exit statuses.
+            Negative statuses are the signal that ended the program."""
+        with self._lock:
+            children = list(self._children.values())
+        reaped = []
+        for child in children:
+            status = child.process.poll()
+            if status is not None:
+                self._exited(child, status)
+                reaped.append((child.process.pid, status))
+        return reaped
+
+    def _running(self, button: Hashable) -> int:
+        return sum(1 for child in self._children.values() if child.button == button)
+
+    def _spawn(self, argv: Tuple[str, ...]) -> subprocess.Popen:
+        if not self.fast_spawn:
+            return subprocess.Popen(argv)
+        # subprocess only uses posix_spawn for an executable given with its directory and
+        # without close_fds, so the program's path is looked up once and remembered
+        executable = self._executables.get(argv[0])
+        if executable is None:
+            executable = shutil.which(argv[0]) or argv[0]
+            if os.path.dirname(executable):
+                self._executables[argv[0]] = executable
+        return subprocess.Popen(argv, executable=executable, close_fds=False)
+
+    def _exited(self, child: _Child, status: int) -> None:
+        with self._lock:
+            if self._children.pop(child.process.pid, None) is None:
+                return
+            self.exited += 1
+        if child.pidfd is not None:
+            os.close(child.pidfd)
+        runtime = time.monotonic() - child.started_at
+        command_seconds.labels().observe(runtime)
+        command_exits.labels(status=status).inc()
+        if status:
+            print(f"The command '{child.command}' exited with status {status} after {runtime:.1f}s")
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="launcher", daemon=True)
+            self._thread.start()
+
+    def _wake(self) -> None:
+        try:
+            self._wake_send.send(b"\0")
+        except OSError:
+            pass
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                pidfds = [child.pidfd for child in self._children.values() if child.pidfd is not None]
+                polling = len(pidfds) < len(self._children)
+            readable, _writable, _errors = select.select(
+                [self._wake_receive, *pidfds], [], [], POLL_INTERVAL if polling else None
+            )
+            if self._wake_receive in readable:
+                self._wake_receive.recv(4096)
+            self.reap()
@@ -0,0 +1,217 @@
+"""Low overhead counters and latency histograms, exported as Prometheus text or JSON"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Upper bounds in seconds, covering a fast cache lookup up to a slow USB hub
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+Labels = Tuple[Tuple[str, str], ...]
+# A collector returns gauge samples as (name, labels, value) when metrics are exported
+Collector = Callable[[], List[Tuple[str, Dict[str, str], float]]]
+
+
+class Counter:
+    """ A value that only goes up, such as the number of key presses."""
+
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    """ Counts observed durations into fixed buckets, keeping their count and sum."""
+
+    __slots__ = ("buckets", "counts", "count", "sum", "_lock")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """ Observes how long the body of the with statement takes, on the monotonic clock."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Family:
+    """ A named metric with one child Counter or Histogram per combination of label values."""
+
+    def __init__(self, name: str, help_text: str, kind: str, buckets: Sequence[float] = ()):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.buckets = buckets
+        self.children: Dict[Labels, object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels: object):
+        """ Returns the child for the given label values, creating it on first use."""
+        key = tuple(sorted((name, str(value)) for name, value in labels.items()))
+        child = self.children.get(key)
+        if child is None:
+            with self._lock:
+                child = self.children.get(key)
+                if child is None:
+                    child = Histogram(self.buckets) if self.kind == "histogram" else Counter()
+                    self.children[key] = child
+        return child
+
+
+class Registry:
+    """ Holds every metric family and the collectors that report gauges at export time."""
+
+    def __init__(self):
+        self.families: Dict[str, Family] = {}
+        self.collectors: List[Collector] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str) -> Family:
+        return self._family(name, help_text, "counter", ())
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Family:
+        return self._family(name, help_text, "histogram", buckets)
+
+    def register_collector(self, collector: Collector) -> None:
+        self.collectors.append(collector)
+
+    def _family(self, name: str, help_text: str, kind: str, buckets: Sequence[float]) -> Family:
+        with self._lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = Family(name, help_text, kind, buckets)
+            return family
+
+    def _gauges(self) -> List[Tuple[str, Dict[str, str], float]]:
+        samples = []
+        for collector in self.collectors:
+            try:
+                samples.extend(collector())
+            except Exception as error:
+                print(f"Unable to collect metrics with error {error}")
+        return samples
+
+    def to_prometheus(self) -> str:
+        """ Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for family in list(self.families.values()):
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for labels, child in list(family.children.items()):
+                if isinstance(child, Histogram):
+                    cumulative = 0
+                    for bound, count in zip([*family.buckets, "+Inf"], child.counts):
+                        cumulative += count
+                        bucket_labels = (*labels, ("le", str(bound)))
+                        lines.append(f"{family.name}_bucket{_format(bucket_labels)} {cumulative}")
+                    lines.append(f"{family.name}_sum{_format(labels)} {child.sum}")
+                    lines.append(f"{family.name}_count{_format(labels)} {child.count}")
+                else:
+                    lines.append(f"{family.name}{_format(labels)} {child.value}")  # type: ignore
+
+        gauge_names = set()
+        for name, labels, value in self._gauges():
+            if name not in gauge_names:
+                gauge_names.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{_format(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        """ Returns every metric as a JSON serialisable dictionary."""
+        result: Dict[str, list] = {}
+        for family in list(self.families.values()):
+            samples = result.setdefault(family.name, [])
+            for labels, child in list(family.children.items()):
+                sample: dict = {"labels": dict(labels)}
+                if isinstance(child, Histogram):
+                    sample.update(count=child.count, sum=child.sum,
+                                  buckets=dict(zip([*map(str, family.buckets), "+Inf"], child.counts)))
+                else:
+                    sample["value"] = child.value  # type: ignore
+                samples.append(sample)
+        for name, labels, value in self._gauges():
+            result.setdefault(name, []).append({"labels": labels, "value": value})
+        return result
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", '\\"').replace("\n", "\\n")
+
+
+def _format(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels) + "}"
+
+
+class MetricsExporter:
+    """ Periodically writes the registry to a file, atomically replacing it. Files ending
+        in .json get a JSON dump, anything else the Prometheus text format, which suits the
+        node exporter's textfile collector. """
+
+    def __init__(self, registry: Registry, path: str, interval: float):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """ Stops exporting, writing the file one last time."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self) -> None:
+        if self.path.endswith(".json"):
+            content = json.dumps({"time": time.time(), "metrics": self.registry.to_json()})
+        else:
+            content = self.registry.to_prometheus()
+        with open(self.path + ".tmp", "w") as metrics_file:
+            metrics_file.write(content)
+        os.replace(self.path + ".tmp", self.path)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self._write_safely()
+        self._write_safely()
+
+    def _write_safely(self) -> None:
+        try:
+            self.write()
+        except OSError as error:
+            print(f"Unable to write metrics to {self.path} with error {error}")
+
+
+REGISTRY = Registry()
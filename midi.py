@@ -0,0 +1,145 @@
+"""Sends MIDI messages for MIDI buttons through a persistent output port"""
+import importlib.util
+import json
+import queue
+import threading
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Tuple
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+
+
+class MIDIMessages(NamedTuple):
+    """The ready to send bytes of a button: press is sent when the key goes down and
+    release, if any, when it comes back up"""
+    press: bytes
+    release: Optional[bytes]
+
+
+def _values(text: str) -> List[int]:
+    text = text.strip()
+    if text.startswith("["):
+        values = json.loads(text)
+    else:
+        values = [part.strip() for part in text.split(",")]
+    return [int(value) for value in values]
+
+
+@lru_cache(maxsize=512)
+def parse_message(command_string: str) -> MIDIMessages:
+    """Parses a button's MIDI command string. "channel,note,velocity" (or the same as a JSON
+    list) plays the note while the key is held, "cc:channel,controller,value" sends a control
+    change when pressed. Channels are 1 to 16, other values 0 to 127."""
+    kind, _colon, values = command_string.strip().rpartition(":")
+    kind = kind.strip().lower() or "note"
+    if kind not in ("note", "cc"):
+        raise ValueError(f"Unknown MIDI message type '{kind}' in '{command_string}'")
+
+    try:
+        channel, number, value = _values(values)
+    except ValueError:
+        raise ValueError(f"Invalid MIDI message '{command_string}', expected channel,number,value")
+    if not 1 <= channel <= 16 or not 0 <= number <= 127 or not 0 <= value <= 127:
+        raise ValueError(f"MIDI values out of range in '{command_string}'")
+
+    if kind == "cc":
+        return MIDIMessages(bytes([CONTROL_CHANGE | (channel - 1), number, value]), None)
+    return MIDIMessages(
+        bytes([NOTE_ON | (channel - 1), number, value]),
+        bytes([NOTE_OFF | (channel - 1), number, 0]),
+    )
+
+
+class RtMidiBackend:
+    """ Output port backed by python-rtmidi. Opens the first port whose name contains
+        port_name, or a virtual port with that name when none matches. """
+
+    def __init__(self, port_name: str):
+        import rtmidi
+
+        self.output = rtmidi.MidiOut()
+        ports = self.output.get_ports()
+        matches = [index for index, name in enumerate(ports) if port_name in name]
+        if matches:
+            self.output.open_port(matches[0])
+        else:
+            self.output.open_virtual_port(port_name or "streamdeck-cli")
+
+    def send(self, message: bytes) -> None:
+        self.output.send_message(list(message))
+
+    def close(self) -> None:
+        self.output.close_port()
+
+
+class FakeBackend:
+    """ Output port that records the messages sent to it, for testing without MIDI hardware."""
+
+    def __init__(self, port_name: str = ""):
+        self.port_name = port_name
+        self.messages: List[bytes] = []
+
+    def send(self, message: bytes) -> None:
+        self.messages.append(message)
+
+    def close(self) -> None:
+        pass
+
+
+BACKENDS = {"rtmidi": RtMidiBackend, "fake": FakeBackend}
+
+
+@lru_cache(maxsize=None)
+def available(backend: str) -> bool:
+    """Returns whether a MIDI backend can be used, without importing the library it needs"""
+    if backend == "rtmidi":
+        return importlib.util.find_spec("rtmidi") is not None
+    return backend in BACKENDS
+
+
+class MIDIOutput:
+    """ Sends MIDI messages from a dedicated thread, so sending never blocks the caller.
+        Messages go out in the order they were sent. """
+
+    def __init__(self, backend):
+        """ Constructs a new MIDIOutput instance around an opened backend port."""
+        self.backend = backend
+        self.sent = 0
+        self.errors = 0
+        self._queue: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="midi-output", daemon=True)
+        self._thread.start()
+
+    def send(self, message: bytes) -> None:
+        """ Queues a message to be sent and returns immediately."""
+        self._queue.put(message)
+
+    def close(self) -> None:
+        """ Sends the queued messages and closes the port."""
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        self.backend.close()
+
+    def _run(self) -> None:
+        while True:
+            message = self._queue.get()
+            if message is None:
+                return
+            try:
+                self.backend.send(message)
+                self.sent += 1
+            except Exception as error:
+                self.errors += 1
+                print(f"Could not send MIDI message {list(message)}: {error}")
+
+
+def open_output(backend: str, port_name: str) -> Tuple[Optional[MIDIOutput], Optional[str]]:
+    """Opens the MIDI output port, returning the output or None and the reason it failed"""
+    try:
+        return MIDIOutput(BACKENDS[backend](port_name)), None
+    except KeyError:
+        return None, f"unknown MIDI backend '{backend}'"
+    except Exception as error:
+        return None, str(error)
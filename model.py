@@ -0,0 +1,244 @@
+"""Typed records for the configuration state of decks and their buttons"""
+import itertools
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from config import DEFAULT_FONT
+
+# Fields every button has, with the value read when the configuration file leaves one out
+BUTTON_DEFAULTS: Dict[str, Any] = {
+    "text": "",
+    "icon": "",
+    "font": DEFAULT_FONT,
+    "command": "",
+    "command_type": "",
+    "command_string": "",
+    "keys": "",
+    "write": "",
+    "switch_page": 0,
+    "brightness_change": 0,
+}
+
+# Fields every deck has besides its buttons, with the value read when left out
+DECK_DEFAULTS: Dict[str, Any] = {
+    "page": 0,
+    "brightness": 100,
+    "brightness_dimmed": 0,
+    "display_timeout": 0,
+}
+
+# Version numbers come from one counter, so a record never gets a number another record had
+_versions = itertools.count(1)
+
+# Buttons written by the same tool list their fields in the same order, so each distinct
+# order is kept once and shared
+_orders: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+
+def _intern_order(order: Tuple[str, ...]) -> Tuple[str, ...]:
+    return _orders.setdefault(order, order)
+
+
+class _Record:
+    """ Fields live in slots, named in _defaults, and any other fields found in the
+        configuration file in _extra. _order holds the names of the fields that
+        are set, in the order they are written back, so a file is saved exactly
+        as it was read. Reading a field never allocates. """
+
+    __slots__ = ("_order", "_extra")
+    _defaults: Dict[str, Any] = {}
+
+    def __init__(self):
+        self._order: Tuple[str, ...] = ()
+        self._extra: Optional[Dict[str, Any]] = None
+        for name, default in self._defaults.items():
+            setattr(self, name, default)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._order
+
+    def get(self, name: str, default: Any = None) -> Any:
+        """ Returns a field's value, or default if it is not set."""
+        if name not in self._order:
+            return default
+        if name in self._defaults:
+            return getattr(self, name)
+        return self._extra[name]  # type: ignore
+
+    def set(self, name: str, value: Any) -> bool:
+        """ Sets a field, returning whether its value changed."""
+        if name in self._order and self.get(name) == value:
+            return False
+        if name in self._defaults:
+            setattr(self, name, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[name] = value
+        if name not in self._order:
+            self._order = _intern_order(self._order + (name,))
+        return True
+
+    def unset(self, name: str) -> bool:
+        """ Removes a field, so it reads as its default again. Returns whether it was set."""
+        if name not in self._order:
+            return False
+        if name in self._defaults:
+            setattr(self, name, self._defaults[name])
+        else:
+            del self._extra[name]  # type: ignore
+        self._order = _intern_order(tuple(field for field in self._order if field != name))
+        return True
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        for name in self._order:
+            yield name, self.get(name)
+
+    def _load(self, fields: Dict[str, Any]) -> None:
+        for name, value in fields.items():
+            if name in self._defaults:
+                setattr(self, name, value)
+            else:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[name] = value
+        self._order = _intern_order(tuple(fields))
+
+
+class ButtonState(_Record):
+    """ The settings of one button. version changes whenever a setting does, and is never
+        reused, so anything derived from the button can be checked against it. """
+
+    __slots__ = (*BUTTON_DEFAULTS, "version")
+    _defaults = BUTTON_DEFAULTS
+
+    def __init__(self):
+        super().__init__()
+        self.version = next(_versions)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ButtonState):
+            return NotImplemented
+        return self._order == other._order and all(
+            self.get(name) == other.get(name) for name in self._order
+        )
+
+    __hash__ = None  # type: ignore
+
+    def __len__(self) -> int:
+        """ Returns the number of settings, so a button without any is false like {} was."""
+        return len(self._order)
+
+    def set(self, name: str, value: Any) -> bool:
+        changed = super().set(name, value)
+        if changed:
+            self.version = next(_versions)
+        return changed
+
+    def unset(self, name: str) -> bool:
+        changed = super().unset(name)
+        if changed:
+            self.version = next(_versions)
+        return changed
+
+    @classmethod
+    def from_dict(cls, settings: Dict[str, Any]) -> "ButtonState":
+        button = cls()
+        button._load(settings)
+        return button
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+
+_NO_BUTTONS: Dict[int, ButtonState] = {}
+
+
+class DeckState(_Record):
+    """ The settings of one deck, with its buttons by page and button number. Each page has
+        a version that changes whenever one of its buttons does. """
+
+    __slots__ = (*DECK_DEFAULTS, "buttons", "page_versions")
+    _defaults = DECK_DEFAULTS
+
+    def __init__(self):
+        super().__init__()
+        self.buttons: Dict[int, Dict[int, ButtonState]] = {}
+        self.page_versions: Dict[int, int] = {}
+
+    def get(self, name: str, default: Any = None) -> Any:
+        if name == "buttons":
+            return self.buttons if name in self._order else default
+        return super().get(name, default)
+
+    def button(self, page: int, button: int) -> Optional[ButtonState]:
+        """ Returns a button's settings, or None if it has none. Nothing is created."""
+        return self.buttons.get(page, _NO_BUTTONS).get(button)
+
+    def page_buttons(self, page: int) -> Dict[int, ButtonState]:
+        """ Returns the buttons of a page by number. The result must not be modified."""
+        return self.buttons.get(page, _NO_BUTTONS)
+
+    def page_version(self, page: int) -> int:
+        return self.page_versions.get(page, 0)
+
+    def set_button(self, page: int, button: int, name: str, value: Any) -> bool:
+        """ Sets a setting of a button, creating the button if needed. Returns whether the
+            setting changed."""
+        button_state = self.button(page, button)
+        if button_state is None:
+            if "buttons" not in self._order:
+                self._order = _intern_order(self._order + ("buttons",))
+            button_state = self.buttons.setdefault(page, {})[button] = ButtonState()
+        changed = button_state.set(name, value)
+        if changed:
+            self.page_changed(page)
+        return changed
+
+    def unset_button(self, page: int, button: int, name: str) -> bool:
+        """ Removes a setting of a button, and the button once it has none left, and its page
+            and the buttons once those are empty. Returns whether the setting was set."""
+        button_state = self.button(page, button)
+        if button_state is None or not button_state.unset(name):
+            return False
+        if not button_state:
+            page_buttons = self.buttons[page]
+            del page_buttons[button]
+            if not page_buttons:
+                del self.buttons[page]
+            if not self.buttons:
+                self._order = _intern_order(tuple(field for field in self._order if field != "buttons"))
+        self.page_changed(page)
+        return True
+
+    def page_changed(self, page: int) -> None:
+        """ Gives a page a new version, after one of its buttons was replaced or changed."""
+        self.page_versions[page] = next(_versions)
+
+    @classmethod
+    def from_dict(cls, settings: Dict[str, Any]) -> "DeckState":
+        """ Builds a deck from its configuration file entry, whose pages and buttons are
+            already numbered by integers."""
+        deck = cls()
+        buttons = settings.get("buttons", {})
+        deck._load({name: value for name, value in settings.items() if name != "buttons"})
+        if "buttons" in settings:
+            deck._order = _intern_order(tuple(settings))
+        for page, page_buttons in buttons.items():
+            deck.buttons[page] = {
+                button: ButtonState.from_dict(button_settings)
+                for button, button_settings in page_buttons.items()
+            }
+            deck.page_changed(page)
+        return deck
+
+    def to_dict(self) -> Dict[str, Any]:
+        settings = {}
+        for name in self._order:
+            if name == "buttons":
+                settings[name] = {
+                    page: {button: button_state.to_dict() for button, button_state in buttons.items()}
+                    for page, buttons in self.buttons.items()
+                }
+            else:
+                settings[name] = self.get(name)
+        return settings
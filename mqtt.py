@@ -0,0 +1,302 @@
+"""Publishes MQTT messages for MQTT buttons over a persistent broker connection"""
+import itertools
+import select
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional, Tuple
+
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+def _string(value: str) -> bytes:
+    data = value.encode()
+    return struct.pack(">H", len(data)) + data
+
+
+def _packet(header: int, body: bytes = b"") -> bytes:
+    length = len(body)
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            break
+    return bytes([header]) + bytes(encoded) + body
+
+
+def encode_connect(client_id: str, keepalive: int, username: Optional[str] = None,
+                   password: Optional[str] = None) -> bytes:
+    """Encodes an MQTT 3.1.1 CONNECT packet with a clean session"""
+    flags = 0x02
+    payload = _string(client_id)
+    if username is not None:
+        flags |= 0x80
+        payload += _string(username)
+        if password is not None:
+            flags |= 0x40
+            payload += _string(password)
+    return _packet(CONNECT, _string("MQTT") + bytes([4, flags]) + struct.pack(">H", keepalive) + payload)
+
+
+def encode_publish(topic: str, payload: bytes, qos: int = 0, packet_id: int = 0,
+                   retain: bool = False, dup: bool = False) -> bytes:
+    """Encodes an MQTT PUBLISH packet"""
+    header = PUBLISH | (0x08 if dup else 0) | (qos << 1) | (0x01 if retain else 0)
+    body = _string(topic) + (struct.pack(">H", packet_id) if qos else b"") + payload
+    return _packet(header, body)
+
+
+def parse_command(command_string: str) -> Tuple[str, bytes]:
+    """Splits a button's command string "topic [payload]" into its topic and payload"""
+    topic, _separator, payload = command_string.strip().partition(" ")
+    if not topic:
+        raise ValueError("MQTT command has no topic")
+    return topic, payload.strip().encode()
+
+
+class MQTTPublisher:
+    """ Keeps one long lived connection to an MQTT broker on a background thread.
+        Publishing only queues the message: the connection thread writes queued
+        messages back to back without waiting for acknowledgements, answers the
+        keepalive, and reconnects after errors. Messages published while the
+        broker is unreachable, or that could not be written, wait in a bounded
+        queue, dropping the oldest once full. Unacknowledged QoS 1 messages are
+        sent again after reconnecting; as many are kept as the queue holds, so
+        the oldest is dropped once a broker leaves that many unacknowledged. """
+
+    def __init__(self, host: str, port: int = 1883, client_id: str = "",
+                 keepalive: int = 60, qos: int = 0, queue_size: int = 100,
+                 username: Optional[str] = None, password: Optional[str] = None):
+        """ Constructs a new MQTTPublisher instance and starts connecting
+
+        :param str host: The broker's host name.
+        :param int port: The broker's port.
+        :param str client_id: The client identifier, generated by the broker if empty.
+        :param int keepalive: Seconds between keepalive pings on an idle connection.
+        :param int qos: The quality of service published with, 0 or 1.
+        :param int queue_size: The number of messages kept while disconnected, and of
+                               unacknowledged QoS 1 messages kept to send again.
+        """
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self.qos = qos
+        self.username = username
+        self.password = password
+        self.connected = False
+        self.published = 0
+        self.acknowledged = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self._queue: Deque[Tuple[str, bytes, bool]] = deque(maxlen=queue_size)
+        self._inflight: "OrderedDict[int, bytes]" = OrderedDict()
+        self._packet_ids = itertools.cycle(range(1, 65536))
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._wake_receive, self._wake_send = socket.socketpair()
+        # Publishing never waits on the connection thread; once the pair is full the thread
+        # is already due to wake
+        self._wake_send.setblocking(False)
+        self._thread = threading.Thread(target=self._run, name=f"mqtt-{host}", daemon=True)
+        self._thread.start()
+
+    def publish(self, topic: str, payload: bytes = b"", retain: bool = False) -> None:
+        """ Queues a message for publishing and returns immediately."""
+        with self._lock:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append((topic, payload, retain))
+        self._wake()
+
+    def close(self) -> None:
+        """ Sends the queued messages if connected, then disconnects."""
+        self._stopped = True
+        self._wake()
+        self._thread.join(timeout=5)
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the publisher counters and queue sizes."""
+        return {
+            "connected": int(self.connected),
+            "queued": len(self._queue),
+            "inflight": len(self._inflight),
+            "published": self.published,
+            "acknowledged": self.acknowledged,
+            "dropped": self.dropped,
+            "reconnects": self.reconnects,
+        }
+
+    def _wake(self) -> None:
+        try:
+            self._wake_send.send(b"\0")
+        except OSError:
+            pass
+
+    def _run(self) -> None:
+        backoff = 1.0
+        while not self._stopped:
+            try:
+                sock = self._connect()
+            except (OSError, ValueError) as error:
+                print(f"Unable to connect to MQTT broker {self.host}:{self.port}: {error}")
+                self._wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+
+            backoff = 1.0
+            try:
+                self._serve(sock)
+            except (OSError, ValueError) as error:
+                print(f"Lost connection to MQTT broker {self.host}:{self.port}: {error}")
+            finally:
+                self.connected = False
+                sock.close()
+            if not self._stopped:
+                self.reconnects += 1
+
+    def _wait(self, timeout: float) -> None:
+        readable, _writable, _errors = select.select([self._wake_receive], [], [], timeout)
+        if readable:
+            self._wake_receive.recv(4096)
+
+    def _connect(self) -> socket.socket:
+        sock = socket.create_connection((self.host, self.port), timeout=10)
+        sock.sendall(encode_connect(self.client_id, self.keepalive, self.username, self.password))
+        header, body = self._read_packet(sock, bytearray())
+        if header & 0xF0 != CONNACK or len(body) != 2 or body[1] != 0:
+            sock.close()
+            raise ValueError(f"connection refused with code {body[1] if len(body) > 1 else '?'}")
+        self.connected = True
+
+        # Messages that were never acknowledged are sent again, marked as duplicates
+        with self._lock:
+            unacknowledged = list(self._inflight.values())
+        for packet in unacknowledged:
+            sock.sendall(bytes([packet[0] | 0x08]) + packet[1:])
+        sock.setblocking(False)
+        return sock
+
+    def _serve(self, sock: socket.socket) -> None:
+        buffer = bytearray()
+        last_sent = time.monotonic()
+        ping_sent: Optional[float] = None
+        while True:
+            last_sent = self._send_queued(sock) or last_sent
+            if self._stopped:
+                self._send(sock, _packet(DISCONNECT))
+                return
+
+            now = time.monotonic()
+            if ping_sent is not None and now - ping_sent > self.keepalive:
+                raise OSError("no response to keepalive ping")
+            if ping_sent is None and self.keepalive and now - last_sent >= self.keepalive / 2:
+                self._send(sock, _packet(PINGREQ))
+                last_sent = ping_sent = now
+
+            timeout = self.keepalive / 2 if self.keepalive else None
+            readable, _writable, _errors = select.select(
+                [sock, self._wake_receive], [], [], timeout
+            )
+            if self._wake_receive in readable:
+                self._wake_receive.recv(4096)
+            if sock in readable:
+                data = sock.recv(4096)
+                if not data:
+                    raise OSError("connection closed by broker")
+                buffer += data
+                for header, body in self._parse_packets(buffer):
+                    if header & 0xF0 == PUBACK:
+                        self._acknowledge(struct.unpack(">H", body[:2])[0])
+                    elif header & 0xF0 == PINGRESP:
+                        ping_sent = None
+
+    def _send_queued(self, sock: socket.socket) -> Optional[float]:
+        packets = []
+        requeue = []
+        with self._lock:
+            while self._queue:
+                message = self._queue.popleft()
+                topic, payload, retain = message
+                packet_id = next(self._packet_ids) if self.qos else 0
+                packet = encode_publish(topic, payload, self.qos, packet_id, retain)
+                if self.qos:
+                    if len(self._inflight) == self._queue.maxlen:
+                        self._inflight.popitem(last=False)
+                        self.dropped += 1
+                    self._inflight[packet_id] = packet
+                else:
+                    requeue.append(message)
+                packets.append(packet)
+        if not packets:
+            return None
+
+        try:
+            self._send(sock, b"".join(packets))
+        except OSError:
+            # QoS 1 messages are sent again after reconnecting, QoS 0 ones would be lost
+            self._requeue(requeue)
+            raise
+        self.published += len(packets)
+        return time.monotonic()
+
+    def _requeue(self, messages) -> None:
+        """ Puts messages that could not be written back at the front of the queue, ahead of
+            those published since, dropping the oldest if the queue overflows."""
+        with self._lock:
+            kept = [*messages, *self._queue]
+            overflow = max(len(kept) - (self._queue.maxlen or len(kept)), 0)
+            self.dropped += overflow
+            self._queue.clear()
+            self._queue.extend(kept[overflow:])
+
+    def _send(self, sock: socket.socket, data: bytes) -> None:
+        # A broker that stops reading for as long as the keepalive counts as lost, so a
+        # stalled connection can't hold the thread
+        sock.settimeout(self.keepalive or 10)
+        try:
+            sock.sendall(data)
+        except socket.timeout:
+            raise OSError("broker stopped reading") from None
+        finally:
+            sock.setblocking(False)
+
+    def _acknowledge(self, packet_id: int) -> None:
+        with self._lock:
+            if self._inflight.pop(packet_id, None) is not None:
+                self.acknowledged += 1
+
+    @staticmethod
+    def _parse_packets(buffer: bytearray):
+        while len(buffer) >= 2:
+            length = 0
+            for index in range(1, min(len(buffer), 5)):
+                length += (buffer[index] & 0x7F) << (7 * (index - 1))
+                if not buffer[index] & 0x80:
+                    break
+            else:
+                return
+            end = index + 1 + length
+            if len(buffer) < end:
+                return
+            header, body = buffer[0], bytes(buffer[index + 1:end])
+            del buffer[:end]
+            yield header, body
+
+    def _read_packet(self, sock: socket.socket, buffer: bytearray) -> Tuple[int, bytes]:
+        while True:
+            for packet in self._parse_packets(buffer):
+                return packet
+            data = sock.recv(4096)
+            if not data:
+                raise OSError("connection closed by broker")
+            buffer += data
@@ -0,0 +1,179 @@
+"""Sends Open Sound Control messages over UDP for OSC buttons"""
+import shlex
+import socket
+import struct
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, NamedTuple, Sequence, Tuple, Union
+
+OSCArgument = Union[int, float, str, bool, bytes, None]
+
+# Time tag meaning "immediately", see the OSC 1.0 specification
+IMMEDIATELY = 1
+
+
+class OSCMessage(NamedTuple):
+    address: str
+    arguments: Tuple[OSCArgument, ...]
+
+
+class OSCCommand(NamedTuple):
+    host: str
+    port: int
+    messages: Tuple[OSCMessage, ...]
+
+
+def _pad(data: bytes) -> bytes:
+    return data + b"\0" * (4 - len(data) % 4)
+
+
+def _blob(data: bytes) -> bytes:
+    padding = (4 - len(data) % 4) % 4
+    return struct.pack(">i", len(data)) + data + b"\0" * padding
+
+
+def encode_message(address: str, arguments: Sequence[OSCArgument] = ()) -> bytes:
+    """Encodes an OSC message. Arguments are sent as int32, float32, string, blob, True,
+    False or Nil depending on their Python type."""
+    type_tags = ","
+    data = b""
+    for argument in arguments:
+        if argument is True:
+            type_tags += "T"
+        elif argument is False:
+            type_tags += "F"
+        elif argument is None:
+            type_tags += "N"
+        elif isinstance(argument, int):
+            type_tags += "i"
+            data += struct.pack(">i", argument)
+        elif isinstance(argument, float):
+            type_tags += "f"
+            data += struct.pack(">f", argument)
+        elif isinstance(argument, str):
+            type_tags += "s"
+            data += _pad(argument.encode())
+        elif isinstance(argument, bytes):
+            type_tags += "b"
+            data += _blob(argument)
+        else:
+            raise ValueError(f"OSC can not send arguments of type {type(argument).__name__}")
+    return _pad(address.encode()) + _pad(type_tags.encode()) + data
+
+
+def encode_bundle(messages: Sequence[bytes], time_tag: int = IMMEDIATELY) -> bytes:
+    """Encodes already encoded OSC messages into a single bundle"""
+    bundle = _pad(b"#bundle") + struct.pack(">Q", time_tag)
+    for message in messages:
+        bundle += struct.pack(">i", len(message)) + message
+    return bundle
+
+
+def _parse_argument(argument: str) -> OSCArgument:
+    lowered = argument.lower()
+    if lowered in ("true", "false"):
+        return lowered == "true"
+    if lowered in ("nil", "none"):
+        return None
+    for convert in (int, float):
+        try:
+            return convert(argument)  # type: ignore
+        except ValueError:
+            pass
+    return argument
+
+
+@lru_cache(maxsize=512)
+def parse_command(command_string: str) -> OSCCommand:
+    """Parses a button's command string of the form
+    "host:port/address [arguments][; /address [arguments] ...]". Several messages
+    separated by semicolons are sent to the same host as one bundle."""
+    destination, separator, _rest = command_string.strip().partition("/")
+    host, _colon, port = destination.rpartition(":")
+    if not separator or not host or not port.isdigit():
+        raise ValueError(f"Invalid OSC command '{command_string}', expected host:port/address")
+
+    messages = []
+    for message in command_string.strip()[len(destination):].split(";"):
+        parts = shlex.split(message)
+        if not parts or not parts[0].startswith("/"):
+            raise ValueError(f"Invalid OSC address in '{command_string}'")
+        messages.append(OSCMessage(parts[0], tuple(_parse_argument(part) for part in parts[1:])))
+    return OSCCommand(host, int(port), tuple(messages))
+
+
+@lru_cache(maxsize=512)
+def encode_command(command: OSCCommand) -> bytes:
+    """Encodes the messages of a parsed command, as a bundle if there are several"""
+    if len(command.messages) == 1:
+        return encode_message(*command.messages[0])
+    return encode_bundle([encode_message(*message) for message in command.messages])
+
+
+class OSCSender:
+    """ Sends OSC packets, keeping one connected UDP socket per destination and
+        caching host name resolution, so sending a message is a single send call.
+        A destination's socket is replaced, and the old one closed, when its host
+        name resolves to a different address. """
+
+    def __init__(self, resolve_ttl: float):
+        """ Constructs a new OSCSender instance
+
+        :param float resolve_ttl: Seconds a resolved host address is reused before it
+                                  is looked up again.
+        """
+        self.resolve_ttl = resolve_ttl
+        self.sent = 0
+        self.resolves = 0
+        # The expiry of the resolved address, the address and its socket, by host and port
+        self._destinations: Dict[Tuple[str, int], Tuple[float, tuple, socket.socket]] = {}
+        self._lock = threading.Lock()
+
+    def send(self, command_string: str) -> None:
+        """ Sends the message, or bundle of messages, described by a button's command string."""
+        self.send_command(parse_command(command_string))
+
+    def send_command(self, command: OSCCommand) -> None:
+        """ Sends the message, or bundle of messages, of an already parsed command."""
+        self.send_packet(command.host, command.port, encode_command(command))
+
+    def send_packet(self, host: str, port: int, packet: bytes) -> None:
+        """ Sends an encoded OSC packet to host and port."""
+        sock = self._socket(host, port)
+        sock.send(packet)
+        self.sent += 1
+
+    def close(self) -> None:
+        """ Closes every open socket."""
+        with self._lock:
+            for _expires, _address, sock in self._destinations.values():
+                sock.close()
+            self._destinations.clear()
+
+    def _socket(self, host: str, port: int) -> socket.socket:
+        now = time.monotonic()
+        with self._lock:
+            destination = self._destinations.get((host, port))
+        if destination is not None and destination[0] > now:
+            return destination[2]
+
+        # Looked up without the lock, as resolving a name such as an mDNS .local host can
+        # take seconds and must not hold up sending to other destinations
+        family, _type, _proto, _name, sockaddr = socket.getaddrinfo(
+            host, port, type=socket.SOCK_DGRAM
+        )[0]
+        address = (family, sockaddr)
+
+        with self._lock:
+            self.resolves += 1
+            destination = self._destinations.get((host, port))
+            if destination is not None and destination[1] == address:
+                sock = destination[2]
+            else:
+                if destination is not None:
+                    destination[2].close()
+                sock = socket.socket(family, socket.SOCK_DGRAM)
+                sock.connect(sockaddr)
+            self._destinations[(host, port)] = (now + self.resolve_ttl, address, sock)
+            return sock
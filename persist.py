@@ -0,0 +1,114 @@
+"""Persists the configuration state in the background, coalescing bursts of changes"""
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+# Longest time in seconds to wait before trying a failed write again
+MAX_RETRY_DELAY = 60.0
+
+
+class StatePersister:
+    """ Write-behind saver for the configuration file. Every change only marks
+        the state as dirty; a background thread writes it once the coalescing
+        delay has passed since the first change, so the changes made in the
+        meantime cost a single write. A write that fails is tried again,
+        waiting longer after each failure in a row. """
+
+    def __init__(self, write: Callable[[], None], delay: float):
+        """ Constructs a new StatePersister instance
+
+        :param Callable[[], None] write: Writes the complete current state.
+        :param float delay: Seconds to wait after the first change before writing, gathering
+                            any further changes into the same write.
+        """
+        self.write = write
+        self.delay = delay
+        self.writes = 0
+        self.failures = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        self._dirty_since: Optional[float] = None
+        self._retry_delay = 0.0
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self) -> None:
+        """ Marks the state as changed. It will be written within the coalescing delay."""
+        with self._condition:
+            if self._dirty_since is None:
+                self._dirty_since = time.monotonic()
+                self._ensure_thread()
+                self._condition.notify()
+
+    def flush(self) -> None:
+        """ Writes any pending changes right away, on the calling thread. A write already
+            in progress on the background thread is waited for first."""
+        self._write_pending()
+
+    def pending(self) -> bool:
+        """ Returns whether there are changes that have not been written yet."""
+        return self._dirty_since is not None
+
+    def stats(self) -> Dict[str, float]:
+        """ Returns the number of writes and how long they took, in seconds."""
+        return {
+            "writes": self.writes,
+            "failures": self.failures,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "mean_latency": self.total_latency / self.writes if self.writes else 0.0,
+        }
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="state-persister", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while self._dirty_since is None:
+                    self._condition.wait()
+                remaining = self._dirty_since + self.delay + self._retry_delay - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+            self._write_pending()
+
+    def _write_pending(self) -> None:
+        # Changes are only taken while holding the write lock, so once flush returns no
+        # write of them is still under way on another thread
+        with self._write_lock:
+            with self._condition:
+                if self._dirty_since is None:
+                    return
+                self._dirty_since = None
+            self._write()
+
+    def _write(self) -> None:
+        start = time.perf_counter()
+        try:
+            self.write()
+        except RuntimeError:
+            # The state was modified while it was being serialised, try again later
+            self.failures += 1
+            self.schedule()
+            return
+        except Exception as error:
+            # Such as a full disk, written again later so the changes aren't lost
+            self.failures += 1
+            print(f"Unable to save the configuration with error {error}")
+            with self._condition:
+                self._retry_delay = min(max(self._retry_delay * 2, 1.0), MAX_RETRY_DELAY)
+            self.schedule()
+            return
+        latency = time.perf_counter() - start
+        with self._condition:
+            self._retry_delay = 0.0
+
+        self.writes += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
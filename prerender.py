@@ -0,0 +1,80 @@
+"""Renders key images on a low priority background thread before they are needed"""
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Iterable, Optional
+
+
+class Prerenderer:
+    """ Runs queued render jobs one at a time on a single background thread.
+        Scheduling new work or cancelling discards everything still pending, so
+        the worker never spends time on pages that are no longer reachable. """
+
+    def __init__(self, nice: int = 10):
+        """ Constructs a new Prerenderer instance
+
+        :param int nice: How much to lower the worker thread's scheduling priority by.
+        """
+        self.nice = nice
+        self.completed = 0
+        self.cancelled = 0
+        self._jobs: Deque[Callable[[], None]] = deque()
+        self._running = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def schedule(self, jobs: Iterable[Callable[[], None]]) -> None:
+        """ Replaces any pending work with jobs and wakes the worker."""
+        with self._condition:
+            self._discard()
+            self._jobs.extend(jobs)
+            self._ensure_thread()
+            self._condition.notify_all()
+
+    def cancel(self) -> None:
+        """ Drops all pending jobs. A job that is already running is allowed to finish."""
+        with self._condition:
+            self._discard()
+
+    def pending(self) -> int:
+        """ Returns the number of jobs waiting to run."""
+        return len(self._jobs)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """ Waits until every job has run. Returns False on timeout."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._jobs and not self._running, timeout)
+
+    def _discard(self) -> None:
+        self.cancelled += len(self._jobs)
+        self._jobs.clear()
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="prerender", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        try:
+            # On Linux niceness is per thread, so this only affects the worker
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+        except (AttributeError, OSError):
+            pass
+
+        while True:
+            with self._condition:
+                self._running = False
+                self._condition.notify_all()
+                while not self._jobs:
+                    self._condition.wait()
+                job = self._jobs.popleft()
+                self._running = True
+
+            try:
+                job()
+            except Exception as error:
+                print(f"Pre-rendering failed with error {error}")
+            self.completed += 1
+            # Give the GIL back between jobs so key handling is never held up
+            time.sleep(0)
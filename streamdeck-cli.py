@@ -11,20 +11,98 @@
 # tiles generated at runtime, and responding to button state change events.
 
 import os
-import sys
-import json
 import threading
-from subprocess import Popen
-import shlex
+import time
+from functools import partial
 
 import api
-from PIL import Image, ImageDraw, ImageFont
+from config import (
+    ACTION_QUEUE_SIZE,
+    ACTION_WORKERS,
+    COMMAND_FAST_SPAWN,
+    CONFIG_WATCH,
+    CONFIG_WATCH_INTERVAL,
+    CONTROL_SOCKET,
+    DIM_FADE_DURATION,
+    DIM_FADE_EASING,
+    DIM_FADE_STEPS,
+    EVENT_BUFFER_SIZE,
+    EVENT_OVERFLOW,
+    EVENT_SINK,
+    HOTPLUG_INTERVAL,
+    HOTPLUG_UDEV,
+    METRICS_FILE,
+    METRICS_INTERVAL,
+    MIDI_BACKEND,
+    MIDI_PORT,
+    MQTT_HOST,
+    MQTT_KEEPALIVE,
+    MQTT_PORT,
+    MQTT_QOS,
+    MQTT_QUEUE_SIZE,
+    OSC_NATIVE,
+    OSC_RESOLVE_TTL,
+    STATE_FILE,
+)
+from actions import EXTERNAL_COMMAND_TYPES
+from control import ControlServer
+from eventchannel import EventChannel
+from executor import ActionExecutor
+from fade import FadeEngine
+from hotplug import HotplugMonitor
+from watcher import FileWatcher
+from launcher import Launcher
+import metrics
+import midi
+import mqtt
+from osc import OSCSender
+from events import Timer
 from StreamDeck.DeviceManager import DeviceManager
-from StreamDeck.ImageHelpers import PILHelper
 from StreamDeck.Devices import StreamDeck
 from typing import Dict, Tuple, Union, cast, Callable
 
-decks: Dict[str, StreamDeck.StreamDeck] = {}
+decks: Dict[str, StreamDeck.StreamDeck] = api.decks
+# Created on first use, as pynput connects to the display server when loaded
+keyboard = None
+keyboard_keys = None
+executor = ActionExecutor(ACTION_WORKERS, ACTION_QUEUE_SIZE)
+osc_sender = OSCSender(OSC_RESOLVE_TTL)
+launcher = Launcher(COMMAND_FAST_SPAWN)
+fade_engine = FadeEngine(DIM_FADE_STEPS)
+# External commands for another process, written from their own thread so a slow reader
+# never holds up key handling
+event_channel = EventChannel(EVENT_SINK, EVENT_BUFFER_SIZE, EVENT_OVERFLOW)
+# MQTT publishers by their broker settings, and the settings each deck last published with
+mqtt_publishers: Dict[tuple, mqtt.MQTTPublisher] = {}
+mqtt_deck_brokers: Dict[str, tuple] = {}
+mqtt_lock = threading.Lock()
+# Opened at startup when the configuration has MIDI buttons
+midi_output = None
+# The note off to send when each (deck_id, key) holding a MIDI note is released,
+# kept from the press so it does not depend on the page shown at release
+midi_releases: Dict[Tuple[str, int], bytes] = {}
+
+press_to_action_seconds = metrics.REGISTRY.histogram(
+    "streamdeck_press_to_action_seconds", "Time from a key press until its action starts"
+)
+action_seconds = metrics.REGISTRY.histogram(
+    "streamdeck_action_seconds", "Time a key's action takes, including its delays"
+)
+metrics.REGISTRY.register_collector(
+    lambda: [(f"streamdeck_executor_{name}", {}, value) for name, value in executor.stats().items()]
+)
+metrics.REGISTRY.register_collector(
+    lambda: [(f"streamdeck_launcher_{name}", {}, value) for name, value in launcher.stats().items()]
+)
+metrics.REGISTRY.register_collector(
+    lambda: [(f"streamdeck_fade_{name}", {}, value) for name, value in fade_engine.stats().items()]
+)
+metrics.REGISTRY.register_collector(
+    lambda: [(f"streamdeck_events_{name}", {}, value) for name, value in event_channel.stats().items()]
+)
+
+# Set by the CloseStreamDeck action to shut the application down.
+exit_event = threading.Event()
 
 # Folder location of image assets used by this example.
 ASSETS_PATH = os.path.join(os.path.dirname(__file__), "Assets")
@@ -36,7 +114,6 @@ class Dimmer:
     __stopped = False
     __dimmer_brightness = -1
     __timer = None
-    __change_timer = None
 
     def __init__(
         self,
@@ -49,8 +126,10 @@ class Dimmer:
 
         :param int timeout: The time in seconds before the dimmer starts.
         :param int brightness: The normal brightness level.
+        :param int brightness_dimmed: The brightness level the dimmer fades to.
         :param Callable[[int], None] brightness_callback: Callback that receives the current
-                                                          brightness level.
+                                                          brightness level. It is called from
+                                                          the fade thread and must not block.
          """
         self.timeout = timeout
         self.brightness = brightness
@@ -62,9 +141,7 @@ class Dimmer:
         reset to start normal dimming operation. """
         if self.__timer:
             self.__timer.stop()
-
-        if self.__change_timer:
-            self.__change_timer.stop()
+        fade_engine.cancel(self)
 
         self.__dimmer_brightness = self.brightness
         self.brightness_callback(self.brightness)
@@ -77,15 +154,12 @@ class Dimmer:
         self.__stopped = False
         if self.__timer:
             self.__timer.stop()
-
-        if self.__change_timer:
-            self.__change_timer.stop()
+        faded_to = fade_engine.cancel(self)
+        if faded_to is not None:
+            self.__dimmer_brightness = faded_to
 
         if self.timeout:
-            self.__timer = QTimer()
-            self.__timer.setSingleShot(True)
-            self.__timer.timeout.connect(partial(self.change_brightness))
-            self.__timer.start(self.timeout * 1000)
+            self.__timer = Timer.singleShot(self.timeout * 1000, self.change_brightness)
 
         if self.__dimmer_brightness != self.brightness:
             previous_dimmer_brightness = self.__dimmer_brightness
@@ -111,37 +185,108 @@ class Dimmer:
 
             # Verify that we're not already at the target brightness nor
             # busy with dimming already
-            if self.__change_timer is None and self.__dimmer_brightness:
+            if not fade_engine.active(self) and self.__dimmer_brightness:
                 self.change_brightness()
 
     def change_brightness(self):
-        """ Move the brightness level down by one and schedule another change_brightness event. """
-        if self.__dimmer_brightness and self.__dimmer_brightness >= self.brightness_dimmed:
-            self.__dimmer_brightness = self.__dimmer_brightness - 1
-            self.brightness_callback(self.__dimmer_brightness)
-            self.__change_timer = QTimer()
-            self.__change_timer.setSingleShot(True)
-            self.__change_timer.timeout.connect(partial(self.change_brightness))
-            self.__change_timer.start(10)
-        else:
-            self.__change_timer = None
+        """ Fade the brightness down to the dimmed level. """
+        if self.__dimmer_brightness > self.brightness_dimmed:
+            fade_engine.fade(self, self.__dimmer_brightness, self.brightness_dimmed,
+                             DIM_FADE_DURATION, self.__set_brightness, DIM_FADE_EASING)
+
+    def __set_brightness(self, brightness: int) -> None:
+        self.__dimmer_brightness = brightness
+        self.brightness_callback(brightness)
 
 
 dimmers: Dict[str, Dimmer] = {}
 
+
+# Returns the keyboard controller used by Keystroke and Text buttons, loading
+# pynput's Key names along with it.
+def get_keyboard():
+    global keyboard, keyboard_keys
+    if keyboard is None:
+        from pynput.keyboard import Controller, Key
+
+        keyboard_keys = Key
+        keyboard = Controller()
+    return keyboard
+
+
+# Returns the pynput Key a compiled keystroke key name stands for, or the name
+# itself for a character. get_keyboard must have been called first.
+def resolve_key(key_name):
+    return getattr(keyboard_keys, key_name, key_name)
+
+
+# Returns the publisher for the MQTT broker a deck uses, connecting to it on
+# first use, or None if no broker is configured. Decks share a publisher only
+# when all their broker settings match. Once a deck's settings change, the
+# publisher it used is closed in the background if no other deck uses it.
+def get_mqtt_publisher(deck_id):
+    settings = api.get_mqtt_broker(deck_id)
+    host = settings.get("host", MQTT_HOST)
+    broker = None
+    if host:
+        broker = (
+            host,
+            int(settings.get("port", MQTT_PORT)),
+            settings.get("client_id", ""),
+            int(settings.get("keepalive", MQTT_KEEPALIVE)),
+            int(settings.get("qos", MQTT_QOS)),
+            settings.get("username"),
+            settings.get("password"),
+        )
+
+    with mqtt_lock:
+        previous = mqtt_deck_brokers.pop(deck_id, None)
+        if broker is not None:
+            mqtt_deck_brokers[deck_id] = broker
+        if previous is not None and previous != broker and previous not in mqtt_deck_brokers.values():
+            stale = mqtt_publishers.pop(previous)
+            threading.Thread(target=stale.close, name="mqtt-close", daemon=True).start()
+        if broker is None:
+            return None
+
+        publisher = mqtt_publishers.get(broker)
+        if publisher is None:
+            host, port, client_id, keepalive, qos, username, password = broker
+            publisher = mqtt_publishers[broker] = mqtt.MQTTPublisher(
+                host,
+                port,
+                client_id=client_id,
+                keepalive=keepalive,
+                qos=qos,
+                queue_size=MQTT_QUEUE_SIZE,
+                username=username,
+                password=password,
+            )
+    return publisher
+
+
 # Generates a custom tile with run-time generated text and custom image via the
-# PIL module.
-def render_key_image(deck, icon_filename, font_filename, label_text):
+# PIL module, on top of the part of the deck's background behind the key if any.
+def render_key_image(deck, icon_filename, font_filename, label_text, background=None):
     # Resize the source image asset to best-fit the dimensions of a single key,
     # leaving a margin at the bottom so that we can draw the key title
-    # afterwards.
-    icon = Image.open(icon_filename)
-    image = PILHelper.create_scaled_image(deck, icon, margins=[0, 0, 20, 0])
+    # afterwards. Fonts and decoded icons come from the shared api asset cache.
+    from PIL import ImageDraw
+    from StreamDeck.ImageHelpers import PILHelper
+
+    image = background.copy() if background is not None else PILHelper.create_image(deck)
+    try:
+        icon = api.asset_cache.icon(icon_filename, (image.width, image.height - 20))
+    except (OSError, IOError) as icon_error:
+        print(f"Unable to load icon {icon_filename} with error {icon_error}")
+    else:
+        icon_pos = ((image.width - icon.width) // 2, (image.height - 20 - icon.height) // 2)
+        image.paste(icon, icon_pos, icon)
 
     # Load a custom TrueType font and use it to overlay the key index, draw key
     # label onto the image a few pixels from the bottom of the key.
     draw = ImageDraw.Draw(image)
-    font = ImageFont.truetype(font_filename, 14)
+    font = api.asset_cache.font(font_filename, 14)
     draw.text((image.width / 2, image.height - 5), text=label_text, font=font, anchor="ms", fill="white")
 
     return PILHelper.to_native_format(deck, image)
@@ -171,142 +316,232 @@ def get_key_style(deck, key, state):
     }
 
 
-# Creates a new key image based on the key index, style and current key state
-# and updates the image on the StreamDeck.
-def update_key_image(deck, page, key, state):
-    deck_id = deck.get_serial_number()
-    # Determine what icon and label to use on the generated key.
-    key_style = get_key_style(deck, key, state)
+# Pre-rendered (released, pressed) images for each key of the current page, so
+# the key callback only has to look an image up and send it to the deck. Each
+# entry holds the button version it was rendered from, so a stale one is never sent.
+key_sprites: Dict[Tuple[str, int, int], Tuple[int, Tuple[bytes, bytes]]] = {}
+
+# Serial numbers by device id; reading the serial number is a USB transfer.
+deck_serials: Dict[str, str] = api.device_serials
+
+
+def get_deck_serial(deck):
+    deck_id = deck_serials.get(deck.id())
+    if deck_id is None:
+        deck_id = deck_serials[deck.id()] = deck.get_serial_number()
+    return deck_id
 
-    # Generate the custom key with the requested image and label.
-    icon = api.get_button_icon(deck_id, page, key)
-    if icon == '':
-        icon = key_style['icon']
+
+# Renders the released and pressed images of a key. The images are stored in
+# the shared api image cache, so identical keys are only rendered once.
+def render_key_sprites(deck, deck_id, page, key):
     label = api.get_button_text(deck_id, page, key)
-    image = render_key_image(deck, icon, key_style["font"], label)
+    background_key = ()
+    background = None
+    if api.get_background(deck_id):
+        try:
+            background_mtime = os.stat(api.get_background(deck_id)).st_mtime_ns
+        except OSError:
+            background_mtime = 0
+        background_key = (api.get_background(deck_id), background_mtime, key)
+        background = api.key_background(deck_id, key)
+    sprites = []
+    for state in (False, True):
+        key_style = get_key_style(deck, key, state)
+        icon = api.get_button_icon(deck_id, page, key) or key_style["icon"]
+        try:
+            icon_mtime = os.stat(icon).st_mtime_ns
+        except OSError:
+            icon_mtime = 0
+        cache_key = ("sprite", deck.deck_type(), deck.key_image_format()["size"],
+                     icon, icon_mtime, key_style["font"], label, *background_key)
+        sprites.append(api.image_cache.get_or_render(
+            cache_key, partial(render_key_image, deck, icon, key_style["font"], label, background)))
+
+    return tuple(sprites)
+
+
+# Renders the sprites of every key on the deck's current page ahead of time.
+def prerender_key_sprites(deck, deck_id):
+    page = api.get_page(deck_id)
+    for key in range(deck.key_count()):
+        store_key_sprites(deck, deck_id, page, key)
+
+
+# Renders and stores the sprites of a key along with the button version they show.
+def store_key_sprites(deck, deck_id, page, key):
+    version = api.get_button_version(deck_id, page, key)
+    sprites = render_key_sprites(deck, deck_id, page, key)
+    key_sprites[(deck_id, page, key)] = (version, sprites)
+    return sprites
+
 
-    # Use a scoped-with on the deck to ensure we're the only thread using it
-    # right now.
-    with deck:
-        # Update requested key with the generated image.
-        deck.set_key_image(key, image)
+# Drops the sprites of buttons whose settings changed, re-rendering them right
+# away when they are on a visible page.
+def invalidate_key_sprites(deck_id, page, button):
+    if deck_id is None:
+        key_sprites.clear()
+        for deck_id, deck in decks.items():
+            prerender_key_sprites(deck, deck_id)
+        return
 
+    if key_sprites.pop((deck_id, page, button), None) is not None and deck_id in decks:
+        if api.get_page(deck_id) == page:
+            store_key_sprites(decks[deck_id], deck_id, page, button)
 
-# Prints key state change information, updates rhe key image and performs any
-# associated actions when a key is pressed.
+
+api.add_change_listener(invalidate_key_sprites)
+
+
+# Updates the key image on the StreamDeck to match the key's current state.
+def update_key_image(deck, deck_id, page, key, state):
+    # A released dynamic key goes back to showing its latest value
+    if not state and api.get_button_dynamic(deck_id, page, key):
+        api.refresh_tile(deck_id, key)
+        return
+
+    entry = key_sprites.get((deck_id, page, key))
+    if entry is not None and entry[0] == api.get_button_version(deck_id, page, key):
+        sprites = entry[1]
+    else:
+        sprites = store_key_sprites(deck, deck_id, page, key)
+
+    # Hand the pre-rendered image to the deck's writer thread, which owns all
+    # writes to the device.
+    api.set_key_image(deck_id, key, sprites[state])
+
+
+# Updates the key image and hands the key's actions to the action executor, so
+# the deck's read thread is never held up by the actions themselves. MIDI is
+# sent from here, as it only queues bytes and must keep its timing. Any key
+# stops the dimmer's fade at once; a press that wakes a dark display does
+# nothing else.
 def key_change_callback(deck, key, state):
-    deck_id = deck.get_serial_number()
+    pressed_at = time.perf_counter()
+    deck_id = get_deck_serial(deck)
+    dimmer = dimmers.get(deck_id)
+    if dimmer and dimmer.reset() and state:
+        return
     page = api.get_page(deck_id)
-    update_key_image(deck, page, key, state)
-    internal_command = {}
-    external_command = {}
-    external_commands = ['OSC', 'MIDI', 'MQTT']
+    update_key_image(deck, deck_id, page, key, state)
+    plan = api.get_action_plan(deck_id, page, key)
+    if midi_output:
+        if state and plan.command_type == 'MIDI':
+            midi_output.send(plan.argument.press)
+            if plan.argument.release:
+                midi_releases[(deck_id, key)] = plan.argument.release
+        elif not state and (deck_id, key) in midi_releases:
+            midi_output.send(midi_releases.pop((deck_id, key)))
+    executor.submit((deck_id, key), run_key_actions(deck, deck_id, page, key, state, plan, pressed_at))
+
+
+# Prints key state change information and performs the button's compiled action
+# plan when a key is pressed. Runs on an executor worker: yielding a delay
+# continues the action after that many seconds without holding up a thread.
+def run_key_actions(deck, deck_id, page, key, state, plan, pressed_at):
     print(deck_id, key, state)
-    if state:
-        # if dimmers[deck_id].reset():
-        #     return
+    if not state:
+        return
+
+    labels = {"deck": deck_id, "page": page, "action": plan.command_type or "none"}
+    started_at = time.perf_counter()
+    press_to_action_seconds.labels(**labels).observe(started_at - pressed_at)
+    try:
+        yield from perform_action(deck, deck_id, plan, (deck_id, page, key))
+    finally:
+        action_seconds.labels(**labels).observe(time.perf_counter() - started_at)
+
+
+# Performs a compiled action plan, yielding the delays between its steps. The
+# button identifies the pressed key for per-button limits such as how many
+# copies of a Command's program may run.
+def perform_action(deck, deck_id, plan, button):
+    if plan.command_type in EXTERNAL_COMMAND_TYPES:
+        if plan.command_type == 'MIDI' and midi_output:
+            # Already sent from key_change_callback
+            pass
+        elif plan.command_type == 'OSC' and OSC_NATIVE:
+            try:
+                osc_sender.send_command(plan.argument)
+            except Exception as error:
+                print(f"Could not send OSC message '{plan.command_string}': {error}")
+        elif plan.command_type == 'MQTT' and get_mqtt_publisher(deck_id):
+            get_mqtt_publisher(deck_id).publish(*plan.argument)
+        else:
+            external_command = {"command_type": plan.command_type, "command_string": plan.command_string}
+            event_channel.emit(external_command)
+
+    elif plan.command_type == 'Command':
+        if plan.argument.argv:
+            try:
+                launcher.launch(button, plan.argument, plan.command_string)
+            except Exception as error:
+                print(f"The command '{plan.command_string}' failed: {error}")
+
+    elif plan.command_type == 'Keystroke':
+        keyboard = get_keyboard()
+        for section_keys in plan.argument:
+            for key_name in section_keys:
+                if isinstance(key_name, float):
+                    if key_name > 0:
+                        yield key_name
+                else:
+                    try:
+                        keyboard.press(resolve_key(key_name))
+                    except Exception:
+                        print(f"Could not press key '{key_name}'")
+
+            for key_name in section_keys:
+                if not isinstance(key_name, float):
+                    try:
+                        keyboard.release(resolve_key(key_name))
+                    except Exception:
+                        print(f"Could not release key '{key_name}'")
+
+    elif plan.command_type == 'Text':
+        try:
+            get_keyboard().type(plan.argument)
+        except Exception as error:
+            print(f"Could not complete the write command: {error}")
+
+    # Set absolute brightness
+    elif plan.command_type == 'Set Brightness':
+        try:
+            set_brightness(deck_id, plan.argument)
+        except Exception as error:
+            print(f"Could not change brightness: {error}")
+
+    # Dim by percentage
+    elif plan.command_type == 'Brightness':
+        try:
+            api.change_brightness(deck_id, plan.argument)
+            dimmers[deck_id].brightness = api.get_brightness(deck_id)
+            dimmers[deck_id].reset()
+        except Exception as error:
+            print(f"Could not change brightness: {error}")
+
+    elif plan.command_type == 'Page':
+        set_page(deck_id, plan.argument)
+
+    elif plan.command_type == 'CloseStreamDeck':
+        exit_event.set()
+
+
+# Sets a deck's brightness, which its dimmer then returns to after dimming.
+def set_brightness(deck_id, brightness):
+    api.set_brightness(deck_id, brightness)
+    if deck_id in dimmers:
+        dimmers[deck_id].brightness = api.get_brightness(deck_id)
+        dimmers[deck_id].reset()
+
+
+# Switches the page a deck shows and pre-renders the pressed images of its keys.
+def set_page(deck_id, page):
+    api.set_page(deck_id, page)
+    if deck_id in decks:
+        prerender_key_sprites(decks[deck_id], deck_id)
 
 
-        if api.get_button_command_type(deck_id, page, key) in external_commands:
-            external_command = {"command_type":api.get_button_command_type(deck_id, page, key), "command_string":api.get_button_command_string(deck_id, page, key)}
-        else:
-            internal_command = {"command_type":api.get_button_command_type(deck_id, page, key), "command_string":api.get_button_command_string(deck_id, page, key)}
-
-        if external_command:
-            # queue.put(external_command)
-            # print(f"External: {external_command}")
-            print(json.dumps(external_command), file = sys.stdout)
-
-        if internal_command:
-            # print(f"Internal: {internal_command}")
-
-            command = internal_command['command_type'] == 'Command'
-            if command:
-                try:
-                    Popen(shlex.split(internal_command['command_string']))
-                except Exception as error:
-                    print(f"The command '{internal_command['command_string']}' failed: {error}")
-
-            keys = internal_command['command_type'] == 'Keystroke'
-            if keys:
-                keys = internal_command['command_string']
-                keys = keys.strip().replace(" ", "")
-                for section in keys.split(","):
-                    # Since + and , are used to delimit our section and keys to press,
-                    # they need to be substituted with keywords.
-                    section_keys = [_replace_special_keys(key_name) for key_name in section.split("+")]
-
-                    # Translate string to enum, or just the string itself if not found
-                    section_keys = [
-                        getattr(Key, key_name.lower(), key_name) for key_name in section_keys
-                    ]
-
-                    for key_name in section_keys:
-                        if isinstance(key_name, str) and key_name.startswith("delay"):
-                            sleep_time_arg = key_name.split("delay", 1)[1]
-                            if sleep_time_arg:
-                                try:
-                                    sleep_time = float(sleep_time_arg)
-                                except Exception:
-                                    print(f"Could not convert sleep time to float '{sleep_time_arg}'")
-                                    sleep_time = 0
-                            else:
-                                # default if not specified
-                                sleep_time = 0.5
-
-                            if sleep_time:
-                                try:
-                                    time.sleep(sleep_time)
-                                except Exception:
-                                    print(f"Could not sleep with provided sleep time '{sleep_time}'")
-                        else:
-                            try:
-                                keyboard.press(key_name)
-                            except Exception:
-                                print(f"Could not press key '{key_name}'")
-
-                    for key_name in section_keys:
-                        if not (isinstance(key_name, str) and key_name.startswith("delay")):
-                            try:
-                                keyboard.release(key_name)
-                            except Exception:
-                                print(f"Could not release key '{key_name}'")
-
-            write = internal_command['command_type'] == "Text"
-            if write:
-                try:
-                    keyboard.type(internal_command['command_string'])
-                except Exception as error:
-                    print(f"Could not complete the write command: {error}")
-
-            # Set absolute brightness
-            set_brightness = internal_command['command_type'] == 'Set Brightness'
-            if set_brightness:
-                try:
-                    api.set_brightness(deck_id, int(internal_command['command_string']))
-                    dimmers[deck_id].brightness = api.get_brightness(deck_id)
-                    dimmers[deck_id].reset()
-                except Exception as error:
-                    print(f"Could not change brightness: {error}")
-
-            # Dim by percentage
-            change_brightness = internal_command['command_type'] == 'Brightness'
-            if set_brightness:
-                try:
-                    api.change_brightness(deck_id, int(internal_command['command_string']))
-                    dimmers[deck_id].brightness = api.get_brightness(deck_id)
-                    dimmers[deck_id].reset()
-                except Exception as error:
-                    print(f"Could not change brightness: {error}")
-
-            switch_page = internal_command['command_type'] == 'Page'
-            if switch_page:
-                api.set_page(deck_id, int(internal_command['command_string']) - 1)
-
-            CloseStreamDeck = internal_command['command_type'] == 'CloseStreamDeck'
-            if CloseStreamDeck:
-                api.close_decks()
-                sys.exit()
 # # #
 # def key_change_callback(deck, key, state):
 #     # Print new key state
@@ -331,32 +566,97 @@ def key_change_callback(deck, key, state):
 #                 deck.close()
 
 
+# Opens a deck and shows its current page. Returns once the page's images are
+# queued for the deck; pre-rendering the other pages continues in the background.
+def start_deck(deck):
+    deck.open()
+    deck.reset()
+    deck_id = get_deck_serial(deck)
+    decks[deck_id] = deck
+    api.invalidate_displayed(deck_id)
+    print("Opened '{}' device (serial number: '{}')".format(deck.deck_type(), deck_id))
+
+    # Start at the configured brightness and dim after the display timeout.
+    brightness = api.get_brightness(deck_id)
+    dimmers[deck_id] = Dimmer(
+        api.get_display_timeout(deck_id),
+        brightness,
+        brightness * api.get_brightness_dimmed(deck_id) // 100,
+        partial(api.write_brightness, deck_id),
+    )
+    dimmers[deck_id].reset()
+
+    # Register callback function for when a key state changes.
+    deck.set_key_callback(key_change_callback)
+    api.render(deck_id=deck_id)
+    api.prerender(decks)
+    prerender_key_sprites(deck, deck_id)
+    return deck_id
+
+
+# Takes over a deck that api reconnected after it was plugged back in. api has
+# already restored its brightness and renders its page once this returns.
+def deck_reconnected(deck_id, deck):
+    deck.set_key_callback(key_change_callback)
+    if deck_id in dimmers:
+        dimmers[deck_id].reset()
+    prerender_key_sprites(deck, deck_id)
+
+
+api.add_reconnect_listener(deck_reconnected)
+
+
 if __name__ == "__main__":
+    if METRICS_FILE:
+        metrics_exporter = metrics.MetricsExporter(metrics.REGISTRY, METRICS_FILE, METRICS_INTERVAL)
+        metrics_exporter.start()
+
     streamdecks = DeviceManager().enumerate()
 
+    if any(plan.command_type == 'MIDI' for plan in api.action_plans.values()):
+        if midi.available(MIDI_BACKEND):
+            midi_output, midi_error = midi.open_output(MIDI_BACKEND, MIDI_PORT)
+            if midi_error:
+                print(f"Unable to open MIDI output, MIDI buttons will be printed: {midi_error}")
+        elif MIDI_BACKEND:
+            print(f"MIDI backend '{MIDI_BACKEND}' is not available, MIDI buttons will be relayed")
+
     print("Found {} Stream Deck(s).\n".format(len(streamdecks)))
 
+    # Open the event sink now, so readers can connect before the first event
+    event_channel.start()
+
     for index, deck in enumerate(streamdecks):
-        deck.open()
-        deck.reset()
-        deck_id = deck.get_serial_number()
-        decks[deck_id] = deck
-        items = decks.items()
-        for deck_id, deck in items:
-            print(deck_id)
-
-        print("Opened '{}' device (serial number: '{}')".format(deck.deck_type(), deck.get_serial_number()))
-
-        # Set initial screen brightness to 30%.
-        deck.set_brightness(30)
-
-        # Register callback function for when a key state changes.
-        deck.set_key_callback(key_change_callback)
-        api.render(decks)
-        # Wait until all application threads have terminated (for this example,
-        # this is when all deck handles are closed).
-        for t in threading.enumerate():
-            try:
-                t.join()
-            except RuntimeError:
-                pass
+        start_deck(deck)
+
+    hotplug_monitor = HotplugMonitor(api.ensure_decks_connected, HOTPLUG_INTERVAL, HOTPLUG_UDEV)
+    hotplug_monitor.start()
+    if CONTROL_SOCKET:
+        control_server = ControlServer(CONTROL_SOCKET, set_page, set_brightness)
+        control_server.start()
+        metrics.REGISTRY.register_collector(
+            lambda: [(f"streamdeck_control_{name}", {}, value) for name, value in control_server.stats().items()]
+        )
+    if CONFIG_WATCH:
+        config_watcher = FileWatcher(STATE_FILE, api.reload_config, CONFIG_WATCH_INTERVAL)
+        config_watcher.start()
+
+    # Wait until a CloseStreamDeck action asks the application to exit.
+    try:
+        exit_event.wait()
+    except KeyboardInterrupt:
+        pass
+    hotplug_monitor.stop()
+    if CONTROL_SOCKET:
+        control_server.stop()
+    if CONFIG_WATCH:
+        config_watcher.stop()
+    api.close_decks()
+    osc_sender.close()
+    event_channel.close()
+    for publisher in mqtt_publishers.values():
+        publisher.close()
+    if midi_output:
+        midi_output.close()
+    if METRICS_FILE:
+        metrics_exporter.stop()
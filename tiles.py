@@ -0,0 +1,389 @@
+"""Keeps the text of dynamic keys up to date from providers such as a clock or a command
+
+A button becomes dynamic by setting "dynamic" to one of the PROVIDERS, with the provider's
+argument in "dynamic_string" and, optionally, the seconds between updates in
+"dynamic_interval". The provider's value replaces "{}" in the button's text, or the whole
+text when it has no "{}".
+"""
+import heapq
+import itertools
+import os
+import shlex
+import subprocess
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Seconds to wait before checking again on a command that is still running
+COMMAND_CHECK_INTERVAL = 0.05
+
+
+class TileSpec(NamedTuple):
+    """What a dynamic key shows: the provider, its argument and the seconds between updates"""
+
+    provider: str
+    argument: str
+    interval: float
+
+
+class _Provider:
+    """ Produces the value of a dynamic key. poll returns the new value, or None
+        if it has none yet, and the seconds until it should be polled again. """
+
+    def __init__(self, argument: str, interval: float):
+        self.argument = argument
+        self.interval = interval
+
+    def poll(self) -> Tuple[Optional[str], float]:
+        return self.value(), self.interval
+
+    def value(self) -> str:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class ClockProvider(_Provider):
+    """ The local time in the strftime format given as the argument, "%H:%M" by
+        default. Polls fall on whole multiples of the interval, so a clock
+        showing seconds or minutes changes on time."""
+
+    def poll(self) -> Tuple[Optional[str], float]:
+        return self.value(), self.interval - time.time() % self.interval
+
+    def value(self) -> str:
+        return time.strftime(self.argument or "%H:%M")
+
+
+class CpuProvider(_Provider):
+    """ Processor use since the previous poll, in percent, from /proc/stat."""
+
+    def __init__(self, argument: str, interval: float):
+        super().__init__(argument, interval)
+        self._last = self._times()
+
+    @staticmethod
+    def _times() -> Tuple[int, int]:
+        with open("/proc/stat") as stat:
+            fields = [int(field) for field in stat.readline().split()[1:]]
+        # idle and iowait
+        return sum(fields), fields[3] + fields[4]
+
+    def value(self) -> str:
+        total, idle = self._times()
+        last_total, last_idle = self._last
+        self._last = total, idle
+        elapsed = total - last_total
+        return f"{round(100 * (1 - (idle - last_idle) / elapsed)) if elapsed else 0}%"
+
+
+class MemoryProvider(_Provider):
+    """ Memory in use, in percent of the total, from /proc/meminfo."""
+
+    def value(self) -> str:
+        memory = {}
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                name, amount = line.split(":", 1)
+                memory[name] = int(amount.split()[0])
+        return f"{round(100 * (1 - memory['MemAvailable'] / memory['MemTotal']))}%"
+
+
+class FileProvider(_Provider):
+    """ The first line of the file given as the argument. The file is only read
+        again after its modification time or size changed."""
+
+    def __init__(self, argument: str, interval: float):
+        super().__init__(os.path.expanduser(argument), interval)
+        self._signature: Optional[Tuple[int, int]] = None
+        self._value = ""
+
+    def poll(self) -> Tuple[Optional[str], float]:
+        try:
+            stat = os.stat(self.argument)
+        except OSError:
+            self._signature = None
+            return "", self.interval
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return None, self.interval
+        self._signature = signature
+        self._value = self.value()
+        return self._value, self.interval
+
+    def value(self) -> str:
+        with open(self.argument, errors="replace") as text:
+            return text.readline(256).strip()
+
+
+class CommandProvider(_Provider):
+    """ The first line the command given as the argument prints, run every
+        interval seconds. The command runs in the background and is checked on
+        without waiting for it; one still running after interval seconds is
+        killed, and never more than one copy runs per key."""
+
+    def __init__(self, argument: str, interval: float):
+        super().__init__(argument, interval)
+        self.argv = shlex.split(argument)
+        if not self.argv:
+            raise ValueError("No command given")
+        self._process: Optional[subprocess.Popen] = None
+        self._started_at = 0.0
+        # close runs on another thread than poll; once it has, poll starts nothing new
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def poll(self) -> Tuple[Optional[str], float]:
+        with self._lock:
+            if self._closed:
+                return None, self.interval
+            return self._poll()
+
+    def _poll(self) -> Tuple[Optional[str], float]:
+        now = time.monotonic()
+        if self._process is None:
+            self._process = subprocess.Popen(
+                self.argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+            self._started_at = now
+            return None, COMMAND_CHECK_INTERVAL
+
+        if self._process.poll() is None:
+            if now - self._started_at < self.interval:
+                return None, COMMAND_CHECK_INTERVAL
+            self._process.kill()
+        try:
+            output, _errors = self._process.communicate(timeout=COMMAND_CHECK_INTERVAL)
+        except subprocess.TimeoutExpired:
+            # Something the command started still holds its output open
+            self._process.kill()
+            output = b""
+        self._process = None
+        value = output.decode(errors="replace").strip().split("\n", 1)[0]
+        return value, max(0.0, self.interval - (now - self._started_at))
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            if self._process is not None:
+                if self._process.poll() is None:
+                    self._process.kill()
+                self._process.wait()
+                self._process.stdout.close()  # type: ignore
+            self._process = None
+
+
+# Providers by the name used in a button's "dynamic" setting, with their default interval
+PROVIDERS: Dict[str, Tuple[Callable[[str, float], _Provider], float]] = {
+    "clock": (ClockProvider, 1.0),
+    "cpu": (CpuProvider, 2.0),
+    "memory": (MemoryProvider, 5.0),
+    "file": (FileProvider, 1.0),
+    "command": (CommandProvider, 10.0),
+}
+
+
+def tile_spec(button_settings) -> Optional[TileSpec]:
+    """Returns the TileSpec of a button's settings, or None if the button is not dynamic.
+    Raises ValueError for an unknown provider or interval."""
+    provider = button_settings.get("dynamic", "")
+    if not provider:
+        return None
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown dynamic provider '{provider}'")
+    interval = float(button_settings.get("dynamic_interval", 0) or PROVIDERS[provider][1])
+    if interval <= 0:
+        raise ValueError(f"Dynamic interval must be positive, not {interval}")
+    return TileSpec(provider, button_settings.get("dynamic_string", ""), interval)
+
+
+def tile_text(text: str, value: str) -> str:
+    """Returns the label of a dynamic key: its text with the value filled in"""
+    return text.replace("{}", value) if "{}" in text else value
+
+
+class _Tile:
+    __slots__ = ("deck_id", "page", "key", "spec", "provider", "due", "value")
+
+    def __init__(self, deck_id: str, page: int, key: int, spec: TileSpec):
+        self.deck_id = deck_id
+        self.page = page
+        self.key = key
+        self.spec = spec
+        self.provider = PROVIDERS[spec.provider][0](spec.argument, spec.interval)
+        self.due = time.monotonic()
+        self.value: Optional[str] = None
+
+
+class TileScheduler:
+    """ Polls the providers of the dynamic keys on the pages being shown, on one
+        background thread, and passes each new value to update. A value equal to
+        the one shown is not passed on. Each deck may receive at most budget
+        updates per second, with bursts of up to budget; updates over the
+        budget wait, and only the newest value of a key is kept while waiting,
+        counted as superseded.
+        Keys on pages that are not shown have no tiles, so their providers are
+        not polled at all. update runs on the scheduler's thread and should only
+        queue the key image, as api.render does, so key presses never wait on it. """
+
+    def __init__(self, update: Callable[[str, int, int, str], None], budget: float):
+        """ Constructs a new TileScheduler instance
+
+        :param Callable update: Receives (deck_id, page, key, value) for each new value.
+        :param float budget: The most key updates per second sent to each deck.
+        """
+        self.update = update
+        self.budget = max(0.1, budget)
+        self.polls = 0
+        self.updates = 0
+        self.unchanged = 0
+        self.superseded = 0
+        self.errors = 0
+        self._tiles: Dict[Tuple[str, int], _Tile] = {}
+        self._due: List[Tuple[float, int, Tuple[str, int]]] = []
+        self._sequence = itertools.count()
+        # Per deck: the tokens left of its budget and when they were counted, and the values
+        # waiting for a token by key
+        self._tokens: Dict[str, Tuple[float, float]] = {}
+        self._waiting: Dict[str, Dict[int, Tuple[int, str]]] = {}
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def show(self, deck_id: str, page: int, specs: Dict[int, TileSpec]) -> None:
+        """ Sets the dynamic keys of the page a deck shows. Tiles of keys whose spec is
+            unchanged keep their provider and value; all the others of the deck stop."""
+        closed = []
+        with self._condition:
+            for tile_id, tile in list(self._tiles.items()):
+                if tile.deck_id != deck_id:
+                    continue
+                if tile.page != page or specs.get(tile.key) != tile.spec:
+                    del self._tiles[tile_id]
+                    closed.append(tile.provider)
+            waiting = self._waiting.get(deck_id, {})
+            for key in [key for key, (waiting_page, _value) in waiting.items() if waiting_page != page]:
+                del waiting[key]
+
+            for key, spec in specs.items():
+                if (deck_id, key) in self._tiles:
+                    continue
+                try:
+                    tile = _Tile(deck_id, page, key, spec)
+                except (OSError, ValueError) as error:
+                    self.errors += 1
+                    print(f"Unable to show {spec.provider} on key {key} of {deck_id} with error {error}")
+                    continue
+                self._tiles[(deck_id, key)] = tile
+                heapq.heappush(self._due, (tile.due, next(self._sequence), (deck_id, key)))
+
+            if self._tiles and self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="tiles", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+        for provider in closed:
+            provider.close()
+
+    def refresh(self, deck_id: str, key: int) -> None:
+        """ Sends the current value of a dynamic key again, after something else was
+            shown on it, such as the image of the key being pressed."""
+        with self._condition:
+            tile = self._tiles.get((deck_id, key))
+            if tile is not None and tile.value is not None:
+                self._waiting.setdefault(deck_id, {})[key] = (tile.page, tile.value)
+                self._condition.notify()
+
+    def value(self, deck_id: str, page: int, key: int) -> Optional[str]:
+        """ Returns the latest value of a dynamic key, or None if it has none yet."""
+        tile = self._tiles.get((deck_id, key))
+        return tile.value if tile is not None and tile.page == page else None
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the number of tiles shown and the poll and update counters."""
+        return {
+            "tiles": len(self._tiles),
+            "polls": self.polls,
+            "updates": self.updates,
+            "unchanged": self.unchanged,
+            "superseded": self.superseded,
+            "errors": self.errors,
+        }
+
+    def _take_ready(self, now: float) -> Tuple[List[Tuple[str, int, int, str]], Optional[float]]:
+        """Takes the waiting values that fit in their deck's budget, returning them and when
+        the next token for the values left waiting is available"""
+        ready = []
+        token_at = None
+        for deck_id, waiting in self._waiting.items():
+            if not waiting:
+                continue
+            tokens, counted_at = self._tokens.get(deck_id, (self.budget, now))
+            tokens = min(self.budget, tokens + (now - counted_at) * self.budget)
+            while waiting and tokens >= 1:
+                tokens -= 1
+                key = next(iter(waiting))
+                page, value = waiting.pop(key)
+                ready.append((deck_id, page, key, value))
+            self._tokens[deck_id] = (tokens, now)
+            if waiting:
+                available_at = now + (1 - tokens) / self.budget
+                token_at = available_at if token_at is None else min(token_at, available_at)
+        return ready, token_at
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    polls = []
+                    while self._due and self._due[0][0] <= now:
+                        _due, _sequence, tile_id = heapq.heappop(self._due)
+                        tile = self._tiles.get(tile_id)
+                        if tile is not None:
+                            polls.append(tile)
+                    ready, token_at = self._take_ready(now)
+                    if polls or ready:
+                        break
+                    wake_at = min(
+                        (at for at in (token_at, self._due[0][0] if self._due else None) if at is not None),
+                        default=None,
+                    )
+                    self._condition.wait(None if wake_at is None else max(0.0, wake_at - now))
+
+            for deck_id, page, key, value in ready:
+                try:
+                    self.update(deck_id, page, key, value)
+                    self.updates += 1
+                except Exception as error:
+                    self.errors += 1
+                    print(f"Unable to show key {key} of {deck_id} with error {error}")
+
+            # Providers run without the lock, so show() never waits on a slow one
+            for tile in polls:
+                self._poll(tile, now)
+
+    def _poll(self, tile: _Tile, now: float) -> None:
+        try:
+            value, delay = tile.provider.poll()
+        except Exception as error:
+            self.errors += 1
+            print(f"Unable to update {tile.spec.provider} on key {tile.key} of {tile.deck_id} with error {error}")
+            value, delay = None, tile.spec.interval
+        self.polls += 1
+
+        with self._condition:
+            if self._tiles.get((tile.deck_id, tile.key)) is not tile:
+                return
+            tile.due = now + delay
+            heapq.heappush(self._due, (tile.due, next(self._sequence), (tile.deck_id, tile.key)))
+            if value is None:
+                return
+            if value == tile.value:
+                self.unchanged += 1
+                return
+            tile.value = value
+            waiting = self._waiting.setdefault(tile.deck_id, {})
+            if tile.key in waiting:
+                self.superseded += 1
+            waiting[tile.key] = (tile.page, value)
@@ -0,0 +1,140 @@
+"""Watches a file for changes, through inotify on Linux and by polling elsewhere"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")
+
+# Seconds to wait for further events of the same save before calling back
+SETTLE_TIME = 0.1
+
+
+def _inotify():
+    """Returns libc if it has inotify, otherwise None"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class FileWatcher:
+    """ Calls on_change from a background thread after a file was written or
+        replaced. With inotify the directory holding the file is watched, which
+        also catches editors and programs that save by renaming a new file over
+        it; without inotify the file's size, modification time and inode are
+        compared every interval seconds. """
+
+    def __init__(self, path: str, on_change: Callable[[], object], interval: float):
+        """ Constructs a new FileWatcher instance
+
+        :param str path: The file to watch. Symbolic links are followed.
+        :param Callable on_change: Called once for each burst of changes.
+        :param float interval: Seconds between checks when polling.
+        """
+        self.path = os.path.realpath(path)
+        self.on_change = on_change
+        self.interval = interval
+        self.mode = ""
+        self.changes = 0
+        self.errors = 0
+        self._stopped = threading.Event()
+        self._wake_receive, self._wake_send = os.pipe()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="file-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        os.write(self._wake_send, b"\0")
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the number of changes seen and of callbacks that failed."""
+        return {"inotify": int(self.mode == "inotify"), "changes": self.changes, "errors": self.errors}
+
+    def _run(self) -> None:
+        inotify_fd = self._watch()
+        self.mode = "inotify" if inotify_fd is not None else "poll"
+        if inotify_fd is None:
+            self._poll()
+            return
+        try:
+            name = os.fsencode(os.path.basename(self.path))
+            while not self._stopped.is_set():
+                if self._wait_for(inotify_fd, name, None):
+                    # A save can take several events, gather them into one call
+                    while self._wait_for(inotify_fd, name, SETTLE_TIME):
+                        pass
+                    self._changed()
+        finally:
+            os.close(inotify_fd)
+
+    def _watch(self) -> Optional[int]:
+        libc = _inotify()
+        if libc is None:
+            return None
+        inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if inotify_fd < 0:
+            return None
+        directory = os.fsencode(os.path.dirname(self.path))
+        if libc.inotify_add_watch(inotify_fd, directory, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            print(f"Polling {self.path} for changes, unable to watch it: {os.strerror(error)}")
+            os.close(inotify_fd)
+            return None
+        return inotify_fd
+
+    def _wait_for(self, inotify_fd: int, name: bytes, timeout: Optional[float]) -> bool:
+        """Waits for events, returning whether any of them were about the watched file"""
+        readable, _writable, _errors = select.select([inotify_fd, self._wake_receive], [], [], timeout)
+        if inotify_fd not in readable:
+            return False
+        try:
+            data = os.read(inotify_fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+
+        matched = False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _wd, _mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            matched = matched or data[offset:offset + length].rstrip(b"\0") == name
+            offset += length
+        return matched
+
+    def _signature(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _poll(self) -> None:
+        last = self._signature()
+        while not self._stopped.wait(self.interval):
+            signature = self._signature()
+            if signature != last and signature is not None:
+                self._changed()
+            last = signature
+
+    def _changed(self) -> None:
+        self.changes += 1
+        try:
+            self.on_change()
+        except Exception as error:
+            self.errors += 1
+            print(f"Unable to apply the changes to {self.path}: {error}")